@@ -0,0 +1,110 @@
+"""
+Benchmark of the DDA sensor traversal: render time of the forward and
+backward passes for several transmittance thresholds, and the resulting dose
+error relative to a full traversal.
+
+To compare against another revision of the sensor, run this script on both.
+Revisions without early termination only support a threshold of 0, for which
+the 'min_transmittance' parameter is not passed to the sensor.
+
+Usage:
+    python benchmarks/dda.py --variant cuda_ad_mono --thresholds 0 1e-3 1e-2
+"""
+import argparse
+import time
+
+import mitsuba as mi
+import drjit as dr
+
+def build_scene(res, min_transmittance, sigma_t):
+    d_ext = 16.77
+    d_int = 15.33
+    sensor = {
+        'type': 'dda',
+        'to_world': mi.ScalarTransform4f().scale(d_ext),
+        'film': {
+            'type': 'vfilm',
+            'resx': res,
+            'resy': res,
+            'resz': res,
+        }
+    }
+    if min_transmittance > 0:
+        sensor['min_transmittance'] = min_transmittance
+
+    return mi.load_dict({
+        'type': 'scene',
+        'dmd': {
+            'type': 'collimated',
+            'patterns': mi.TensorXf(dr.linspace(mi.Float, 1, 10, 100*res*res), (100, res, res)),
+            'pixel_size': d_ext/res,
+            'motion': 'circular',
+            'distance': 1.5 * d_ext,
+        },
+        'sensor': sensor,
+        'vial_interior': {
+            'type': 'cylinder',
+            'p0': [0., 0., -10.],
+            'p1': [0., 0.,  10.],
+            'radius': 0.5 * d_int,
+            'bsdf': {'type': 'null'},
+            'interior': {
+                'type': 'homogeneous',
+                'sigma_t': sigma_t,
+                'albedo': 0.,
+            }
+        },
+    })
+
+def timed(fn, n_runs):
+    timings = []
+    for _ in range(n_runs + 1):
+        dr.sync_thread()
+        start = time.perf_counter()
+        out = fn()
+        dr.eval(out)
+        dr.sync_thread()
+        timings.append(time.perf_counter() - start)
+    # Discard the first run, which includes kernel compilation
+    return out, min(timings[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--variant', default='llvm_ad_mono')
+    parser.add_argument('--res', type=int, default=128, help="Film and projector resolution")
+    parser.add_argument('--spp', type=int, default=4, help="Samples per pixel")
+    parser.add_argument('--sigma_t', type=float, default=0.5, help="Extinction of the printing medium")
+    parser.add_argument('--runs', type=int, default=3, help="Timed runs per configuration")
+    parser.add_argument('--thresholds', type=float, nargs='+', default=[0., 1e-3, 1e-2, 1e-1], help="Transmittance thresholds")
+    args = parser.parse_args()
+
+    mi.set_variant(args.variant)
+    import drtvam
+
+    integrator = mi.load_dict({'type': 'volume', 'max_depth': 8})
+    reference = None
+    print(f"{'threshold':>10}{'forward':>12}{'backward':>12}{'rel. error':>12}")
+    for threshold in args.thresholds:
+        scene = build_scene(args.res, threshold, args.sigma_t)
+        params = mi.traverse(scene)
+        key = 'dmd.active_data'
+
+        vol, t_fwd = timed(lambda: mi.render(scene, params, integrator=integrator, spp=args.spp, seed=0), args.runs)
+
+        def backward():
+            dr.enable_grad(params[key])
+            params.update()
+            y = mi.render(scene, params, integrator=integrator, spp=args.spp, seed=0)
+            dr.backward(dr.sum(y, axis=None))
+            grad = dr.grad(params[key])
+            dr.disable_grad(params[key])
+            return grad
+        _, t_bwd = timed(backward, args.runs)
+
+        if reference is None:
+            reference = vol
+        error = dr.sum(dr.abs(vol - reference), axis=None) / dr.sum(reference, axis=None)
+        print(f"{threshold:>10.0e}{1e3 * t_fwd:>10.1f}ms{1e3 * t_bwd:>10.1f}ms{error[0]:>12.2e}")
+
+if __name__ == '__main__':
+    main()
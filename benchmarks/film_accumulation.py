@@ -0,0 +1,69 @@
+"""
+Benchmark of the reduce modes of VolumetricFilm.write, with the access pattern
+of a collimated projection: the samples of each pixel are contiguous in the
+wavefront, and march through the same column of voxels.
+
+Usage:
+    python benchmarks/film_accumulation.py --threads 1 2 4 8 16
+"""
+import argparse
+import time
+
+import mitsuba as mi
+import drjit as dr
+
+mi.set_variant('llvm_ad_mono')
+
+import drtvam
+
+@dr.syntax
+def march(film, spp):
+    res = film.resolution()
+    # One ray per sample, along the x axis of the grid
+    idx = dr.arange(mi.UInt32, res.y * res.z * spp)
+    pixel = idx // spp
+    y, z = pixel % res.y, pixel // res.y
+    value = 1. / (1. + mi.Float(idx % spp))
+
+    x = mi.UInt32(0)
+    while x < res.x:
+        film.write(value, x + y * res.x + z * res.x * res.y, True)
+        x += 1
+
+def bench(mode, res, spp, n_runs):
+    film = mi.load_dict({
+        'type': 'vfilm',
+        'resx': res,
+        'resy': res,
+        'resz': res,
+        'reduce_mode': mode,
+    })
+    timings = []
+    for _ in range(n_runs + 1):
+        film.clear()
+        dr.sync_thread()
+        start = time.perf_counter()
+        march(film, spp)
+        dr.eval(film.data)
+        dr.sync_thread()
+        timings.append(time.perf_counter() - start)
+    # Discard the first run, which includes kernel compilation
+    return min(timings[1:])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--res', type=int, default=128, help="Film resolution along each axis")
+    parser.add_argument('--spp', type=int, default=16, help="Samples per pixel")
+    parser.add_argument('--runs', type=int, default=5, help="Timed runs per configuration")
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8], help="Thread counts")
+    parser.add_argument('--modes', nargs='+', default=['direct', 'auto', 'local', 'expand'], help="Reduce modes")
+    args = parser.parse_args()
+
+    print(f"{'threads':>8}" + ''.join(f"{m:>12}" for m in args.modes))
+    for n in args.threads:
+        dr.set_thread_count(n)
+        timings = [bench(m, args.res, args.spp, args.runs) for m in args.modes]
+        print(f"{n:>8}" + ''.join(f"{1e3 * t:>10.1f}ms" for t in timings))
+
+if __name__ == '__main__':
+    main()
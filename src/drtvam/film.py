@@ -5,21 +5,47 @@ class VolumetricFilm(mi.Film):
     def __init__(self, props):
         super().__init__(props)
 
-        #TODO: have proper reconstruction filters
-        resz = props.get('resz', 256)
-        resy = props.get('resx', 256)
-        resx = props.get('resy', 256)
+        # Reconstruction filter: 'box' writes each sample to its voxel, 'tent'
+        # splats it trilinearly over the 8 nearest voxels
+        self.filter = props.get('filter', 'box')
+        if self.filter not in ('box', 'tent'):
+            raise ValueError(f"[{self.__class__.__name__}] Invalid filter: '{self.filter}'")
 
         # Spatial resolution of the film
-        self.res = mi.ScalarVector3i(resx, resy, resz)
+        self.res = self.parse_resolution(props)
+        resx, resy, resz = self.res.x, self.res.y, self.res.z
 
         # Use surface-aware discretization ?
         self.surface_aware = props.get('surface_aware', False)
+
+        # How contributions are reduced into the film: 'auto' lets Dr.Jit
+        # decide, 'direct' uses one atomic per contribution, 'local' first
+        # reduces contributions to the same voxel within a SIMD packet or warp,
+        # and 'expand' (LLVM only) accumulates into a private copy of the film
+        # per thread, merged once the film is evaluated
+        reduce_modes = {
+            'auto': dr.ReduceMode.Auto,
+            'direct': dr.ReduceMode.Direct,
+            'local': dr.ReduceMode.Local,
+            'expand': dr.ReduceMode.Expand,
+        }
+        reduce_mode = props.get('reduce_mode', 'auto')
+        if reduce_mode not in reduce_modes:
+            raise ValueError(f"[{self.__class__.__name__}] Invalid reduce mode: '{reduce_mode}'")
+        if reduce_mode == 'expand' and not mi.variant().startswith('llvm'):
+            raise ValueError(f"[{self.__class__.__name__}] The 'expand' reduce mode is only supported on the LLVM backend.")
+        self.reduce_mode = reduce_modes[reduce_mode]
         if self.surface_aware:
             self.data = dr.zeros(mi.TensorXf, (resz, resy, resx, 2))
         else:
             self.data = dr.zeros(mi.TensorXf, (resz, resy, resx, 1))
 
+    def parse_resolution(self, props):
+        resz = props.get('resz', 256)
+        resy = props.get('resx', 256)
+        resx = props.get('resy', 256)
+        return mi.ScalarVector3i(resx, resy, resz)
+
     def to_string(self):
         return ('VolumetricFilm[\n'
                 f'    resolution = {self.data.shape},\n'
@@ -37,8 +63,221 @@ class VolumetricFilm(mi.Film):
     def develop(self):
         return self.data
 
+    def index(self, idx, active=True):
+        """
+        Index in the film data of the flat voxel indices 'idx' (interleaved
+        with the channels in surface-aware mode), and whether the voxels are
+        stored in the film
+        """
+        return idx, active
+
     def write(self, values, idx, active):
-        dr.scatter_reduce(dr.ReduceOp.Add, self.data.array, values, idx, active)
+        dr.scatter_reduce(dr.ReduceOp.Add, self.data.array, values, idx, active, mode=self.reduce_mode)
+
+    def compact(self, tensor, reduction='mean'):
+        """
+        Convert a dense tensor of shape (resz, resy, resx, channels) to the
+        layout of the film data
+        """
+        return tensor
+
+    def expand(self, tensor):
+        """
+        Convert a tensor with the layout of the film data to a dense tensor of
+        shape (resz, resy, resx, channels)
+        """
+        return tensor
+
+class CylindricalFilm(VolumetricFilm):
+    """
+    Volumetric film in cylindrical coordinates, to be used with the
+    cylindrical sensors. Its voxels are indexed by radius, angle and height,
+    and its data is stored with shape (resz, restheta, resr, channels).
+    """
+    def parse_resolution(self, props):
+        return mi.ScalarVector3i(props.get('resr', 128), props.get('restheta', 256), props.get('resz', 256))
+
+    def to_string(self):
+        return ('CylindricalFilm[\n'
+                f'    resolution = {self.data.shape},\n'
+                ']')
+
+class SparseFilm(VolumetricFilm):
+    """
+    Volumetric film that groups the voxels in cubic bricks of 'brick_size'
+    voxels per side. Refined bricks store all of their voxels, while the other
+    bricks are stored as a single coarse cell. The data is stored compactly
+    with shape (cells, channels), and voxel indices are mapped to it through
+    the offset of each brick.
+
+    All bricks are coarse until 'refine' is called, typically with the bricks
+    crossed by the target surface.
+    """
+    def __init__(self, props):
+        super().__init__(props)
+        self.brick_size = props.get('brick_size', 8)
+        if any(r % self.brick_size != 0 for r in self.res):
+            raise ValueError(f"[SparseFilm] The film resolution {self.res} must be a multiple of the brick size ({self.brick_size}).")
+        self.brick_res = self.res // self.brick_size
+        self.refine(dr.zeros(mi.Bool, dr.prod(self.brick_res)))
+
+    def to_string(self):
+        return ('SparseFilm[\n'
+                f'    resolution = {self.res},\n'
+                f'    brick_size = {self.brick_size},\n'
+                f'    refined_bricks = {dr.count(self.refined)},\n'
+                f'    cells = {self.data.shape[0]},\n'
+                ']')
+
+    def refine(self, refined):
+        """
+        Set which bricks store all of their voxels, and reallocate the data
+        accordingly
+        """
+        self.refined = mi.Bool(refined)
+        size = dr.select(self.refined, mi.UInt32(self.brick_size**3), 1)
+        self.offsets = dr.prefix_sum(size)
+        dr.eval(self.refined, self.offsets)
+        self.data = dr.zeros(mi.TensorXf, (dr.sum(size)[0], 2 if self.surface_aware else 1))
+
+    def index(self, idx, active=True):
+        channels = 2 if self.surface_aware else 1
+        voxel = idx // channels
+        res = self.res
+        b = self.brick_size
+        x, y, z = voxel % res.x, (voxel // res.x) % res.y, voxel // (res.x * res.y)
+
+        brick = x // b + (y // b) * self.brick_res.x + (z // b) * self.brick_res.x * self.brick_res.y
+        offset = dr.gather(mi.UInt32, self.offsets, brick, active)
+        refined = dr.gather(mi.Bool, self.refined, brick, active)
+        local = x % b + (y % b) * b + (z % b) * b * b
+
+        cell = offset + dr.select(refined, local, 0)
+        return cell * channels + idx % channels, active
+
+    def cell_bounds(self, voxel, active=True):
+        """
+        Integer coordinates of the first voxel of the cells containing the
+        voxels 'voxel', and their number of voxels per side
+        """
+        b = self.brick_size
+        brick = voxel // b
+        refined = dr.gather(mi.Bool, self.refined, mi.UInt32(brick.x + brick.y * self.brick_res.x + brick.z * self.brick_res.x * self.brick_res.y), active)
+        return dr.select(refined, voxel, brick * b), dr.select(refined, mi.Int32(1), mi.Int32(b))
+
+    def cells(self):
+        """
+        Integer coordinates of the first voxel of each cell, as a Point3f, and
+        the number of voxels per side of each cell
+        """
+        b = self.brick_size
+        idx = dr.arange(mi.UInt32, self.data.shape[0])
+        # Brick containing each cell: the last one starting before it
+        brick = dr.binary_search(0, dr.prod(self.brick_res) - 1, lambda i: dr.gather(mi.UInt32, self.offsets, i) <= idx)
+        brick[dr.gather(mi.UInt32, self.offsets, brick) > idx] -= 1
+        refined = dr.gather(mi.Bool, self.refined, brick)
+        local = idx - dr.gather(mi.UInt32, self.offsets, brick)
+        brick_res = self.brick_res
+        lo = mi.Point3f(brick % brick_res.x, (brick // brick_res.x) % brick_res.y, brick // (brick_res.x * brick_res.y)) * b
+        lo[refined] += mi.Point3f(local % b, (local // b) % b, local // (b * b))
+        return lo, dr.select(refined, 1., b)
+
+    def compact(self, tensor, reduction='mean'):
+        # Average or sum the voxels of each cell
+        channels = tensor.shape[-1]
+        res = self.res
+        voxel = dr.arange(mi.UInt32, dr.prod(res))
+        x, y, z = voxel % res.x, (voxel // res.x) % res.y, voxel // (res.x * res.y)
+        b = self.brick_size
+        brick = x // b + (y // b) * self.brick_res.x + (z // b) * self.brick_res.x * self.brick_res.y
+        refined = dr.gather(mi.Bool, self.refined, brick)
+        cell = dr.gather(mi.UInt32, self.offsets, brick) + dr.select(refined, x % b + (y % b) * b + (z % b) * b * b, 0)
+
+        out = dr.zeros(mi.Float, self.data.shape[0] * channels)
+        for c in range(channels):
+            values = dr.gather(mi.Float, tensor.array, voxel * channels + c)
+            dr.scatter_reduce(dr.ReduceOp.Add, out, values, cell * channels + c)
+        if reduction == 'mean':
+            _, size = self.cells()
+            out /= dr.repeat(size**3, channels)
+        return mi.TensorXf(out, shape=(self.data.shape[0], channels))
+
+    def expand(self, tensor):
+        # Repeat the values of coarse cells over their voxels
+        channels = tensor.shape[-1]
+        res = self.res
+        idx = dr.arange(mi.UInt32, dr.prod(res) * channels)
+        if channels != (2 if self.surface_aware else 1):
+            # Single channel tensor with a surface-aware film
+            cell = self.index(idx * 2)[0] // 2
+        else:
+            cell = self.index(idx)[0]
+        return mi.TensorXf(dr.gather(mi.Float, tensor.array, cell), shape=(res.z, res.y, res.x, channels))
+
+class MaskedFilm(VolumetricFilm):
+    """
+    Volumetric film that only stores the voxels of a mask, e.g. those that
+    overlap the printing medium. The data is stored compactly with shape
+    (voxels, channels), and voxel indices are mapped to it through an index
+    map. Writes to voxels outside of the mask are discarded.
+
+    All voxels are stored until 'set_mask' is called.
+    """
+    def __init__(self, props):
+        super().__init__(props)
+        self.set_mask(dr.ones(mi.Bool, dr.prod(self.res)))
+
+    def to_string(self):
+        return ('MaskedFilm[\n'
+                f'    resolution = {self.res},\n'
+                f'    voxels = {self.data.shape[0]},\n'
+                ']')
+
+    def set_mask(self, mask):
+        """
+        Set which voxels are stored in the film, and reallocate the data
+        accordingly
+        """
+        self.mask = mi.Bool(mask)
+        self.offsets = dr.prefix_sum(dr.select(self.mask, mi.UInt32(1), 0))
+        self.voxels = dr.compress(self.mask) + dr.opaque(mi.UInt32, 0) # Hack to get the result of compress to only use its actual size
+        dr.eval(self.mask, self.offsets, self.voxels)
+        self.data = dr.zeros(mi.TensorXf, (dr.width(self.voxels), 2 if self.surface_aware else 1))
+
+    def index(self, idx, active=True):
+        channels = 2 if self.surface_aware else 1
+        voxel = idx // channels
+        active = active & dr.gather(mi.Bool, self.mask, voxel, active)
+        return dr.gather(mi.UInt32, self.offsets, voxel, active) * channels + idx % channels, active
+
+    def cells(self):
+        """
+        Integer coordinates of the stored voxels, as a Point3f, and the number
+        of voxels per side of each cell
+        """
+        res = self.res
+        lo = mi.Point3f(self.voxels % res.x, (self.voxels // res.x) % res.y, self.voxels // (res.x * res.y))
+        return lo, dr.ones(mi.Float, dr.width(self.voxels))
+
+    def compact(self, tensor, reduction='mean'):
+        # Keep the voxels of the mask
+        channels = tensor.shape[-1]
+        idx = dr.arange(mi.UInt32, dr.width(self.voxels) * channels)
+        voxel = dr.gather(mi.UInt32, self.voxels, idx // channels)
+        return mi.TensorXf(dr.gather(mi.Float, tensor.array, voxel * channels + idx % channels), shape=(dr.width(self.voxels), channels))
+
+    def expand(self, tensor):
+        # Voxels outside of the mask are set to zero
+        channels = tensor.shape[-1]
+        res = self.res
+        idx = dr.arange(mi.UInt32, dr.prod(res) * channels)
+        voxel = idx // channels
+        valid = dr.gather(mi.Bool, self.mask, voxel)
+        values = dr.gather(mi.Float, tensor.array, dr.gather(mi.UInt32, self.offsets, voxel) * channels + idx % channels, valid)
+        return mi.TensorXf(values, shape=(res.z, res.y, res.x, channels))
 
 mi.register_film('vfilm', VolumetricFilm)
+mi.register_film('cfilm', CylindricalFilm)
+mi.register_film('sfilm', SparseFilm)
+mi.register_film('mfilm', MaskedFilm)
 
@@ -1,5 +1,7 @@
 import mitsuba as mi
 import drjit as dr
+import numpy as np
+from .utils import load_volume, volume_bbox
 
 class Container:
     """
@@ -15,6 +17,11 @@ class Container:
     Therefore, IOR and phase functions are stored in a list of known media, and the queried
     from a key in the input parameters.
 
+    The extinction is either a constant, or a voxel grid given as a dictionary
+    with the same fields as a voxel grid target ('filename', 'size',
+    'box_center_*'...), and an optional 'scale' applied to its values. The
+    extinction is zero outside of the grid.
+
     Also top and bottom occlusions can be added to the container. These are .ply files
     """
     def __init__(self, params):
@@ -24,6 +31,7 @@ class Container:
         self.medium_ior = medium['ior']
         self.sigma_t = medium['extinction']
         self.albedo = medium['albedo'] # Purely absorptive by default
+        self.extinction_grid = self.load_extinction(self.sigma_t)
         # add some occlusions
         self.occlusions = params.get('occlusions', [])
 
@@ -34,12 +42,38 @@ class Container:
         else:
             self.medium_phase = None
 
+    @staticmethod
+    def load_extinction(sigma_t):
+        """
+        Load a heterogeneous extinction, as a tuple of its (z, y, x, 1) values
+        and the (min, max) corners of its grid, or None for a constant one.
+        """
+        if not isinstance(sigma_t, dict):
+            return None
+        data = load_volume(sigma_t)
+        if data.shape[-1] != 1:
+            raise ValueError(f"The extinction grid must have a single channel, got shape {data.shape}.")
+        values = np.array(data, dtype=np.float32) * sigma_t.get('scale', 1.)
+        return (values, *volume_bbox(sigma_t, data.shape))
+
     def medium_dict(self):
-        medium_dict = {
-            'type': 'homogeneous',
-            'sigma_t': self.sigma_t,
-            'albedo': self.albedo,
+        if self.extinction_grid is not None:
+            values, bbox_min, bbox_max = self.extinction_grid
+            medium_dict = {
+                'type': 'heterogeneous',
+                'sigma_t': {
+                    'type': 'gridvolume',
+                    'grid': mi.VolumeGrid(values),
+                    'to_world': mi.ScalarTransform4f().translate(bbox_min.tolist()).scale((bbox_max - bbox_min).tolist()),
+                },
+                'albedo': self.albedo,
             }
+        else:
+            medium_dict = {
+                'type': 'homogeneous',
+                'sigma_t': self.sigma_t,
+                'albedo': self.albedo,
+                }
         if self.medium_phase is not None:
             medium_dict['phase'] = self.medium_phase
         return medium_dict
@@ -1,6 +1,7 @@
 from __future__ import annotations as __annotations__ # Delayed parsing of type annotations
 import mitsuba as mi
 import drjit as dr
+from drtvam.projector import TelecentricProjector, LensProjector
 
 class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
     def __init__(self, props):
@@ -15,12 +16,56 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
         # ID of the target shape, necessary when surface-aware discretization is enabled
         self.target_id = props.get('target_id', 'target')
 
+        # How to know whether samples are inside the target: 'mesh' tracks the
+        # crossings of the target surface along each ray, 'grid' looks up a
+        # precomputed occupancy grid, so the target does not need to be traced
+        self.inside_test = props.get('inside_test', 'mesh')
+        if self.inside_test not in ('mesh', 'grid'):
+            raise ValueError(f"[{self.__class__.__name__}] Invalid inside test: '{self.inside_test}'")
+
+        # OccupancyGrid of the target, to be set before rendering with inside_test='grid'
+        self.occupancy = None
+
+        # ExtinctionGrid of the printing medium, to be set before rendering
+        # with a heterogeneous medium
+        self.extinction = None
+
         # Always sample only the transmission component at interfaces
         self.transmission_only = props.get('transmission_only', True)
 
         # Shoot from the center of the pixels only
         self.regular_sampling = props.get('regular_sampling', False)
 
+        # How to distribute rays among active pixels: 'uniform' shoots 'spp' rays
+        # per pixel, 'intensity' distributes the same total ray budget
+        # proportionally to the pixel values
+        self.pixel_sampling = props.get('pixel_sampling', 'uniform')
+        if self.pixel_sampling not in ('uniform', 'intensity'):
+            raise ValueError(f"[{self.__class__.__name__}] Invalid pixel sampling mode: '{self.pixel_sampling}'")
+
+        # Fraction of the ray budget that is still distributed uniformly with
+        # intensity sampling, so that dark pixels keep receiving gradients
+        self.uniform_fraction = props.get('uniform_fraction', 0.1)
+
+        # Trace the projector rays through the interfaces in front of the
+        # medium only once, and reuse their state at the medium entry in
+        # subsequent renderings, as long as the active pixels do not change.
+        # The same ray samples are then used in every rendering, whatever the
+        # seed, so caching is restricted to configurations where the rays
+        # traced to the medium do not depend on random samples: positions at
+        # the pixel centers, discrete time steps and transmission only at the
+        # interfaces. Projectors with an aperture are rejected when rendering.
+        self.cache_rays = props.get('cache_rays', False)
+        if self.cache_rays and self.pixel_sampling != 'uniform':
+            raise ValueError(f"[{self.__class__.__name__}] Ray caching is only supported with uniform pixel sampling.")
+        if self.cache_rays and not self.regular_sampling:
+            raise ValueError(f"[{self.__class__.__name__}] Ray caching reuses the same ray samples for every seed, it is only supported with regular sampling.")
+        if self.cache_rays and self.sample_time:
+            raise ValueError(f"[{self.__class__.__name__}] Ray caching reuses the same ray samples for every seed, it is not supported with time sampling.")
+        if self.cache_rays and not self.transmission_only:
+            raise ValueError(f"[{self.__class__.__name__}] Ray caching reuses the same ray samples for every seed, it is only supported with transmission_only.")
+        self.ray_cache = None
+
     def parse_scene(self, scene: mi.Scene):
         target_shape = None
         medium = None
@@ -36,6 +81,12 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
         if medium is None:
             raise ValueError("No printing medium found in the scene")
 
+        if dr.hint(self.inside_test == 'grid', mode='scalar'):
+            if self.occupancy is None:
+                raise ValueError(f"[{self.__class__.__name__}] An occupancy grid must be set to use inside_test='grid'.")
+            # The target surface is not tracked, even if it is part of the scene
+            target_shape = None
+
         return medium, target_shape
 
     def prepare(self,
@@ -52,6 +103,9 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
 
         if spp != 0:
             sampler.set_sample_count(spp)
+            if sampler.sample_count() != spp:
+                # e.g. stratified samplers require a square number of samples
+                mi.Log(mi.LogLevel.Warn, f"[{self.__class__.__name__}] The projector sampler adjusted the sample count from {spp} to {sampler.sample_count()}.")
         spp = sampler.sample_count()
 
         sampler.set_samples_per_wavefront(spp)
@@ -67,6 +121,42 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
         sampler.seed(seed, wavefront_size)
         return sampler, spp
 
+    def active_index(self, emitter: TVAMProjector, spp: int) -> mi.UInt32:
+        """
+        Index of the active pixel that each sample of the wavefront originates
+        from, with uniform pixel sampling. It is a function of the sample index
+        only, so gathers using it are computed in the kernels that consume them.
+        """
+        return dr.arange(mi.UInt32, emitter.active_size() * spp) // spp
+
+    def sample_pixels(self,
+                      emitter: TVAMProjector,
+                      sampler: mi.Sampler) -> Tuple[mi.UInt32, mi.Float]:
+        """
+        Sample one active pixel per ray, with probability proportional to its
+        intensity (mixed with a uniform distribution). Returns the pixel
+        indices and their values, re-weighted so that the estimate matches the
+        one of uniform sampling with the same number of rays.
+        """
+        n_active = emitter.active_size()
+        with dr.suspend_grad():
+            intensity = dr.abs(dr.detach(emitter.active_data))
+            total = dr.sum(intensity)
+            pmf = dr.select(total > 0, (1 - self.uniform_fraction) * intensity / total, 0.)
+            pmf += dr.select(total > 0, self.uniform_fraction, 1.) / n_active
+            cdf = dr.cumsum(pmf)
+            dr.eval(cdf)
+
+            # Invert the CDF
+            u = sampler.next_1d() * dr.gather(mi.Float, cdf, n_active - 1)
+            active_idx = dr.binary_search(0, n_active - 1, lambda i: dr.gather(mi.Float, cdf, i) < u)
+            pmf_idx = dr.gather(mi.Float, pmf, active_idx)
+
+        idx = dr.gather(mi.UInt32, emitter.active_pixels, active_idx)
+        # Uniform sampling has a pmf of 1/n_active, compensate for the difference
+        L = dr.gather(mi.Float, emitter.active_data, active_idx) * dr.rcp(pmf_idx * n_active)
+        return idx, L
+
     def sample_rays(
         self,
         scene: mi.Scene,
@@ -78,8 +168,14 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
         spp = sampler.sample_count()
 
         # Compute discrete sample position
-        idx = dr.repeat(emitter.active_pixels, spp)
-        L = dr.repeat(emitter.active_data, spp)
+        if self.pixel_sampling == 'intensity':
+            idx, L = self.sample_pixels(emitter, sampler)
+        else:
+            # Derive the pixel index and intensity from the sample index instead
+            # of materializing wavefront-sized arrays
+            active_idx = self.active_index(emitter, spp)
+            idx = dr.gather(mi.UInt32, emitter.active_pixels, active_idx)
+            L = dr.gather(mi.Float, emitter.active_data, active_idx)
         emitter_idx = idx // (h * w)
         pixel_idx = idx % (h * w)
 
@@ -115,3 +211,88 @@ class TVAMIntegrator(mi.ad.integrators.common.ADIntegrator):
 
         return ray, L, weight
 
+    def medium_rays(self,
+                    scene: mi.Scene,
+                    emitter: TVAMProjector,
+                    sampler: mi.Sampler,
+                    spp: int) -> Tuple[mi.Ray3f, mi.Spectrum, mi.Float, Optional[mi.Bool], mi.UInt32]:
+        """
+        Sample the projector rays to start light paths from. With ray caching,
+        the rays are returned at their entry in the medium, along with a mask
+        of the rays that entered it and the number of interfaces they crossed.
+        Otherwise, the rays start on the projector and the mask is None.
+        """
+        if not self.cache_rays:
+            ray, L, weight = self.sample_rays(scene, emitter, sampler)
+            return ray, L, weight, None, mi.UInt32(0)
+
+        if isinstance(emitter, (TelecentricProjector, LensProjector)):
+            raise ValueError(f"[{self.__class__.__name__}] Ray caching reuses the same ray samples for every seed, it is not supported with projectors sampling an aperture.")
+
+        # Only the pattern values change between renderings
+        L = dr.gather(mi.Float, emitter.active_data, self.active_index(emitter, spp))
+
+        cache = self.ray_cache
+        if cache is None or cache['spp'] != spp or dr.width(cache['pixels']) != emitter.active_size() or \
+           not dr.all(cache['pixels'] == emitter.active_pixels):
+            with dr.suspend_grad():
+                ray, _, weight = self.sample_rays(scene, emitter, sampler)
+                ray, weight, in_medium, depth = self.trace_to_medium(scene, sampler, ray, weight)
+                cache = {
+                    'spp': spp,
+                    'pixels': mi.UInt32(emitter.active_pixels),
+                    'ray': ray,
+                    'weight': weight,
+                    'in_medium': in_medium,
+                    'depth': depth,
+                }
+                dr.eval(cache)
+            self.ray_cache = cache
+
+        return cache['ray'], L, cache['weight'], cache['in_medium'], cache['depth']
+
+    @dr.syntax
+    def trace_to_medium(self,
+                        scene: mi.Scene,
+                        sampler: mi.Sampler,
+                        ray: mi.Ray3f,
+                        weight: mi.Spectrum) -> Tuple[mi.Ray3f, mi.Spectrum, mi.Bool, mi.UInt32]:
+        """
+        Trace rays through the interfaces in front of the printing medium,
+        until they enter it. Returns the rays at the medium entry, their
+        weights including the interface transmittances, whether they entered
+        the medium, and the number of interfaces they crossed.
+        """
+        weight = mi.Spectrum(weight)
+        active = mi.Bool(True)
+        in_medium = mi.Bool(False)
+        depth = mi.UInt32(0)
+
+        while active:
+            si = scene.ray_intersect(ray, active=active)
+            active &= si.is_valid()
+
+            bsdf = si.bsdf(ray)
+            ctx = mi.BSDFContext()
+            s1 = sampler.next_1d(active)
+            s2 = sampler.next_2d(active)
+
+            if dr.hint(self.transmission_only, mode='scalar'):
+                ctx.type_mask = mi.BSDFFlags.Transmission
+                bs, bs_w = bsdf.sample(ctx, si, s1, s2, active)
+            else:
+                # If this is the first intersection, we only sample a refraction to avoid having useless rays
+                force_tr = active & (depth == 0)
+                bs, bs_w = bsdf.sample(ctx, si, s1, s2, active & ~force_tr)
+                ctx.type_mask = mi.BSDFFlags.Transmission
+                bs[force_tr], bs_w[force_tr] = bsdf.sample(ctx, si, s1, s2, force_tr)
+
+            weight[active] *= bs_w
+            ray[active] = si.spawn_ray(si.to_world(bs.wo))
+
+            in_medium |= active & si.is_medium_transition() & (si.target_medium(ray.d) != None)
+            depth[active] += 1
+            active &= ~in_medium & dr.any(weight != 0) & (depth < self.max_depth)
+
+        return ray, weight, in_medium, depth
+
@@ -27,6 +27,9 @@ class CornerIntegrator(TVAMIntegrator):
         if len(scene.emitters()) > 1:
             raise Exception("The scene contains more than one projector. Only one is supported")
 
+        if self.pixel_sampling != 'uniform':
+            raise ValueError(f"[{self.__class__.__name__}] Only uniform pixel sampling is supported.")
+
         projector = scene.emitters()[0]
 
         with dr.suspend_grad():
@@ -42,9 +45,10 @@ class CornerIntegrator(TVAMIntegrator):
                 active=mi.Bool(True)
             ) * weight
 
+            # Sum the contributions of the samples of each pixel first, as
+            # they are contiguous in the wavefront
             imgs = dr.zeros(mi.TensorXf, projector.size())
-            idx = dr.repeat(projector.active_pixels, spp)
-            dr.scatter_reduce(dr.ReduceOp.Add, imgs.array, L, idx)
+            dr.scatter_reduce(dr.ReduceOp.Add, imgs.array, dr.block_sum(L, spp), projector.active_pixels)
 
         return imgs
 
@@ -23,6 +23,9 @@ class RadonIntegrator(TVAMIntegrator):
         if len(scene.emitters()) > 1:
             raise Exception("The scene contains more than one projector. Only one is supported")
 
+        if self.pixel_sampling != 'uniform':
+            raise ValueError(f"[{self.__class__.__name__}] Only uniform pixel sampling is supported.")
+
         projector = scene.emitters()[0]
 
         with dr.suspend_grad():
@@ -38,9 +41,10 @@ class RadonIntegrator(TVAMIntegrator):
                 active=mi.Bool(True)
             ) * weight
 
+            # Sum the contributions of the samples of each pixel first, as
+            # they are contiguous in the wavefront
             imgs = dr.zeros(mi.TensorXf, projector.size())
-            idx = dr.repeat(projector.active_pixels, spp)
-            dr.scatter_reduce(dr.ReduceOp.Add, imgs.array, L, idx)
+            dr.scatter_reduce(dr.ReduceOp.Add, imgs.array, dr.block_sum(L, spp), projector.active_pixels)
 
         return imgs
 
@@ -54,9 +58,14 @@ class RadonIntegrator(TVAMIntegrator):
                active: mi.Bool) -> Tuple[mi.Spectrum, mi.Bool, List[mi.Float]]:
 
         medium, target_shape = self.parse_scene(scene)
-        if target_shape is None:
+        if target_shape is None and self.inside_test == 'mesh':
             raise ValueError("No target shape found in the scene")
-        sigma_s, _, sigma_t = medium.get_scattering_coefficients(mi.MediumInteraction3f())
+        if dr.hint(self.extinction is not None, mode='scalar'):
+            # Only the support of the transform matters, so a heterogeneous
+            # medium is replaced by a homogeneous one at its largest extinction
+            sigma_t = mi.Spectrum(dr.max(self.extinction.majorants.data))
+        else:
+            sigma_s, _, sigma_t = medium.get_scattering_coefficients(mi.MediumInteraction3f())
 
         active = mi.Bool(True)
         active_medium = mi.Bool(False)
@@ -74,7 +83,10 @@ class RadonIntegrator(TVAMIntegrator):
             # Here we make the assumption that the medium is purely absorptive
             contrib = throughput * dr.exp(-sigma_t*t) * (1 - dr.exp(-sigma_t * si.t))
             hit_target = active & (si.shape == target_shape)
-            L[inside_target & active_medium] += contrib
+            if dr.hint(self.inside_test == 'grid', mode='scalar'):
+                L[active & active_medium] += throughput * dr.exp(-sigma_t*t) * self.occupancy.absorption(ray, si.t, sigma_t, active & active_medium)
+            else:
+                L[inside_target & active_medium] += contrib
             t[active] += si.t
 
             inside_target = (~inside_target & hit_target) | (inside_target & ~hit_target) # /!\ This may cause some rays to leak out
@@ -1,7 +1,7 @@
 from __future__ import annotations as __annotations__ # Delayed parsing of type annotations
 import mitsuba as mi
 import drjit as dr
-from drtvam.sensor import DeltaVolumetricSensor
+from drtvam.sensor import DeltaVolumetricSensor, HybridVolumetricSensor
 from .common import TVAMIntegrator
 
 class VolumeIntegrator(TVAMIntegrator):
@@ -36,7 +36,7 @@ class VolumeIntegrator(TVAMIntegrator):
 
         with dr.suspend_grad():
             sampler, spp = self.prepare(projector, seed, spp)
-            ray, Le, weight = self.sample_rays(scene, projector, sampler)
+            ray, Le, weight, in_medium, depth = self.medium_rays(scene, projector, sampler, spp)
 
             volume = sensor.compute_volume(scene)
             inv_vol = dr.select(volume != 0., dr.rcp(volume), 0.)
@@ -48,9 +48,10 @@ class VolumeIntegrator(TVAMIntegrator):
                 ray=ray,
                 Le=Le * weight,
                 sensor=sensor,
-                depth=mi.UInt32(0),
+                depth=depth,
                 δL=None,
-                active=mi.Bool(True)
+                active=mi.Bool(True),
+                active_medium=in_medium
             ) * inv_vol
 
         return L
@@ -75,7 +76,7 @@ class VolumeIntegrator(TVAMIntegrator):
 
         with dr.suspend_grad():
             sampler, spp = self.prepare(projector, seed, spp)
-            ray, Le, weight = self.sample_rays(scene, projector, sampler)
+            ray, Le, weight, in_medium, depth = self.medium_rays(scene, projector, sampler, spp)
 
             volume = sensor.compute_volume(scene)
             inv_vol = dr.select(volume != 0., dr.rcp(volume), 0.)
@@ -87,9 +88,10 @@ class VolumeIntegrator(TVAMIntegrator):
                 ray=ray,
                 Le=Le * weight,
                 sensor=sensor,
-                depth=mi.UInt32(0),
+                depth=depth,
                 δL=None,
-                active=mi.Bool(True)
+                active=mi.Bool(True),
+                active_medium=in_medium
             ) * inv_vol
 
         return δL
@@ -114,7 +116,7 @@ class VolumeIntegrator(TVAMIntegrator):
         projector = scene.emitters()[0]
 
         sampler, spp = self.prepare(projector, seed, spp)
-        ray, Le, weight = self.sample_rays(scene, projector, sampler)
+        ray, Le, weight, in_medium, depth = self.medium_rays(scene, projector, sampler, spp)
 
         volume = sensor.compute_volume(scene)
         inv_vol = dr.select(volume != 0., dr.rcp(volume), 0.)
@@ -126,9 +128,10 @@ class VolumeIntegrator(TVAMIntegrator):
             ray=ray,
             Le=Le * weight,
             sensor=sensor,
-            depth=mi.UInt32(0),
+            depth=depth,
             δL=grad_in * inv_vol,
-            active=mi.Bool(True)
+            active=mi.Bool(True),
+            active_medium=in_medium
         )
 
         del L
@@ -143,7 +146,8 @@ class VolumeIntegrator(TVAMIntegrator):
                sensor: mi.Sensor,
                depth: mi.UInt32,
                δL: Optional[mi.Spectrum],
-               active: mi.Bool) -> Tuple[mi.Spectrum, mi.Bool, List[mi.Float]]:
+               active: mi.Bool,
+               active_medium: Optional[mi.Bool] = None) -> Tuple[mi.Spectrum, mi.Bool, List[mi.Float]]:
 
         medium, target_shape = self.parse_scene(scene)
 
@@ -151,16 +155,25 @@ class VolumeIntegrator(TVAMIntegrator):
         is_backward = mode == dr.ADMode.Backward
         is_forward = mode == dr.ADMode.Forward
 
-        sigma_s, _, sigma_t = medium.get_scattering_coefficients(mi.MediumInteraction3f())
-        has_scattering = dr.any(dr.any(sigma_s != 0)) # Delta tracking must assume there is scattering to work
+        extinction = self.extinction
+        if dr.hint(extinction is not None, mode='scalar'):
+            # Heterogeneous medium, whose coefficients are not differentiated
+            sigma_s = mi.Spectrum(0.)
+            sigma_t = mi.Spectrum(0.)
+            has_scattering = extinction.albedo > 0
+        else:
+            sigma_s, _, sigma_t = medium.get_scattering_coefficients(mi.MediumInteraction3f())
+            has_scattering = dr.any(dr.any(sigma_s != 0)) # Delta tracking must assume there is scattering to work
         if not has_scattering and isinstance(sensor, DeltaVolumetricSensor):
             raise ValueError("Tried to render a purely absorptive volume with a delta tracking sensor. This is not supported.")
+        if not has_scattering and isinstance(sensor, HybridVolumetricSensor):
+            raise ValueError("Tried to render a purely absorptive volume with a hybrid sensor. It relies on sampled free-flight distances, please use the DDA sensor instead.")
 
         if is_forward and dr.grad_enabled(Le):
             dr.forward_to(Le)
 
         attenuation = mi.Spectrum(1.)
-        δL = mi.TensorXf(δL) if δL is not None else dr.zeros(mi.TensorXf, sensor.film().resolution())
+        δL = mi.TensorXf(δL) if δL is not None else dr.zeros(mi.TensorXf, sensor.film().data.shape)
         em_grad = dr.zeros(mi.Float, dr.width(Le))
         ss_grad = mi.Spectrum(0.)
         st_grad = mi.Spectrum(0.)
@@ -172,9 +185,15 @@ class VolumeIntegrator(TVAMIntegrator):
         # Inside/outside of the target mesh status, assuming all rays start from outside
         inside_target = mi.Bool(False)
 
-        active = mi.Bool(True)
-        depth = mi.UInt32(0)
-        active_medium = mi.Bool(False)
+        # Rays may start inside the medium when they were traced through the
+        # interfaces beforehand, other rays can then be discarded
+        if dr.hint(active_medium is None, mode='scalar'):
+            active = mi.Bool(active)
+            active_medium = mi.Bool(False)
+        else:
+            active = mi.Bool(active & active_medium)
+            active_medium = mi.Bool(active_medium)
+        depth = mi.UInt32(depth)
 
         while dr.hint(active, label=f"Backprojection ({mode.name})", exclude=[Le]):
 
@@ -196,7 +215,13 @@ class VolumeIntegrator(TVAMIntegrator):
             hit_target = active & (si.shape == target_shape)
 
             weight = mi.Spectrum(1.)
-            if dr.hint(has_scattering, mode='scalar'):
+            if dr.hint(has_scattering and extinction is not None, mode='scalar'):
+                # Delta tracking through the majorant grid, the transmittance
+                # cancels out with the pdf of real collisions
+                mei = extinction.sample_interaction(ray, si.t, sampler, active_medium)
+                reached_surface = active_medium & ~mei.is_valid()
+                weight[active_medium & ~reached_surface] *= dr.rcp(mei.sigma_t)
+            elif dr.hint(has_scattering, mode='scalar'):
                 mei = medium.sample_interaction(ray, sampler.next_1d(), 0, active_medium)
                 reached_surface = active_medium & si.is_valid() & (si.t < mei.t)
                 mei.t[reached_surface] = dr.inf
@@ -206,6 +231,10 @@ class VolumeIntegrator(TVAMIntegrator):
 
                 inv_pdf = dr.select(tr_pdf > 0.0, dr.detach(dr.rcp(tr_pdf)), 0.0)
                 weight[active_medium] *= tr * inv_pdf
+            elif dr.hint(extinction is not None, mode='scalar'):
+                reached_surface = mi.Bool(active_medium)
+                mei = dr.zeros(mi.MediumInteraction3f)
+                mei.t = dr.inf
             else:
                 reached_surface = mi.Bool(active_medium)
                 mei = mi.MediumInteraction3f()
@@ -213,7 +242,7 @@ class VolumeIntegrator(TVAMIntegrator):
 
             active_medium &= ~reached_surface
 
-            g_em, g_ss, g_st = sensor.accumulate(ray, Le, inside_target, attenuation, total_t, n_scat, si.t, mei, sampler, active=active_medium | reached_surface, δL=δL, mode=mode)
+            g_em, g_ss, g_st = sensor.accumulate(ray, Le, inside_target, attenuation, total_t, n_scat, si.t, mei, sampler, active=active_medium | reached_surface, δL=δL, mode=mode, occupancy=self.occupancy if self.inside_test == 'grid' else None, extinction=extinction)
 
             # Flip inside/outside flag if the target was hit
             inside_target = (~inside_target & hit_target) | (inside_target & ~hit_target) # /!\ This may cause some rays to leak out
@@ -259,6 +288,8 @@ class VolumeIntegrator(TVAMIntegrator):
                     weight[active_medium] *= phase_w
                     ray[active_medium] = mei.spawn_ray(wo)
                 n_scat[active_medium] += 1
+            elif dr.hint(extinction is not None, mode='scalar'):
+                weight[active & reached_surface] *= extinction.transmittance(ray, 0., si.t, sampler, active & reached_surface)
             else:
                 weight[active & reached_surface] *= dr.exp(-mei.sigma_t * si.t)
 
@@ -166,6 +166,8 @@ class LinearLBFGS(mi.ad.Optimizer):
         self.loss_fn = loss_fn
         # How many iterations of backtracking line search to run
         self.search_it = search_it
+        # Dose predicted for the updated variables by the last line search
+        self.vol = None
 
     def reset(self, k):
         self.s[k] = []
@@ -195,6 +197,84 @@ class LinearLBFGS(mi.ad.Optimizer):
         self.g_old[k] = g_p
         self.t[k] += 1
 
+    def remap(self, k, value, idx, valid):
+        """
+        Replace the flat variable 'k' with 'value' of a different size, where
+        entry i of 'value' corresponds to entry idx[i] of the previous variable
+        if valid[i] is set. The history is remapped accordingly, so that it
+        stays consistent with the new variable. New entries start with zero
+        state and gradient differences.
+        """
+        def gather(v):
+            return dr.gather(mi.Float, v, idx, valid)
+
+        t = self.t.get(k, 0)
+        s = [gather(v) for v in self.s.get(k, [])]
+        y = [gather(v) for v in self.y.get(k, [])]
+        p_old = gather(self.p_old[k]) if k in self.p_old else None
+        g_old = gather(self.g_old[k]) if k in self.g_old else None
+
+        self[k] = value
+        self.reset(k)
+        self.s[k] = s
+        self.y[k] = y
+        self.ys[k] = [dr.dot(y_i, s_i) for y_i, s_i in zip(y, s)]
+        self.t[k] = t
+        if p_old is not None:
+            self.p_old[k] = p_old
+            self.g_old[k] = g_old
+            dr.schedule(p_old, g_old)
+        dr.schedule(s, y, self.ys[k])
+
+    def line_search(self, vol, dvol, loss, g_dot_z, patterns, dpatterns):
+        """
+        Backtracking line search on the linearized dose vol + alpha * dvol and
+        patterns + alpha * dpatterns, returning the first of the step sizes
+        1, 1/2, 1/4, ... that satisfies the Armijo condition.
+        """
+        c1 = 1e-4
+        for i in range(self.search_it):
+            # Opaque step size, so that all step sizes share the same kernels
+            alpha = dr.opaque(mi.Float, 0.5 ** i)
+            # Only the loss value is needed, so no AD graph is recorded
+            with dr.suspend_grad():
+                mi.Log(mi.LogLevel.Debug, "[drtvam] Calling loss from LBFGS")
+                f_new = self.loss_fn(vol + alpha * dvol, patterns + alpha * dpatterns)
+
+            armijo = (f_new <= loss + c1 * alpha * g_dot_z)
+            if dr.all(armijo):
+                return alpha
+
+        # No step size was accepted
+        return dr.opaque(mi.Float, 0.5 ** self.search_it)
+
+    def search_direction(self, k, q):
+        """
+        Two-loop recursion: apply the inverse Hessian approximation stored in
+        the history of variable 'k' to the vector 'q'.
+        """
+        hist_size = len(self.s[k])
+        dr.make_opaque(hist_size)
+        s = self.s[k]
+        y = self.y[k]
+        ys = self.ys[k]
+        alphas = []
+        for i in range(hist_size-1, -1, -1):
+            rho = dr.rcp(ys[i])
+            a = rho * dr.dot(s[i], q)
+            q = q - a * y[i]
+            alphas.insert(0, a)
+
+        gamma = 1 if hist_size == 0 else ys[-1] / dr.dot(y[-1], y[-1])
+
+        z = gamma * q
+        for i in range(hist_size):
+            rho = dr.rcp(ys[i])
+            b = rho * dr.dot(y[i], z)
+            z = z + (alphas[i] - b) * s[i]
+
+        return z
+
     def step(self, vol, loss):
         search_dirs = {}
         # TODO: unravel arrays for dot products
@@ -210,32 +290,9 @@ class LinearLBFGS(mi.ad.Optimizer):
             self.update_history(k)
 
             # Find search direction
-            q = dr.ravel(p.grad)
-            hist_size = len(self.s[k])
-            dr.make_opaque(hist_size)
-            s = self.s[k]
-            y = self.y[k]
-            ys = self.ys[k]
-            alphas = []
-            for i in range(hist_size-1, -1, -1):
-                rho = dr.rcp(ys[i])
-                a = rho * dr.dot(s[i], q)
-                q = q - a * y[i]
-                alphas.insert(0, a)
-
-            gamma = 1 if self.t[k] == 1 else ys[-1] / dr.dot(y[-1], y[-1])
-
-            z = gamma * q
-            for i in range(hist_size):
-                rho = dr.rcp(ys[i])
-                b = rho * dr.dot(y[i], z)
-                z = z + (alphas[i] - b) * s[i]
-
-            search_dirs[k] = -z
+            search_dirs[k] = -self.search_direction(k, dr.ravel(p.grad))
 
         # Backtracking line search until Armijo conditions are satisfied
-        alpha = dr.opaque(mi.Float, 1.) # TODO: expose initial step size as param
-        c1 = 1e-4
         params = {}
         for k, p in self.variables.items():
             if type(p) == mi.TensorXf:
@@ -253,17 +310,13 @@ class LinearLBFGS(mi.ad.Optimizer):
         for k, p in params.items():
             g_dot_z += dr.dot(self.g_old[k], search_dirs[k])
 
-        for _ in range(self.search_it):
+        alpha = self.line_search(vol, dvol, loss, g_dot_z,
+                                 dr.detach(self.variables['projector.active_data']),
+                                 params['projector.active_data'])
 
-            vol_new = vol + alpha * dvol
-            mi.Log(mi.LogLevel.Debug, "[drtvam] Calling loss from LBFGS")
-            f_new = self.loss_fn(vol_new, params['projector.active_data'])
-
-            armijo = (f_new <= loss + c1 * alpha * g_dot_z)
-            if dr.all(armijo):
-                break
-
-            alpha *= 0.5
+        # By linearity, this is the dose for the updated variables
+        self.vol = dr.detach(vol + alpha * dvol)
+        dr.schedule(self.vol)
 
         for k, p in self.variables.items():
             if type(p) == mi.TensorXf:
@@ -273,3 +326,145 @@ class LinearLBFGS(mi.ad.Optimizer):
             # self.variables[k] = type(p)(dr.detach(p + alpha * dr.unravel(type(p), search_dirs[k])))
             dr.enable_grad(self.variables[k])
             dr.schedule(self.variables[k])
+
+class LinearLBFGSB(LinearLBFGS):
+    """
+    Bound-constrained variant of LinearLBFGS (projected L-BFGS).
+
+    Instead of clamping the variables after each step, which invalidates the
+    stored curvature pairs, the iterates are kept feasible throughout:
+    variables sitting at the lower bound with a gradient pushing them further
+    down form the active set and are frozen, the quasi-Newton direction is
+    computed on the remaining free variables, and the line search is performed
+    along the projected direction P(x + d) - x. Since the box is convex, every
+    point x + alpha * (P(x + d) - x) with alpha in [0, 1] is feasible, so the
+    forward model only needs to be evaluated once for the search direction,
+    as in LinearLBFGS.
+    """
+    def __init__(self, lr=1.0, m=5, params=None, render_fn=None, loss_fn=None, search_it=20, lower_bound=0., eps=1e-10):
+        super().__init__(lr, m, params, render_fn, loss_fn, search_it)
+        # Lower bound on the variables
+        self.lower_bound = lower_bound
+        # Minimum curvature y^T s for a pair to be used by the two-loop recursion
+        self.eps = eps
+
+    def update_history(self, k):
+        p = dr.ravel(dr.detach(self.variables[k]))
+        g_p = dr.ravel(self.variables[k].grad)
+        dr.schedule(p, g_p)
+        # Update history. Pairs with insufficient curvature are kept, but
+        # skipped by the two-loop recursion, so that their rejection does not
+        # require a host synchronization.
+        if self.t[k] > 0:
+            self.s[k].append(p - self.p_old[k])
+            self.y[k].append(g_p - self.g_old[k])
+            dr.schedule(self.s[k][-1], self.y[k][-1])
+            self.ys[k].append(dr.dot(self.y[k][-1], self.s[k][-1]))
+
+            # Discard too old entries
+            if len(self.s[k]) > self.m:
+                self.s[k].pop(0)
+                self.y[k].pop(0)
+                self.ys[k].pop(0)
+
+        # Update previous state and gradient
+        self.p_old[k] = p
+        self.g_old[k] = g_p
+        self.t[k] += 1
+
+    def search_direction(self, k, q, free=True):
+        """
+        Two-loop recursion restricted to the free variables: the pairs stored
+        in the history of variable 'k' are projected onto the free subspace,
+        and pairs whose curvature there is below 'eps' are skipped, so that
+        the Hessian approximation stays positive definite.
+        """
+        s = [dr.select(free, s_i, 0.) for s_i in self.s[k]]
+        y = [dr.select(free, y_i, 0.) for y_i in self.y[k]]
+        ys = [dr.dot(y_i, s_i) for y_i, s_i in zip(y, s)]
+        rho = [dr.select(ys_i > self.eps, dr.rcp(ys_i), 0.) for ys_i in ys]
+        q = dr.select(free, q, 0.)
+
+        alphas = []
+        for i in range(len(s)-1, -1, -1):
+            a = rho[i] * dr.dot(s[i], q)
+            q = q - a * y[i]
+            alphas.insert(0, a)
+
+        # Initial scaling from the most recent pair that is not skipped
+        gamma = mi.Float(1.)
+        for i in range(len(s)):
+            gamma = dr.select(rho[i] > 0, ys[i] / dr.dot(y[i], y[i]), gamma)
+
+        z = gamma * q
+        for i in range(len(s)):
+            b = rho[i] * dr.dot(y[i], z)
+            z = z + (alphas[i] - b) * s[i]
+
+        return z
+
+    def projected_direction(self, k, x, g):
+        """
+        Compute the feasible search direction P(x + d) - x for variable 'k',
+        where d is the L-BFGS direction restricted to the free variables.
+        """
+        # Variables at the bound whose gradient points outside of the feasible
+        # set are kept fixed for this iteration
+        free = (x > self.lower_bound) | (g < 0)
+        z = dr.select(free, self.search_direction(k, g, free), 0.)
+        return dr.maximum(x - z, self.lower_bound) - x
+
+    def step(self, vol, loss):
+        search_dirs = {}
+
+        # Compute projected search directions
+        g_dot_z = mi.Float(0.)
+        for k, p in self.variables.items():
+            if k not in self.s:
+                self.reset(k)
+
+            # Update history
+            self.update_history(k)
+
+            search_dirs[k] = self.projected_direction(k, self.p_old[k], self.g_old[k])
+            g_dot_z += dr.dot(self.g_old[k], search_dirs[k])
+
+        # If the quasi-Newton model does not yield a descent direction, drop
+        # the history and fall back to projected gradient descent
+        if dr.all(g_dot_z >= 0):
+            g_dot_z = mi.Float(0.)
+            for k, p in self.variables.items():
+                t = self.t[k]
+                self.reset(k)
+                self.t[k] = t
+                search_dirs[k] = self.projected_direction(k, self.p_old[k], self.g_old[k])
+                g_dot_z += dr.dot(self.g_old[k], search_dirs[k])
+
+        # Backtracking line search along the projected direction until Armijo
+        # conditions are satisfied
+        params = {}
+        for k, p in self.variables.items():
+            if type(p) == mi.TensorXf:
+                params[k] = dr.detach(type(p)(search_dirs[k], shape=p.shape))
+            else:
+                params[k] = dr.detach(dr.unravel(type(p), search_dirs[k]))
+            dr.schedule(params[k])
+
+        dvol = self.render_fn(params)
+        dr.eval(dvol)
+
+        alpha = self.line_search(vol, dvol, loss, g_dot_z,
+                                 dr.detach(self.variables['projector.active_data']),
+                                 params['projector.active_data'])
+
+        self.vol = dr.detach(vol + alpha * dvol)
+        dr.schedule(self.vol)
+
+        for k, p in self.variables.items():
+            # The maximum only guards against rounding errors, the step is feasible
+            if type(p) == mi.TensorXf:
+                self.variables[k] = dr.detach(dr.maximum(p + alpha * type(p)(search_dirs[k], shape=p.shape), self.lower_bound))
+            else:
+                self.variables[k] = dr.detach(dr.maximum(p + alpha * dr.unravel(type(p), search_dirs[k]), self.lower_bound))
+            dr.enable_grad(self.variables[k])
+            dr.schedule(self.variables[k])
@@ -5,6 +5,10 @@ import mitsuba as mi
 def relu(x):
     return dr.select(x > 0, x, 0)
 
+def relu_grad(x, K):
+    """Derivative of relu(x)^K with respect to x"""
+    return dr.select(x > 0, K * x**(K - 1), 0)
+
 
 class Loss:
     def __init__(self, props):
@@ -15,6 +19,11 @@ class Loss:
             self.reduction = dr.mean
         else:
             raise ValueError(f"Invalid reduction method: '{reduction}'.")
+        self.reduction_type = reduction
+
+        # Cached weights of the surface-aware target
+        self.target = None
+        self.target_weights = None
 
     def eval_in(self, x):
         raise NotImplementedError
@@ -25,7 +34,16 @@ class Loss:
     def eval(self, x, target, patterns):
         raise NotImplementedError
 
-    def __call__(self, x, target, patterns):
+    def grad_in(self, x):
+        raise NotImplementedError
+
+    def grad_out(self, x):
+        raise NotImplementedError
+
+    def grad(self, x, target, patterns):
+        raise NotImplementedError
+
+    def check_target(self, x, target):
         if x.shape != target.shape:
             if len(x.shape) == len(target.shape) + 1 and x.shape[-1] == 1:
                 # we expect the last dimension to have 1 or 2 channels
@@ -34,21 +52,38 @@ class Loss:
                 raise ValueError(f"Input and target shapes do not match: \
                                  {x.shape} != {target.shape}")
 
+        if target.shape[-1] not in (1, 2):
+            raise ValueError(f"[Loss] Received tensors of invalid shape: \
+                             {target.shape}. The last dimension should be\
+                             either 1 or 2.")
+        return target
+
+    def weights(self, target):
+        """
+        Return the normalized inside/outside weights of a surface-aware target,
+        with the same layout as the target. They are computed once and reused
+        as long as the same target is passed.
+        """
+        if self.target is not target:
+            total = target[..., 0] + target[..., 1]
+            self.target_weights = mi.TensorXf(target.array / dr.repeat(total.array, 2), target.shape)
+            dr.eval(self.target_weights)
+            self.target = target
+        return self.target_weights
+
+    def __call__(self, x, target, patterns):
+        target = self.check_target(x, target)
+
         if target.shape[-1] == 1:  # binary or grayscale target
             loss, loss_patterns = self.eval(x, target, patterns)
-        elif target.shape[-1] == 2:  # Surface-aware discretization
+        else:  # Surface-aware discretization
             # Here, the target defines the fractional inside/outside
             # volumes of individual voxels.
-            w_in = target[..., 0] / (target[..., 0] + target[..., 1])
-            w_out = target[..., 1] / (target[..., 0] + target[..., 1])
+            w = self.weights(target)
 
-            loss = w_in * self.eval_in(x[..., 0]) +\
-                w_out * self.eval_out(x[..., 1])
+            loss = w[..., 0] * self.eval_in(x[..., 0]) +\
+                w[..., 1] * self.eval_out(x[..., 1])
             loss_patterns = self.eval_sparsity(patterns)
-        else:
-            raise ValueError(f"[Loss] Received tensors of invalid shape: \
-                             {target.shape}. The last dimension should be\
-                             either 1 or 2.")
 
         mi.Log(mi.LogLevel.Debug, "loss_patterns {}".format(\
                self.reduction(loss_patterns, axis=None)))
@@ -58,6 +93,46 @@ class Loss:
         return self.reduction(loss, axis=None) +\
             self.reduction(loss_patterns, axis=None)
 
+    def eval_grad(self, x, target, patterns):
+        """
+        Fused evaluation of the loss and of its gradients with respect to 'x'
+        and 'patterns'. The gradients are computed analytically, so no AD graph
+        is recorded, and the loss and gradients are evaluated in one pass.
+
+        Returns the loss value, the gradient with respect to 'x' (with the same
+        shape as 'x') and the gradient with respect to 'patterns'.
+        """
+        with dr.suspend_grad():
+            x = dr.detach(x)
+            patterns = dr.detach(patterns)
+            target = self.check_target(x, target)
+
+            if target.shape[-1] == 1:  # binary or grayscale target
+                loss, loss_patterns = self.eval(x, target, patterns)
+                grad_x, grad_patterns = self.grad(x, target, patterns)
+                loss = loss.array
+                n_voxels = dr.width(loss)
+                grad_x = grad_x.array
+            else:  # Surface-aware discretization
+                # Work on the flat interleaved inside/outside layout, so that
+                # both channels are handled by the same kernel.
+                w = self.weights(target).array
+                is_in = (dr.arange(mi.UInt32, dr.width(w)) & 1) == 0
+                x_flat = x.array
+                loss = w * dr.select(is_in, self.eval_in(x_flat), self.eval_out(x_flat))
+                grad_x = w * dr.select(is_in, self.grad_in(x_flat), self.grad_out(x_flat))
+                loss_patterns = self.eval_sparsity(patterns)
+                grad_patterns = self.grad_sparsity(patterns)
+                n_voxels = dr.width(loss) // 2
+
+            scale = 1. / n_voxels if self.reduction_type == 'mean' else 1.
+            loss = dr.sum(loss) * scale + self.reduction(loss_patterns, axis=None)
+            grad_x *= scale
+            if self.reduction_type == 'mean':
+                grad_patterns /= dr.width(patterns)
+
+        return loss, mi.TensorXf(grad_x, x.shape), grad_patterns
+
 
 # TODO: implement L1 in an example in the documentation
 class L2Loss(Loss):
@@ -79,6 +154,18 @@ class L2Loss(Loss):
     def eval_sparsity(self, patterns):
         return patterns**self.M * self.weight_sparsity
 
+    def grad_in(self, x):
+        return 2. * (x - 1.)
+
+    def grad_out(self, x):
+        return 2. * x
+
+    def grad(self, x, target, patterns):
+        return 2. * (x - target), 0 * patterns
+
+    def grad_sparsity(self, patterns):
+        return self.M * patterns**(self.M - 1) * self.weight_sparsity
+
 class ThresholdedLoss(Loss):
     """
     Thresholded loss following Wechsler et al 2024.
@@ -131,6 +218,20 @@ class ThresholdedLoss(Loss):
         return dr.select(target > 0, self.eval_in(x), self.eval_out(x)),\
                 self.eval_sparsity(patterns)
 
+    def grad_in(self, x):
+        return - self.weight_object * relu_grad(self.tu - x, self.K) +\
+            self.weight_limit * relu_grad(x - 1., self.K)
+
+    def grad_out(self, x):
+        return self.weight_void * relu_grad(x - self.tl, self.K)
+
+    def grad_sparsity(self, patterns):
+        return self.M * dr.abs(patterns)**(self.M - 1) * dr.sign(patterns) * self.weight_sparsity
+
+    def grad(self, x, target, patterns):
+        return dr.select(target > 0, self.grad_in(x), self.grad_out(x)),\
+                self.grad_sparsity(patterns)
+
 
 losses = {
     'l2': L2Loss,
@@ -8,9 +8,11 @@ import json
 import argparse
 
 from drtvam.geometry import geometries
-from drtvam.utils import save_img, save_vol, save_histogram, discretize
+from drtvam.utils import save_img, save_vol, save_cells, save_histogram, discretize, is_volume_file, volume_target, volume_bbox, load_volume, resample_volume, build_scene, load_mesh, cached_mesh_file, simplified_mesh_file
 from drtvam.loss import losses
-from drtvam.lbfgs import LinearLBFGS
+from drtvam.lbfgs import LinearLBFGS, LinearLBFGSB
+from drtvam.sensor import OccupancyGrid, ExtinctionGrid
+from drtvam.film import CylindricalFilm, SparseFilm, MaskedFilm
 
 def load_scene(config):
     for key in ['target', 'vial', 'projector', 'sensor']:
@@ -28,27 +30,6 @@ def load_scene(config):
     if 'filename' not in config['target']:
         raise ValueError("Missing field 'filename' for the target shape.")
 
-    # Target mesh transform
-    mesh_type = os.path.splitext(config['target']['filename'])[1][1:]
-    bbox = mi.load_dict({
-        'type': mesh_type,
-        'filename': config['target']['filename']
-    }).bbox()
-
-    c = 0.5 * (bbox.min + bbox.max)
-    size = config['target'].get('size', 1.)
-    center_pos_x = config['target'].get('box_center_x', 0.)
-    center_pos_y = config['target'].get('box_center_y', 0.)
-    center_pos_z = config['target'].get('box_center_z', 0.)
-
-    center_pos = mi.ScalarPoint3f(center_pos_x, center_pos_y, center_pos_z)
-    # Scale and center the target object
-    # first translate to the center of the bounding box
-    # then scale to the size of the bounding box
-    # then translate to user specified position (if there is one)
-    target_to_world = mi.ScalarTransform4f().translate(center_pos) @ \
-      mi.ScalarTransform4f().scale(size / dr.max(bbox.extents())) @ mi.ScalarTransform4f().translate(-c)
-
     def get_sensor_transform(sensor_dict):
         sensor_scalex = sensor_dict.pop('scalex', 1.)
         sensor_scaley = sensor_dict.pop('scaley', 1.)
@@ -57,27 +38,147 @@ def load_scene(config):
 
     sensor_to_world = get_sensor_transform(config['sensor'])
 
-    # Create Mitsuba scene
-    scene_dict = {
-        'type': 'scene',
-        'projector': config['projector'],
-        'sensor': config['sensor'] | {'to_world': sensor_to_world},
-        'target': {
+    # Decimate the target and occlusion meshes to an error bound well below the voxel size
+    simplify = config.get('simplify_meshes', False)
+    # Store meshes in world space as binary PLY files, which are fast to load
+    cache_meshes = config.get('cache_meshes', False)
+    cache_dir = config.get('cache_dir', os.path.join(os.path.expanduser('~'), '.cache', 'drtvam'))
+    if simplify:
+        # Resolution of the instantiated film, whose parameters depend on its type
+        film = mi.load_dict(dict(config['sensor'].get('film', {'type': 'vfilm'})))
+        res = mi.ScalarVector3f(film.resolution())
+        extents = sensor_to_world @ mi.ScalarVector3f(1.)
+        if isinstance(film, CylindricalFilm):
+            # Radial and vertical steps of the cylindrical grid
+            voxel_size = min(0.5 * min(extents.x, extents.y) / res.x, extents.z / res.z)
+        else:
+            voxel_size = dr.min(extents / res)
+        tolerance = config.get('simplify_tolerance', 0.5 * voxel_size)
+
+    # Voxel grid targets are directly resampled onto the film, they are not part of the scene
+    volume_target = is_volume_file(config['target']['filename'])
+
+    def load_target():
+        # Load the target mesh only once, it is shared by the scenes of all stages
+        mesh_type = os.path.splitext(config['target']['filename'])[1][1:]
+        target = mi.load_dict({
             'type': mesh_type,
+            'id': 'target',
             'filename': config['target']['filename'],
-            'to_world': target_to_world,
             'bsdf': {
                 'type': 'null'
             }
-        },
+        })
+        bbox = target.bbox()
+
+        c = 0.5 * (bbox.min + bbox.max)
+        size = config['target'].get('size', 1.)
+        center_pos_x = config['target'].get('box_center_x', 0.)
+        center_pos_y = config['target'].get('box_center_y', 0.)
+        center_pos_z = config['target'].get('box_center_z', 0.)
+
+        center_pos = mi.ScalarPoint3f(center_pos_x, center_pos_y, center_pos_z)
+        # Scale and center the target object
+        # first translate to the center of the bounding box
+        # then scale to the size of the bounding box
+        # then translate to user specified position (if there is one)
+        target_to_world = mi.ScalarTransform4f().translate(center_pos) @ \
+          mi.ScalarTransform4f().scale(size / dr.max(bbox.extents())) @ mi.ScalarTransform4f().translate(-c)
+
+        # Apply the transform in place rather than reloading the mesh
+        target_params = mi.traverse(target)
+        positions = dr.unravel(mi.Point3f, target_params['vertex_positions'])
+        target_params['vertex_positions'] = dr.ravel(mi.Transform4f(target_to_world) @ positions)
+        target_params.update()
+        return target
+
+    if not volume_target and (simplify or cache_meshes):
+        # Cached meshes are stored in world space, so the placement of the target is part of the key
+        placement = tuple(config['target'].get(k, d) for k, d in [('size', 1.), ('box_center_x', 0.), ('box_center_y', 0.), ('box_center_z', 0.)])
+        if simplify:
+            target_file = simplified_mesh_file(config['target']['filename'], tolerance, cache_dir, load_target, placement)
+        else:
+            target_file = cached_mesh_file(config['target']['filename'], cache_dir, load_target, placement)
+        target = mi.load_dict({
+            'type': 'ply',
+            'id': 'target',
+            'filename': target_file,
+            'bsdf': {
+                'type': 'null'
+            }
+        })
+    elif not volume_target:
+        target = load_target()
+
+    # Sampler used to generate projector rays, e.g. a stratified or low-discrepancy one
+    if 'sampler' in config and 'sampler' not in config['projector']:
+        sampler = config['sampler']
+        config['projector']['sampler'] = {'type': sampler} if isinstance(sampler, str) else sampler
+
+    # Create Mitsuba scene
+    scene_dict = {
+        'type': 'scene',
+        'projector': config['projector'],
+        'sensor': config['sensor'] | {'to_world': sensor_to_world},
     } | vial.to_dict()
 
+    if simplify:
+        for occlusion in vial.occlusions:
+            key = "occlusion" + occlusion["filename"].replace("/", "_").replace(".", "_")
+            scene_dict[key]['filename'] = simplified_mesh_file(occlusion['filename'], tolerance, cache_dir)
+
+    if cache_meshes:
+        for key, shape in scene_dict.items():
+            if not isinstance(shape, dict) or shape.get('type') not in ('ply', 'obj'):
+                continue
+            if simplify and key.startswith('occlusion'):
+                continue # Already cached
+            to_world = shape.pop('to_world', mi.ScalarTransform4f())
+            def load_fn():
+                return load_mesh(shape['filename'], to_world=to_world, face_normals=shape.get('face_normals', False))
+            shape['filename'] = cached_mesh_file(shape['filename'], cache_dir, load_fn, (str(to_world.matrix), shape.get('face_normals', False)))
+            shape['type'] = 'ply'
+
+    if not volume_target:
+        scene_dict['target'] = target
+
     if 'final_sensor' in config.keys():
         final_sensor_to_world = get_sensor_transform(config['final_sensor'])
         scene_dict['final_sensor'] = config['final_sensor'] | {'to_world': final_sensor_to_world}
 
+    if vial.extinction_grid is not None:
+        # Heterogeneous extinction, also tracked by the integrators themselves
+        scene_dict['extinction'] = vial.extinction_grid
+
     return scene_dict
 
+def set_active_pixels(params, opt, key, all_pixels, old_map, new_map):
+    """
+    Change the set of active projector pixels to the candidate pixels 'new_map'
+    (indices into 'all_pixels'). The pattern values and optimizer state of the
+    pixels that were active in 'old_map' are carried over, other pixels start
+    at zero.
+    """
+    n_old = dr.width(old_map)
+    # Position of each candidate pixel in the previous active set, n_old if it was inactive
+    pos = dr.full(mi.UInt32, n_old, dr.width(all_pixels))
+    dr.scatter(pos, dr.arange(mi.UInt32, n_old), old_map)
+    idx = dr.gather(mi.UInt32, pos, new_map)
+    valid = idx < n_old
+
+    data = dr.gather(mi.Float, dr.detach(opt[key]), idx, valid)
+    dr.eval(data)
+    params['projector.active_pixels'] = dr.gather(mi.UInt32, all_pixels, new_map)
+    params[key] = data
+    params.update()
+
+    if isinstance(opt, LinearLBFGS):
+        opt.remap(key, data, idx, valid)
+    else:
+        opt[key] = data
+
+    return new_map
+
 def optimize(config, patterns_fwd=None):
     """
 
@@ -87,8 +188,11 @@ def optimize(config, patterns_fwd=None):
         patterns_fwd (np.ndarray, optional): if provided, the actual optimization is skipped
     """
     scene_dict = load_scene(config)
+    # The target mesh is only added to the scenes of the stages that need it
+    target_shape = scene_dict.pop('target', None)
+    # The extinction grid loaded with the vial, shared with the integrators
+    extinction_grid = scene_dict.pop('extinction', None)
     scene = mi.load_dict(scene_dict)
-    params = mi.traverse(scene)
 
     output = config['output']
 
@@ -102,6 +206,13 @@ def optimize(config, patterns_fwd=None):
     progressive = config.get('progressive', False)
     transmission_only = config.get('transmission_only', True)
     regular_sampling = config.get('regular_sampling', False)
+    pixel_sampling = config.get('pixel_sampling', 'uniform')
+    voxelizer = config.get('voxelizer', 'ray') # Target discretization method, 'ray' or 'scanline'
+    fused_loss = config.get('fused_loss', False) # Analytic loss gradients instead of AD
+    incremental_dose = config.get('incremental_dose', False) # Carry the dose from the line search to the next iteration
+    refresh_every = config.get('refresh_every', 5) # Full render frequency with incremental dose tracking
+    compact_every = config.get('compact_every', 0) # Active pixel compaction frequency, 0 to disable
+    compact_patience = config.get('compact_patience', 3) # Iterations a pixel must be stuck at zero before being dropped
     sensor = None
     final_sensor = None
     for s in scene.sensors():
@@ -114,9 +225,51 @@ def optimize(config, patterns_fwd=None):
         final_sensor = sensor
     if final_sensor.film().surface_aware:
         raise ValueError("The final sensor is used to generate visualizations and metrics of the final simulated print. Therefore, it must not be surface-aware. If you are using the surface-aware discretization for optimization, please specify another sensor called 'final_sensor' in the configuration file.")
+    if isinstance(final_sensor.film(), (CylindricalFilm, SparseFilm, MaskedFilm)):
+        raise ValueError("The final sensor is used to generate visualizations and metrics of the final simulated print. Therefore, it must use a dense Cartesian film. If you are using a cylindrical, sparse or masked film for optimization, please specify another sensor called 'final_sensor' in the configuration file.")
 
     surface_aware = sensor.film().surface_aware
     filter_radon = config.get('filter_radon', False) # Disable DMD pixels where the Radon transform is zero
+    target_volume = is_volume_file(config['target']['filename'])
+    inside_test = config.get('inside_test', 'mesh') # Track target crossings ('mesh') or look up an occupancy grid ('grid')
+    occupancy_scale = config.get('occupancy_scale', 2) # Resolution of the occupancy grid relative to the sensor
+    majorant_brick_size = config.get('majorant_brick_size', 8) # Voxels per side of the bricks of the majorant grid of a heterogeneous medium
+
+    if target_volume and inside_test != 'grid' and (surface_aware or filter_radon):
+        raise ValueError("Surface-aware optimization and the Radon transform filter require tracking whether rays are inside the target. With voxel grid targets, this is only supported with 'inside_test' set to 'grid'.")
+
+    if target_shape is not None:
+        # Scene used for inside/outside queries during the discretization
+        target_scene = mi.load_dict({
+            'type': 'scene',
+            'target': target_shape,
+        })
+
+    film = sensor.film()
+    if isinstance(film, SparseFilm):
+        if target_volume:
+            raise ValueError("Sparse films are refined around the target surface, which requires a mesh target.")
+        sensor.refine(target_scene)
+    elif isinstance(film, MaskedFilm):
+        # Only store the voxels that projector rays can reach in the medium
+        film.set_mask(sensor.medium_mask(scene))
+
+    occupancy = None
+    if inside_test == 'grid' and (surface_aware or filter_radon):
+        if target_volume:
+            data = load_volume(config['target'])
+            res = sensor.resolution() * occupancy_scale
+            frac_in = resample_volume(data, *volume_bbox(config['target'], data.shape), (res.x, res.y, res.z),
+                                      sensor.bbox.min.numpy().ravel(), sensor.bbox.max.numpy().ravel(), 'linear')
+            occupancy = OccupancyGrid(mi.TensorXf(frac_in[..., None]), sensor.bbox)
+        else:
+            occupancy = OccupancyGrid(sensor.occupancy(target_scene, occupancy_scale), sensor.bbox)
+
+    # Optimization rays only need to track the target surface in surface-aware mode
+    final_scene = scene
+    if surface_aware and inside_test == 'mesh':
+        scene = build_scene(scene, {'target': target_shape})
+    params = mi.traverse(scene)
 
     integrator = mi.load_dict({
         'type': 'volume',
@@ -124,19 +277,46 @@ def optimize(config, patterns_fwd=None):
         'rr_depth': rr_depth,
         'print_time': time,
         'transmission_only': transmission_only,
-        'regular_sampling': regular_sampling
+        'regular_sampling': regular_sampling,
+        'pixel_sampling': pixel_sampling,
+        'inside_test': inside_test if surface_aware else 'mesh',
+        'cache_rays': config.get('cache_rays', False)
     })
+    integrator.occupancy = occupancy
+
+    extinction = None
+    if extinction_grid is not None:
+        values, bbox_min, bbox_max = extinction_grid
+        extinction = ExtinctionGrid(mi.TensorXf(values), mi.BoundingBox3f(mi.Point3f(*bbox_min), mi.Point3f(*bbox_max)), config['vial']['medium']['albedo'], majorant_brick_size)
+    integrator.extinction = extinction
 
     # Computing reference
-    if surface_aware:
-        target = sensor.compute_volume(scene)
-        save_vol(target[..., 0, None], os.path.join(output, "target_in.exr"))
-        save_vol(target[..., 1, None], os.path.join(output, "target_out.exr"))
+    def save_target(tensor, name):
+        # Sparse and masked films are saved in their compact layout, without expanding them to a dense grid
+        if isinstance(film, (SparseFilm, MaskedFilm)):
+            save_cells(film, tensor, os.path.join(output, f"{name}.npz"))
+        else:
+            save_vol(tensor, os.path.join(output, f"{name}.exr"))
+
+    if target_volume and surface_aware:
+        target = film.compact(volume_target(config['target'], sensor), reduction='sum')
+        # Inside/outside volumes of each voxel, used to normalize the dose
+        sensor.volumes = target
+        save_target(target[..., 0, None], "target_in")
+        save_target(target[..., 1, None], "target_out")
+    elif target_volume:
+        target = film.compact(volume_target(config['target'], sensor))
+        save_target(target, "target")
+    elif surface_aware:
+        target = sensor.compute_volume(target_scene)
+        save_target(target[..., 0, None], "target_in")
+        save_target(target[..., 1, None], "target_out")
     else:
-        target = discretize(scene, sensor=sensor)
-        save_vol(target, os.path.join(output, "target.exr"))
+        target = discretize(target_scene, sensor=sensor, method=voxelizer)
+        save_target(target, "target")
 
-    np.save(os.path.join(output, "target.npy"), target.numpy())
+    if not isinstance(film, (SparseFilm, MaskedFilm)):
+        np.save(os.path.join(output, "target.npy"), target.numpy())
 
     patterns_key = 'projector.active_data'
 
@@ -145,8 +325,12 @@ def optimize(config, patterns_fwd=None):
         radon_integrator = mi.load_dict({
             'type': 'radon',
             'max_depth': 5,
+            'inside_test': inside_test,
         })
-        radon = mi.render(scene, integrator=radon_integrator, spp=config.get('spp_filter_radon', 4))
+        radon_integrator.occupancy = occupancy
+        radon_integrator.extinction = extinction
+        radon_scene = scene if surface_aware or inside_test == 'grid' else build_scene(scene, {'target': target_shape})
+        radon = mi.render(radon_scene, integrator=radon_integrator, spp=config.get('spp_filter_radon', 4))
 
         active_pixels = dr.compress(radon.array > 0.) + dr.opaque(mi.UInt32, 0) # Hack to get the result of compress to only use its actual size
         dr.eval(active_pixels)
@@ -158,7 +342,7 @@ def optimize(config, patterns_fwd=None):
         params[patterns_key] = dr.zeros(mi.Float, dr.width(active_pixels))
         params.update()
 
-        del radon, radon_integrator
+        del radon, radon_integrator, radon_scene
         dr.flush_malloc_cache()
         dr.sync_thread()
 
@@ -185,11 +369,6 @@ def optimize(config, patterns_fwd=None):
         dr.sync_thread()
 
 
-    # If not using the surface-aware discretization, we don't need the target shape anymore, so we just move it far away
-    if not surface_aware:
-        params['target.vertex_positions'] += 1e5
-        params.update()
-
     if "loss" not in config.keys():
         print("No loss function specified. Using thresholded loss.")
         config['loss'] = {'type': 'threshold'}
@@ -205,6 +384,10 @@ def optimize(config, patterns_fwd=None):
         config['optimizer'] = {'type': 'lbfgs'}
 
     optim_type = config['optimizer'].pop('type')
+    if incremental_dose and optim_type != 'lbfgsb':
+        # Other optimizers clamp the patterns after each step, which the dose
+        # predicted by the line search does not account for
+        raise ValueError("Incremental dose tracking is only supported with the 'lbfgsb' optimizer.")
     if optim_type == 'adam':
         opt = mi.ad.Adam(**config['optimizer'])
     elif optim_type == 'sgd':
@@ -219,7 +402,11 @@ def optimize(config, patterns_fwd=None):
         def loss_fn2(y, patterns):
             return loss_fn(y, target, patterns)
 
-        opt = LinearLBFGS(loss_fn=loss_fn2, render_fn=render_fn)
+        if optim_type == 'lbfgsb':
+            # Bound-constrained variant, the patterns are kept non-negative by the optimizer itself
+            opt = LinearLBFGSB(loss_fn=loss_fn2, render_fn=render_fn, **config['optimizer'])
+        else:
+            opt = LinearLBFGS(loss_fn=loss_fn2, render_fn=render_fn)
 
     # Pass patterns to optimizer
     opt[patterns_key] = params[patterns_key]
@@ -236,6 +423,7 @@ def optimize(config, patterns_fwd=None):
         'regular_sampling': regular_sampling,
         'print_time': time
     })
+    integrator_final.extinction = extinction
 
     if patterns_fwd is not None:
         print("Using provided patterns for forward mode.")
@@ -265,7 +453,7 @@ def optimize(config, patterns_fwd=None):
 
         params.update()
         print("Rendering final state...")
-        vol_final = mi.render(scene, params, spp=spp_ref, integrator=integrator_final, sensor=final_sensor)
+        vol_final = mi.render(final_scene, params, spp=spp_ref, integrator=integrator_final, sensor=final_sensor)
 
         np.save(os.path.join(output, "final.npy"), vol_final.numpy())
         save_vol(vol_final, os.path.join(output, "final.exr"))
@@ -284,19 +472,45 @@ def optimize(config, patterns_fwd=None):
         return vol_final
     else:
         print("Optimizing patterns...")
+        if compact_every > 0:
+            # Candidate pixels, and the number of consecutive iterations each
+            # of them has been stuck at zero
+            all_pixels = mi.UInt32(params['projector.active_pixels'])
+            n_all = dr.width(all_pixels)
+            active_map = dr.arange(mi.UInt32, n_all)
+            inactive_count = dr.zeros(mi.UInt32, n_all)
+
         for i in trange(n_steps):
+            if compact_every > 0 and i > 0 and i % compact_every == 0:
+                # Trace all candidate pixels in this iteration, so that dropped
+                # pixels can be reactivated if their gradient changed sign
+                active_map = set_active_pixels(params, opt, patterns_key, all_pixels, active_map, dr.arange(mi.UInt32, n_all))
+
+            # Reuse the dose predicted by the line search of the previous step,
+            # unless a full render is due
+            reuse_vol = incremental_dose and opt.vol is not None and (i % refresh_every != 0)
+
             if progressive and i == 5:
                 integrator.max_depth = max_depth
+                reuse_vol = False
 
             with dr.scoped_set_flag(dr.JitFlag.KernelHistory, True):
                 params.update(opt)
 
-                vol = mi.render(scene, params, integrator=integrator, sensor=sensor, spp=spp, spp_grad=spp_grad, seed=i)
+                if reuse_vol:
+                    vol = mi.TensorXf(opt.vol)
+                    dr.enable_grad(vol)
+                else:
+                    vol = mi.render(scene, params, integrator=integrator, sensor=sensor, spp=spp, spp_grad=spp_grad, seed=i)
                 dr.schedule(vol)
 
                 mi.Log(mi.LogLevel.Debug, "[drtvam] Calling loss from optimize loop")
-                loss = loss_fn(vol, target, params['projector.active_data'])
-                dr.eval(loss)
+                if fused_loss:
+                    loss, grad_vol, grad_patterns = loss_fn.eval_grad(vol, target, params['projector.active_data'])
+                    dr.eval(loss, grad_vol, grad_patterns)
+                else:
+                    loss = loss_fn(vol, target, params['projector.active_data'])
+                    dr.eval(loss)
 
                 # numpy conversion is necessary to store the loss value
                 # apparently in just loss.numpy() is deprecated since (Deprecated NumPy 1.25.)
@@ -305,19 +519,51 @@ def optimize(config, patterns_fwd=None):
                 # Primal timing
                 timing_hist[i, 0] = sum([h['execution_time'] for h in dr.kernel_history() if h['type'] == dr.KernelType.JIT])
 
-                dr.backward(loss)
+                if fused_loss:
+                    # Propagate the analytic gradients through the renderer
+                    dr.accum_grad(params['projector.active_data'], grad_patterns)
+                    if not reuse_vol:
+                        dr.set_grad(vol, grad_vol)
+                        dr.enqueue(dr.ADMode.Backward, vol)
+                        dr.traverse(dr.ADMode.Backward)
+                else:
+                    dr.backward(loss)
+                    if reuse_vol:
+                        grad_vol = vol.grad
+
+                if reuse_vol:
+                    # The dose was not rendered in this iteration, so only run the adjoint pass
+                    integrator.render_backward(scene, params, grad_vol, sensor=sensor, seed=i, spp=spp_grad)
+
+                if compact_every > 0:
+                    # Pixels at zero whose gradient pushes them further down
+                    stuck = (dr.detach(opt[patterns_key]) <= 0) & (opt[patterns_key].grad > 0)
+                    count = dr.gather(mi.UInt32, inactive_count, active_map)
+                    dr.scatter(inactive_count, dr.select(stuck, count + 1, 0), active_map)
+                    dr.eval(inactive_count)
 
                 if dr.all(loss == 0):
                     print("Converged")
                     break
 
-                if optim_type == 'lbfgs':
-                    opt.step(vol, loss)
+                if optim_type in ('lbfgs', 'lbfgsb'):
+                    opt.step(dr.detach(vol), loss)
                 else:
                     opt.step()
 
-                # Clamp patterns
-                opt[patterns_key] = dr.maximum(dr.detach(opt[patterns_key]), 0)
+                # Clamp patterns. The bound-constrained optimizer already keeps
+                # them feasible, and clamping would corrupt its history.
+                if optim_type != 'lbfgsb':
+                    opt[patterns_key] = dr.maximum(dr.detach(opt[patterns_key]), 0)
+
+                if compact_every > 0 and i % compact_every == 0:
+                    # Drop pixels that have been stuck at zero for too long
+                    keep = (dr.gather(mi.UInt32, inactive_count, active_map) < compact_patience) | \
+                        (dr.detach(opt[patterns_key]) > 0)
+                    kept = dr.compress(keep) + dr.opaque(mi.UInt32, 0) # Hack to get the result of compress to only use its actual size
+                    if 0 < dr.width(kept) < dr.width(active_map):
+                        active_map = set_active_pixels(params, opt, patterns_key, all_pixels, active_map,
+                                                       dr.gather(mi.UInt32, active_map, kept))
 
                 # Adjoint timing
                 timing_hist[i, 1] = sum([h['execution_time'] for h in dr.kernel_history() if h['type'] == dr.KernelType.JIT])
@@ -325,7 +571,7 @@ def optimize(config, patterns_fwd=None):
 
 
     print("Rendering final state...")
-    vol_final = mi.render(scene, params, spp=spp_ref, integrator=integrator_final, sensor=final_sensor)
+    vol_final = mi.render(final_scene, params, spp=spp_ref, integrator=integrator_final, sensor=final_sensor)
 
     np.save(os.path.join(output, "final.npy"), vol_final.numpy())
     save_vol(vol_final, os.path.join(output, "final.exr"))
@@ -353,9 +599,12 @@ def optimize(config, patterns_fwd=None):
     np.savez_compressed(os.path.join(output, "patterns_normalized_uint8.npz"), patterns=final_array)
 
     # save a high resolution in case of surface aware since the resolution
-    # might be low of target.exr/npy
-    if surface_aware:
-        target = discretize(scene, sensor=final_sensor)
+    # might be low of target.exr/npy, and a Cartesian target for cylindrical sensors
+    if surface_aware or final_sensor is not sensor:
+        if target_volume:
+            target = volume_target(config['target'], final_sensor)
+        else:
+            target = discretize(target_scene, sensor=final_sensor, method=voxelizer)
         np.save(os.path.join(output, "target_binary.npy"), target.numpy())
         save_vol(target, os.path.join(output, "target_binary.exr"))
 
@@ -119,6 +119,13 @@ class TVAMProjector(mi.Emitter):
     def active_size(self):
         return len(self.active_data)
 
+    def active_count(self):
+        """
+        Number of active pixels, as an opaque value so that the generated
+        kernels do not depend on it when the set of active pixels changes.
+        """
+        return dr.opaque(mi.Float, self.active_size())
+
     def size(self):
         return (self.n_patterns, self.res.y, self.res.x)
 
@@ -161,7 +168,7 @@ class TVAMProjector(mi.Emitter):
         to_world = self.motion.eval(time)
         ray = to_world @ mi.Ray3f(origin, direction)
 
-        n_samples = dr.width(position_sample)
+        n_samples = dr.opaque(mi.Float, dr.width(position_sample))
         return ray, inv_pdf / n_samples
 
 class CollimatedProjector(TVAMProjector):
@@ -184,7 +191,7 @@ class CollimatedProjector(TVAMProjector):
     def get_ray(self, position_sample, aperture_sample):
         origin = self.sample_to_camera @ mi.Point3f(position_sample.x, position_sample.y, 0.)
         direction = mi.Vector3f(0., 0., 1.)
-        active_area = dr.prod(self.pixel_size) * len(self.active_data)
+        active_area = dr.prod(self.pixel_size) * self.active_count()
         return origin, direction, active_area
 
     def to_string(self):
@@ -230,7 +237,7 @@ class TelecentricProjector(TVAMProjector):
         moved_scaled_aperture_sample = mi.Point3f(origin.x + scaled_aperture_sample.x, origin.y + scaled_aperture_sample.y, -self.focus_distance)
         direction = dr.normalize(-moved_scaled_aperture_sample + origin)
 
-        active_area = dr.prod(self.pixel_size) * len(self.active_data)
+        active_area = dr.prod(self.pixel_size) * self.active_count()
         return scaled_aperture_sample_p, direction, active_area
 
     def to_string(self):
@@ -281,7 +288,7 @@ class LensProjector(TVAMProjector):
         focus_p = near_p * (self.focus_distance / near_p.z)
         direction = dr.normalize(focus_p - origin)
 
-        active_area = self.pixel_size * self.pixel_size * len(self.active_data)
+        active_area = self.pixel_size * self.pixel_size * self.active_count()
 
         return origin, direction, active_area
 
@@ -1,6 +1,230 @@
 import mitsuba as mi
 import drjit as dr
-from .film import VolumetricFilm
+from .film import VolumetricFilm, CylindricalFilm, SparseFilm, MaskedFilm
+from .utils import get_target, build_scene
+
+def triangle_box_overlap(v0, v1, v2, half_size):
+    """
+    Separating axis test between the triangles (v0, v1, v2) and the
+    axis-aligned boxes centered at the origin with the given half size
+    (Akenine-Möller, 2001).
+    """
+    overlap = mi.Bool(True)
+
+    # Box face normals, i.e. bounding box of the triangle
+    for i in range(3):
+        overlap &= (dr.minimum(dr.minimum(v0[i], v1[i]), v2[i]) <= half_size[i]) & \
+                   (dr.maximum(dr.maximum(v0[i], v1[i]), v2[i]) >= -half_size[i])
+
+    # Triangle normal
+    e0, e1, e2 = v1 - v0, v2 - v1, v0 - v2
+    n = dr.cross(e0, e1)
+    overlap &= dr.abs(dr.dot(n, v0)) <= dr.dot(half_size, dr.abs(n))
+
+    # Cross products of the box and triangle edges
+    for e in (e0, e1, e2):
+        for i in range(3):
+            axis = mi.Vector3f(0.)
+            axis[i] = 1.
+            a = dr.cross(axis, e)
+            d0, d1, d2 = dr.dot(a, v0), dr.dot(a, v1), dr.dot(a, v2)
+            r = dr.dot(half_size, dr.abs(a))
+            overlap &= (dr.minimum(dr.minimum(d0, d1), d2) <= r) & (dr.maximum(dr.maximum(d0, d1), d2) >= -r)
+
+    return overlap
+
+class OccupancyGrid:
+    """
+    Occupancy of the target on a regular grid spanning 'bbox'. Points are
+    classified as inside or outside of the target with a texture lookup, where
+    the interpolated occupancy is thresholded at 0.5, instead of tracking the
+    crossings of the target surface along each ray.
+    """
+    def __init__(self, occupancy, bbox):
+        self.texture = mi.Texture3f(occupancy, filter_mode=dr.FilterMode.Linear, wrap_mode=dr.WrapMode.Clamp)
+        self.bbox = mi.BoundingBox3f(bbox.min, bbox.max)
+        res = occupancy.shape
+        self.voxel_size = self.bbox.extents() / mi.Vector3f(res[2], res[1], res[0])
+
+    def eval(self, p, active=True):
+        uvw = (p - self.bbox.min) / self.bbox.extents()
+        in_grid = dr.all((uvw >= 0) & (uvw <= 1))
+        return in_grid & (self.texture.eval(uvw, active & in_grid)[0] > 0.5)
+
+    @dr.syntax
+    def absorption(self, ray, maxt, sigma_t, active=True):
+        """
+        Fraction of the light entering the segment [0, maxt] of the ray that
+        is absorbed inside the target, assuming a purely absorptive medium. The
+        segment is marched at twice the resolution of the grid.
+        """
+        valid, mint_box, maxt_box = self.bbox.ray_intersect(ray)
+        active = mi.Bool(active) & valid
+        s = dr.maximum(mint_box, 0.)
+        end = dr.minimum(maxt_box, maxt)
+        active &= s < end
+
+        h = 0.5 * dr.min(self.voxel_size)
+        absorbed = mi.Spectrum(0.)
+        while active:
+            ds = dr.minimum(h, end - s)
+            inside = active & self.eval(ray(s + 0.5 * ds), active)
+            absorbed[inside] += dr.exp(-sigma_t * s) * (1 - dr.exp(-sigma_t * ds))
+            s += ds
+            active &= s < end
+
+        return absorbed
+
+class MajorantGrid:
+    """
+    Upper bounds of the extinction over the cells of a coarse grid spanning
+    'bbox'. Distances to the next interaction are sampled by regular tracking
+    through the cells, so that steps adapt to the local extinction, and empty
+    cells are skipped.
+    """
+    def __init__(self, majorants, bbox):
+        shape = majorants.shape
+        self.res = mi.ScalarVector3i(shape[2], shape[1], shape[0])
+        self.data = mi.Float(majorants.array)
+        self.bbox = mi.BoundingBox3f(bbox.min, bbox.max)
+        self.cell_size = self.bbox.extents() / mi.Vector3f(self.res)
+
+    @staticmethod
+    def from_extinction(sigma_t, bbox, brick_size=8):
+        """
+        Build the majorant grid of an extinction grid of shape (z, y, x, 1),
+        with one cell per brick of 'brick_size' voxels per side. Each voxel
+        also bounds the neighboring bricks, which its trilinear interpolation
+        reaches.
+        """
+        shape = sigma_t.shape
+        res = mi.ScalarVector3i(shape[2], shape[1], shape[0])
+        coarse = (res + brick_size - 1) // brick_size
+        majorants = dr.zeros(mi.Float, dr.prod(coarse))
+
+        idx = dr.arange(mi.UInt32, dr.prod(res))
+        voxel = mi.Vector3i(idx % res.x, (idx // res.x) % res.y, idx // (res.x * res.y))
+        values = dr.gather(mi.Float, sigma_t.array, idx)
+        for i in range(27):
+            v = dr.clip(voxel + mi.Vector3i(i % 3 - 1, (i // 3) % 3 - 1, i // 9 - 1), 0, res - 1)
+            cell = v // brick_size
+            dr.scatter_reduce(dr.ReduceOp.Max, majorants, values, mi.UInt32(cell.x + cell.y * coarse.x + cell.z * coarse.x * coarse.y))
+
+        return MajorantGrid(mi.TensorXf(majorants, shape=(coarse.z, coarse.y, coarse.x, 1)), bbox)
+
+    def cell_index(self, p):
+        cell = dr.clip(mi.Vector3i(dr.floor((p - self.bbox.min) / self.cell_size)), 0, self.res - 1)
+        return cell, cell.x + cell.y * self.res.x + cell.z * self.res.x * self.res.y
+
+    def eval(self, p, active=True):
+        """
+        Majorant at the points 'p', zero outside of the grid
+        """
+        in_grid = active & dr.all((p >= self.bbox.min) & (p <= self.bbox.max))
+        return dr.gather(mi.Float, self.data, self.cell_index(p)[1], in_grid)
+
+    @dr.syntax
+    def sample(self, ray, mint, maxt, tau, active=True):
+        """
+        Distance along the ray, from 'mint', at which the optical depth of the
+        majorant reaches 'tau', and the majorant there. The distance is
+        infinite if it is beyond 'maxt'.
+        """
+        valid, mint_box, maxt_box = self.bbox.ray_intersect(ray)
+        t = dr.maximum(mint, mint_box)
+        end = dr.minimum(maxt, maxt_box)
+        active = mi.Bool(active) & valid & (t < end)
+        tau = mi.Float(tau)
+
+        t_hit = mi.Float(dr.inf)
+        majorant = mi.Float(0.)
+        eps = 1e-4 * dr.min(self.cell_size)
+        while active:
+            cell, idx = self.cell_index(ray(t + eps))
+            m = dr.gather(mi.Float, self.data, idx, active)
+
+            # Distance to the exit of the current cell
+            boundary = self.bbox.min + mi.Vector3f(cell + dr.select(ray.d > 0, mi.Vector3i(1), mi.Vector3i(0))) * self.cell_size
+            t_axis = dr.select(ray.d != 0, (boundary - ray.o) / ray.d, dr.inf)
+            t_exit = dr.minimum(dr.maximum(dr.min(t_axis), t + eps), end)
+
+            dtau = m * (t_exit - t)
+            hit = active & (tau <= dtau)
+            t_hit[hit] = t + tau / m
+            majorant[hit] = m
+
+            tau[active] -= dtau
+            t[active] = t_exit
+            active &= ~hit & (t < end)
+
+        return t_hit, majorant
+
+class ExtinctionGrid:
+    """
+    Heterogeneous extinction of the printing medium, trilinearly interpolated
+    on a regular grid spanning 'bbox', and zero outside of it. Free-flight
+    distances and transmittances are estimated with delta and ratio tracking
+    through a coarse MajorantGrid with bricks of 'brick_size' voxels, so that
+    their cost depends on the resolution of the majorant grid rather than the
+    one of the extinction.
+    """
+    def __init__(self, sigma_t, bbox, albedo, brick_size=8):
+        self.texture = mi.Texture3f(sigma_t, filter_mode=dr.FilterMode.Linear, wrap_mode=dr.WrapMode.Clamp)
+        self.bbox = mi.BoundingBox3f(bbox.min, bbox.max)
+        self.albedo = albedo
+        self.majorants = MajorantGrid.from_extinction(sigma_t, self.bbox, brick_size)
+
+    def eval(self, p, active=True):
+        uvw = (p - self.bbox.min) / self.bbox.extents()
+        in_grid = active & dr.all((uvw >= 0) & (uvw <= 1))
+        return dr.select(in_grid, self.texture.eval(uvw, in_grid)[0], 0.)
+
+    @dr.syntax
+    def sample_interaction(self, ray, maxt, sampler, active=True):
+        """
+        Sample the next collision along the segment [0, maxt] of the ray by
+        delta tracking. The interaction is invalid if there is none.
+        """
+        active = mi.Bool(active)
+        t = mi.Float(0.)
+        t_hit = mi.Float(dr.inf)
+        while active:
+            t_next, majorant = self.majorants.sample(ray, t, maxt, -dr.log(1 - sampler.next_1d(active)), active)
+            active &= t_next < maxt
+            t[active] = t_next
+            real = active & (sampler.next_1d(active) * majorant < self.eval(ray(t), active))
+            t_hit[real] = t
+            active &= ~real
+
+        mei = dr.zeros(mi.MediumInteraction3f, dr.width(t_hit))
+        mei.t = t_hit
+        mei.p = ray(t_hit)
+        mei.wi = -ray.d
+        mei.sh_frame = mi.Frame3f(mei.wi)
+        mei.time = ray.time
+        mei.wavelengths = ray.wavelengths
+        sigma_t = self.eval(mei.p, dr.isfinite(t_hit))
+        mei.sigma_t = mi.Spectrum(sigma_t)
+        mei.sigma_s = mi.Spectrum(self.albedo * sigma_t)
+        mei.sigma_n = mi.Spectrum(0.)
+        return mei
+
+    @dr.syntax
+    def transmittance(self, ray, mint, maxt, sampler, active=True):
+        """
+        Ratio tracking estimate of the transmittance along the segment
+        [mint, maxt] of the ray.
+        """
+        active = mi.Bool(active)
+        t = mi.Float(mint)
+        tr = mi.Float(1.)
+        while active:
+            t_next, majorant = self.majorants.sample(ray, t, maxt, -dr.log(1 - sampler.next_1d(active)), active)
+            active &= t_next < maxt
+            t[active] = t_next
+            tr[active] *= 1 - self.eval(ray(t), active) / majorant
+            active &= tr > 0
+        return mi.Spectrum(tr)
 
 class VolumetricSensor(mi.Sensor):
     def __init__(self, props):
@@ -21,6 +245,13 @@ class VolumetricSensor(mi.Sensor):
         # Voxel volume
         self.volumes = None
 
+        # How to estimate the inside/outside volumes for surface-aware
+        # discretization: 'sampling' samples every voxel, 'boundary' only
+        # samples the voxels crossed by the target surface
+        self.volume_estimator = props.get('volume_estimator', 'sampling')
+        if self.volume_estimator not in ('sampling', 'boundary'):
+            raise ValueError(f"Invalid volume estimator: '{self.volume_estimator}'")
+
     def traverse(self, callback):
         callback.put_parameter("to_world", self.to_world, mi.ParamFlags.NonDifferentiable)
         callback.put_object("film", self.m_film, mi.ParamFlags.Differentiable)
@@ -28,6 +259,78 @@ class VolumetricSensor(mi.Sensor):
     def resolution(self):
         return self.m_film.resolution()
 
+    def voxel_index(self, p):
+        """
+        Integer coordinates of the voxels containing the points 'p', and
+        whether the points are inside the grid
+        """
+        voxel = mi.Vector3i(dr.floor((p - self.bbox.min) / self.voxel_size))
+        return voxel, dr.all(voxel >= 0) & dr.all(voxel < self.m_film.resolution())
+
+    def voxel_to_world(self, coords):
+        """
+        World space position of points given by their continuous voxel
+        coordinates, e.g. (i + 0.5) for the center of voxel i
+        """
+        return self.bbox.min + self.voxel_size * coords
+
+    def cell_volume(self):
+        """
+        Volume of the voxels of the grid
+        """
+        return dr.prod(self.voxel_size)
+
+    def film_taps(self, p, voxel, active, inside_target):
+        """
+        Film indices, weights and masks of the voxels to which a sample at 'p',
+        in the voxel 'voxel', contributes. With the box filter, this is only
+        its own voxel. With the tent filter, the sample is splatted trilinearly
+        over the 8 nearest voxel centers.
+        """
+        res = self.m_film.resolution()
+        if self.m_film.filter == 'tent':
+            u = (p - self.bbox.min) / self.voxel_size - 0.5
+            base = mi.Vector3i(dr.floor(u))
+            f = u - mi.Vector3f(base)
+            taps = []
+            for k in range(8):
+                w = (f.x if k & 1 else 1 - f.x) * (f.y if k & 2 else 1 - f.y) * (f.z if k & 4 else 1 - f.z)
+                # Neighbors outside of the grid are clamped to its boundary, to preserve energy
+                v = dr.clip(base + mi.Vector3i(k & 1, (k >> 1) & 1, k >> 2), 0, res - 1)
+                taps.append((v, w))
+        else:
+            taps = [(voxel, mi.Float(1.))]
+
+        out = []
+        for v, w in taps:
+            idx = v.x + v.y * res.x + v.z * res.x * res.y
+            if self.m_film.surface_aware:
+                idx = dr.select(inside_target, 2*idx, 2*idx+1)
+            idx, valid = self.m_film.index(idx, active)
+            out.append((idx, w, valid))
+        return out
+
+    def splat(self, taps, values, δL=None):
+        """
+        Accumulate the weighted 'values' in the voxels of the taps, in the film
+        or in the tensor 'δL' (forward-mode AD)
+        """
+        for idx, w, valid in taps:
+            if δL is None:
+                self.m_film.write(values * w, idx, valid)
+            else:
+                dr.scatter_reduce(dr.ReduceOp.Add, δL.array, values * w, idx, valid, mode=self.m_film.reduce_mode)
+
+    def gather(self, taps, δL):
+        """
+        Adjoint of 'splat': weighted sum of the gradients 'δL' of the voxels of
+        the taps (reverse-mode AD)
+        """
+        grad = mi.Spectrum(0.)
+        for idx, w, valid in taps:
+            grad += w * dr.gather(mi.Spectrum, δL.array, idx, valid)
+        return grad
+
     def accumulate(self,
                    ray,
                    emitted,
@@ -40,54 +343,186 @@ class VolumetricSensor(mi.Sensor):
                    sampler,
                    active=True,
                    δL=None,
-                   mode=dr.ADMode.Primal
+                   mode=dr.ADMode.Primal,
+                   occupancy=None,
+                   extinction=None
                    ):
         raise NotImplementedError()
 
     @dr.syntax
     def compute_volume(self, scene: mi.Scene, sample_count=2**14):
 
+        if dr.hint(isinstance(self.m_film, (SparseFilm, MaskedFilm)), mode='scalar'):
+            return self.compute_sparse_volume(scene, sample_count)
+
         if dr.hint(not self.m_film.surface_aware, mode='scalar'):
-            return dr.prod(self.voxel_size)
+            return self.cell_volume()
 
         # Surface-aware discretization
         if dr.hint(self.volumes is not None, mode='scalar'):
             return self.volumes
 
-        target_shape = None
-        for shape in scene.shapes():
-            if dr.hint(shape.id() == 'target', mode='scalar'):
-                target_shape = shape
-        if target_shape is None:
-            raise ValueError("No target shape found in the scene")
-
-        target_scene = mi.load_dict({
-            'type': 'scene',
-            'target': target_shape,
-        })
+        target_scene, target_shape = get_target(scene)
 
-        bbox = target_shape.bbox()
         # First channel is "outside" and second channel is "inside"
         res = self.m_film.resolution()
         self.volumes = dr.ones(mi.TensorXf, shape=self.m_film.data.shape)
 
-        xx = dr.arange(mi.Float, res.x)
-        yy = dr.arange(mi.Float, res.y)
-        zz = dr.arange(mi.Float, res.z)
-        z_idx, y_idx, x_idx = dr.meshgrid(zz, yy, xx, indexing='ij')
-        voxel = mi.Point3f(x_idx, y_idx, z_idx)
+        idx = dr.arange(mi.UInt32, dr.prod(res))
+        voxel_vol = self.cell_volume()
+
+        if dr.hint(self.volume_estimator == 'boundary', mode='scalar'):
+            # Voxels that are not crossed by the surface are entirely inside or
+            # outside, so a single test at their center is enough
+            frac_in = dr.select(self.is_inside(target_scene, target_shape, self.voxel_to_world(self.voxel_coords(idx) + 0.5)), 1., 0.)
+
+            # Only sample the fractional volumes of the boundary voxels
+            boundary_idx = dr.compress(self.boundary_voxels(target_shape)) + dr.opaque(mi.UInt32, 0) # Hack to get the result of compress to only use its actual size
+            if dr.hint(dr.width(boundary_idx) > 0, mode='scalar'):
+                frac_boundary = self.sample_volume(target_scene, target_shape, self.voxel_coords(boundary_idx), sample_count)
+                dr.scatter(frac_in, frac_boundary, boundary_idx)
+        else:
+            frac_in = self.sample_volume(target_scene, target_shape, self.voxel_coords(idx), sample_count)
+
+        dr.scatter(self.volumes.array, frac_in * voxel_vol, 2*idx)
+        dr.scatter(self.volumes.array, (1 - frac_in) * voxel_vol, 2*idx+1)
+
+        dr.eval(self.volumes)
+        return self.volumes
+
+    def compute_sparse_volume(self, scene: mi.Scene, sample_count=2**14):
+        """
+        Volumes of the cells of a SparseFilm or MaskedFilm. Coarse cells are not crossed by
+        the target surface, so they are classified with a single test at their
+        center, and only the voxels of refined bricks are sampled. The voxels
+        of a MaskedFilm are all sampled, or only those crossed by the target
+        surface with the 'boundary' volume estimator.
+        """
+        lo, size = self.m_film.cells()
+        cell_vol = self.cell_volume() * size**3
+
+        if dr.hint(not self.m_film.surface_aware, mode='scalar'):
+            return mi.TensorXf(cell_vol, shape=self.m_film.data.shape)
+
+        if dr.hint(self.volumes is not None, mode='scalar'):
+            return self.volumes
+
+        target_scene, target_shape = get_target(scene)
+
+        frac_in = dr.select(self.is_inside(target_scene, target_shape, self.voxel_to_world(lo + 0.5 * size)), 1., 0.)
+        if dr.hint(isinstance(self.m_film, SparseFilm), mode='scalar'):
+            sampled = size == 1
+        elif dr.hint(self.volume_estimator == 'boundary', mode='scalar'):
+            res = self.m_film.resolution()
+            v = mi.UInt32(lo.x + lo.y * res.x + lo.z * res.x * res.y)
+            sampled = dr.gather(mi.Bool, self.boundary_voxels(target_shape), v)
+        else:
+            sampled = dr.full(mi.Bool, True, dr.width(size))
+        refined_idx = dr.compress(sampled) + dr.opaque(mi.UInt32, 0) # Hack to get the result of compress to only use its actual size
+        if dr.hint(dr.width(refined_idx) > 0, mode='scalar'):
+            frac_refined = self.sample_volume(target_scene, target_shape, dr.gather(mi.Point3f, lo, refined_idx), sample_count)
+            dr.scatter(frac_in, frac_refined, refined_idx)
+
+        idx = dr.arange(mi.UInt32, dr.width(cell_vol))
+        self.volumes = dr.ones(mi.TensorXf, shape=self.m_film.data.shape)
+        dr.scatter(self.volumes.array, frac_in * cell_vol, 2*idx)
+        dr.scatter(self.volumes.array, (1 - frac_in) * cell_vol, 2*idx+1)
+
+        dr.eval(self.volumes)
+        return self.volumes
 
-        voxel_vol = dr.prod(self.voxel_size)
-        count_in = dr.zeros(mi.UInt32, dr.prod(res))
-        count_out = dr.zeros(mi.UInt32, dr.prod(res))
+    def refine(self, scene: mi.Scene):
+        """
+        Refine the bricks of a SparseFilm that are crossed by the target surface
+        """
+        _, target_shape = get_target(scene)
+        self.m_film.refine(self.boundary_voxels(target_shape, self.m_film.brick_size))
+        self.volumes = None
+
+    def medium_mask(self, scene: mi.Scene):
+        """
+        Mask of the voxels that overlap the printing medium. The center and
+        corners of each voxel are tested with rays along the six axis
+        directions, and are in the medium if it lies behind the first surface
+        that one of the rays hits. The mask is then dilated by one voxel, so
+        that voxels that the medium only clips between their test points are
+        kept as well.
+        """
+        # The target does not delimit the medium
+        scene = build_scene(scene, exclude=('target',))
+        res = self.m_film.resolution()
+        idx = dr.arange(mi.UInt32, dr.prod(res))
+        voxel = self.voxel_coords(idx)
+
+        mask = dr.zeros(mi.Bool, dr.width(idx))
+        offsets = [(0.5, 0.5, 0.5)] + [(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)]
+        directions = [(1, 0, 0), (-1, 0, 0), (0, 1, 0), (0, -1, 0), (0, 0, 1), (0, 0, -1)]
+        for offset in offsets:
+            for d in directions:
+                ray = mi.Ray3f(self.voxel_to_world(voxel + mi.Vector3f(offset)), mi.Vector3f(d))
+                si = scene.ray_intersect(ray, active=~mask)
+                mask |= si.is_valid() & (si.target_medium(-ray.d) != None)
+
+        dilated = mi.Bool(mask)
+        for offset in [(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]:
+            v = mi.Vector3i(voxel) + mi.Vector3i(offset)
+            valid = dr.all((v >= 0) & (v < mi.Vector3i(res)))
+            dilated |= dr.gather(mi.Bool, mask, mi.UInt32(v.x + v.y * res.x + v.z * res.x * res.y), valid)
+        return dilated
+
+    def voxel_coords(self, idx):
+        """
+        Integer coordinates of the voxels with flat indices 'idx', as a Point3f
+        """
+        res = self.m_film.resolution()
+        return mi.Point3f(idx % res.x, (idx // res.x) % res.y, idx // (res.x * res.y))
+
+    def is_inside(self, target_scene, target_shape, pos):
+        """
+        Test whether the points at 'pos' (in world space) are inside the target,
+        by checking the orientation of the surface along a random ray.
+        """
+        bbox = target_shape.bbox()
+        sampler = mi.load_dict({'type': 'independent'})
+        sampler.seed(0, dr.width(pos))
+
+        ray = mi.Ray3f(pos, mi.warp.square_to_uniform_sphere(sampler.next_2d()))
+        # If the ray origin is outside of its bounding box, we already know it's outside the mesh
+        in_mesh_bbox = dr.all((ray.o > bbox.min) & (ray.o < bbox.max))
+        si = target_scene.ray_intersect(ray, active=in_mesh_bbox)
+
+        return si.is_valid() & (si.shape == mi.ShapePtr(target_shape)) & (dr.dot(ray.d, si.n) > 0)
+
+    def occupancy(self, scene: mi.Scene, scale=2):
+        """
+        Binary occupancy of the target on a Cartesian grid spanning the
+        bounding box of the sensor, 'scale' times finer than the film along
+        each dimension.
+        """
+        target_scene, target_shape = get_target(scene)
+        res = self.m_film.resolution() * scale
+        idx = dr.arange(mi.UInt32, dr.prod(res))
+        coords = mi.Point3f(idx % res.x, (idx // res.x) % res.y, idx // (res.x * res.y)) + 0.5
+        pos = self.bbox.min + coords * self.bbox.extents() / mi.Vector3f(res)
+        occupancy = dr.select(self.is_inside(target_scene, target_shape, pos), 1., 0.)
+        return mi.TensorXf(occupancy, shape=(res.z, res.y, res.x, 1))
+
+    @dr.syntax
+    def sample_volume(self, target_scene, target_shape, voxel, sample_count):
+        """
+        Monte Carlo estimate of the fraction of the volume of each voxel (given
+        by its integer coordinates) that is inside the target.
+        """
+        bbox = target_shape.bbox()
+        count_in = dr.zeros(mi.UInt32, dr.width(voxel))
         d = mi.UInt32(0)
         sampler = mi.load_dict({'type': 'independent'})
-        sampler.seed(0, dr.prod(res))
+        sampler.seed(0, dr.width(voxel))
 
         active = mi.Bool(True)
         while active:
             offset = mi.Point3f(sampler.next_1d(), sampler.next_1d(), sampler.next_1d())
-            pos = self.bbox.min + self.voxel_size * (voxel + offset)
+            pos = self.voxel_to_world(voxel + offset)
             ray = mi.Ray3f(pos, mi.warp.square_to_uniform_sphere(sampler.next_2d()))
 
             # If the ray origin is outside of its bounding box, we already know it's outside the mesh
@@ -97,17 +532,48 @@ class VolumetricSensor(mi.Sensor):
             is_inside = si.is_valid() & (si.shape == mi.ShapePtr(target_shape)) & (dr.dot(ray.d, si.n) > 0)
 
             count_in[active & is_inside] += 1
-            count_out[active & ~is_inside] += 1
 
             d[active] += 1
             active &= (d < sample_count)
 
-        idx = dr.arange(mi.UInt32, dr.prod(res))
-        dr.scatter(self.volumes.array, count_in * voxel_vol / sample_count, 2*idx)
-        dr.scatter(self.volumes.array, count_out * voxel_vol / sample_count, 2*idx+1)
+        return mi.Float(count_in) / sample_count
 
-        dr.eval(self.volumes)
-        return self.volumes
+    @dr.syntax
+    def boundary_voxels(self, target_shape, scale=1):
+        """
+        Mark the voxels that are crossed by the surface of the target mesh. Each
+        triangle is tested against the voxels overlapped by its bounding box.
+        With 'scale' > 1, the test is done on blocks of 'scale' voxels per side
+        instead.
+        """
+        res = self.m_film.resolution() // scale
+        voxel_size = self.voxel_size * scale
+        boundary = dr.zeros(mi.UInt32, dr.prod(res))
+
+        params = mi.traverse(target_shape)
+        faces = dr.gather(mi.Vector3u, params['faces'], dr.arange(mi.UInt32, target_shape.face_count()))
+        p0 = dr.gather(mi.Point3f, params['vertex_positions'], faces.x)
+        p1 = dr.gather(mi.Point3f, params['vertex_positions'], faces.y)
+        p2 = dr.gather(mi.Point3f, params['vertex_positions'], faces.z)
+
+        # Range of voxels overlapped by the bounding box of each triangle
+        tri_min = dr.minimum(dr.minimum(p0, p1), p2)
+        tri_max = dr.maximum(dr.maximum(p0, p1), p2)
+        lo = dr.clip(mi.Vector3i(dr.floor((tri_min - self.bbox.min) / voxel_size)), 0, res - 1)
+        hi = dr.clip(mi.Vector3i(dr.floor((tri_max - self.bbox.min) / voxel_size)), 0, res - 1)
+        extents = mi.Vector3u(hi - lo + 1)
+        n = extents.x * extents.y * extents.z
+
+        half_size = 0.5 * voxel_size
+        j = mi.UInt32(0)
+        while j < n:
+            v = lo + mi.Vector3i(mi.Vector3u(j % extents.x, (j // extents.x) % extents.y, j // (extents.x * extents.y)))
+            center = self.bbox.min + (mi.Point3f(v) + 0.5) * voxel_size
+            overlap = triangle_box_overlap(p0 - center, p1 - center, p2 - center, half_size)
+            dr.scatter(boundary, 1, mi.UInt32(v.x + v.y * res.x + v.z * res.x * res.y), overlap)
+            j += 1
+
+        return boundary != 0
 
 class DeltaVolumetricSensor(VolumetricSensor):
     def __init__(self, props):
@@ -131,7 +597,9 @@ class DeltaVolumetricSensor(VolumetricSensor):
                    sampler,
                    active=True,
                    δL=None,
-                   mode=dr.ADMode.Primal
+                   mode=dr.ADMode.Primal,
+                   occupancy=None,
+                   extinction=None
                    ):
 
         g_em = dr.zeros(mi.Float, dr.width(emitted))
@@ -139,16 +607,12 @@ class DeltaVolumetricSensor(VolumetricSensor):
         g_ss = dr.zeros(mi.Spectrum, dr.width(emitted))
 
         active = mi.Bool(active & mei.is_valid())
-        res = self.m_film.resolution()
         pos = ray(mei.t)
-        current_voxel = mi.Vector3i(dr.floor((pos - self.bbox.min) / self.voxel_size))
-        is_inside_grid = dr.all(current_voxel >= 0) & dr.all(current_voxel < res)
-        current_voxel_flat = current_voxel.x + current_voxel.y * res.x + current_voxel.z * res.x * res.y
+        current_voxel, is_inside_grid = self.voxel_index(pos)
 
-        if dr.hint(self.m_film.surface_aware, mode='scalar'):
-            idx = dr.select(inside_target, 2*current_voxel_flat, 2*current_voxel_flat+1)
-        else:
-            idx = current_voxel_flat
+        if dr.hint(self.m_film.surface_aware and occupancy is not None, mode='scalar'):
+            inside_target = occupancy.eval(pos, active)
+        taps = self.film_taps(pos, current_voxel, active & is_inside_grid, inside_target)
 
         em = dr.detach(emitted)
         ss = dr.detach(mei.sigma_s)
@@ -166,27 +630,32 @@ class DeltaVolumetricSensor(VolumetricSensor):
             dr.set_grad(ss, mei.sigma_s.grad)
             dr.set_grad(st, mei.sigma_t.grad)
 
-        sa = st - ss
-        tr = dr.exp(-st * mei.t)
-        tr_pdf = tr * st
-        inv_pdf = dr.select(tr_pdf != 0, dr.detach(dr.rcp(tr_pdf)), 0.) # This is wrong if we don't sample free-flight distances proportional to transmittance
-        throughput = dr.detach(attenuation * dr.exp(st * t_prev)) * dr.exp(-st * t_prev)
-        throughput *= dr.select(ss != 0, ss**n_scat / dr.detach(ss**n_scat), 1.)
+        if dr.hint(extinction is not None, mode='scalar'):
+            # Heterogeneous medium: the transmittance cancels out with the
+            # delta tracking pdf, and only the emission is differentiated
+            contrib = dr.select(active, dr.detach(attenuation) * (1 - extinction.albedo) * em, 0.)
+        else:
+            sa = st - ss
+            tr = dr.exp(-st * mei.t)
+            tr_pdf = tr * st
+            inv_pdf = dr.select(tr_pdf != 0, dr.detach(dr.rcp(tr_pdf)), 0.) # This is wrong if we don't sample free-flight distances proportional to transmittance
+            throughput = dr.detach(attenuation * dr.exp(st * t_prev)) * dr.exp(-st * t_prev)
+            throughput *= dr.select(ss != 0, ss**n_scat / dr.detach(ss**n_scat), 1.)
 
-        contrib = dr.select(active, throughput * sa * tr * inv_pdf * em, 0.)
+            contrib = dr.select(active, throughput * sa * tr * inv_pdf * em, 0.)
         if dr.hint(mode == dr.ADMode.Primal, mode='scalar'):
-            self.m_film.write(contrib, idx, active & is_inside_grid)
+            self.splat(taps, contrib)
         else:
             if dr.hint(mode == dr.ADMode.Backward, mode='scalar'):
                 # Reverse-mode AD
-                grad = dr.gather(mi.Spectrum, δL.array, idx, active & is_inside_grid)
+                grad = self.gather(taps, δL)
                 dr.backward_from(contrib * grad)
                 g_em = em.grad
                 g_ss = ss.grad
                 g_st = st.grad
             else:
                 # Forward-mode AD
-                dr.scatter_reduce(dr.ReduceOp.Add, δL.array, dr.forward_to(contrib), idx, active & is_inside_grid)
+                self.splat(taps, dr.forward_to(contrib), δL)
 
         return g_em, g_ss, g_st
     
@@ -194,12 +663,17 @@ class RatioVolumetricSensor(VolumetricSensor):
     def __init__(self, props):
         super().__init__(props)
 
-        self.majorant = props['majorant']
+        # Fixed majorant, or 0 to use the extinction of the homogeneous medium
+        # the ray travels through, scaled by 'majorant_scale'
+        self.majorant = props.get('majorant', 0.)
+        self.majorant_scale = props.get('majorant_scale', 2.)
+        if self.majorant_scale < 1.:
+            raise ValueError(f"[{self.__class__.__name__}] The majorant scale must be at least 1.")
 
     def to_string(self):
         return ('RatioVolumetricSensor[\n'
                 f'    to_world = {self.to_world},\n'
-                f'    majorant = {self.majorant},\n'
+                f'    majorant = {self.majorant if self.majorant > 0 else "auto"},\n'
                 ']')
 
     @dr.syntax
@@ -215,17 +689,37 @@ class RatioVolumetricSensor(VolumetricSensor):
                    sampler,
                    active=True,
                    δL=None,
-                   mode=dr.ADMode.Primal
+                   mode=dr.ADMode.Primal,
+                   occupancy=None,
+                   extinction=None
                    ):
         is_primal = (mode == dr.ADMode.Primal)
         is_forward = (mode == dr.ADMode.Forward)
         active = mi.Bool(active)
 
-        n_interactions = mi.Float(0)
+        # Ratio tracking estimate of the transmittance, and its derivative
+        # with respect to the extinction divided by itself
+        tr_est = mi.Spectrum(1.)
+        dlog_tr = mi.Spectrum(0.)
+
+        sigma_t = dr.detach(mei.sigma_t)
+        # Heterogeneous media provide their own majorant grid
+        majorant_grid = extinction.majorants if extinction is not None else None
+        if dr.hint(majorant_grid is not None, mode='scalar'):
+            majorant = mi.Float(0.)
+        elif dr.hint(self.majorant > 0, mode='scalar'):
+            majorant = mi.Float(self.majorant)
+        else:
+            majorant = self.majorant_scale * dr.max(sigma_t)
 
-        # Undo transmittance estimate from previous interactions, since we will recompute it
-        throughput = dr.detach(attenuation * dr.exp(mei.sigma_t * t_prev))
-        throughput *= dr.select(mei.sigma_s != 0, dr.rcp(dr.detach(mei.sigma_s) ** n_scat), 1.)
+        if dr.hint(extinction is not None, mode='scalar'):
+            # Heterogeneous medium: the transmittance estimates of previous
+            # segments are kept, and only the emission is differentiated
+            throughput = dr.detach(attenuation)
+        else:
+            # Undo transmittance estimate from previous interactions, since we will recompute it
+            throughput = dr.detach(attenuation * dr.exp(mei.sigma_t * t_prev))
+            throughput *= dr.select(mei.sigma_s != 0, dr.rcp(dr.detach(mei.sigma_s) ** n_scat), 1.)
 
         if is_forward:
             if dr.grad_enabled(mei.sigma_t):
@@ -237,27 +731,25 @@ class RatioVolumetricSensor(VolumetricSensor):
         g_st = dr.zeros(mi.Spectrum, dr.width(emitted))
         g_ss = dr.zeros(mi.Spectrum, dr.width(emitted))
 
-        grid_res = self.m_film.resolution()
         t = mi.Float(0.)
 
         while dr.hint(active, label="Ratio tracking estimator", exclude=[emitted, mei]):
-            sampled_t = - dr.log(1-sampler.next_1d(active)) / self.majorant
-
-            t[active] += sampled_t
+            tau = - dr.log(1-sampler.next_1d(active))
+            if dr.hint(majorant_grid is not None, mode='scalar'):
+                t_next, majorant = majorant_grid.sample(ray, t, maxt, tau, active)
+                t[active] = t_next
+            else:
+                t[active] += tau / majorant
 
             active &= t < maxt
 
             p = ray(t)
 
-            current_voxel = mi.Vector3i(dr.floor((p - self.bbox.min) / self.voxel_size))
+            current_voxel, is_inside_grid = self.voxel_index(p)
 
-            is_inside_grid = dr.all(current_voxel >= 0) & dr.all(current_voxel < grid_res)
-
-            current_voxel_flat = current_voxel.x + current_voxel.y * grid_res.x + current_voxel.z * grid_res.x * grid_res.y
-            if self.m_film.surface_aware:
-                idx = dr.select(inside_target, 2*current_voxel_flat, 2*current_voxel_flat+1)
-            else:
-                idx = current_voxel_flat
+            if dr.hint(self.m_film.surface_aware and occupancy is not None, mode='scalar'):
+                inside_target = occupancy.eval(p, active)
+            taps = self.film_taps(p, current_voxel, active & is_inside_grid, inside_target)
 
             em = dr.detach(emitted)
             ss = dr.detach(mei.sigma_s)
@@ -271,36 +763,52 @@ class RatioVolumetricSensor(VolumetricSensor):
                     dr.set_grad(st, mei.sigma_t.grad)
                     dr.set_grad(ss, mei.sigma_s.grad)
 
-            sa = st - ss
-            weight = throughput * dr.exp(-st * t_prev)
-            weight *= dr.select(ss != 0, ss ** n_scat, 1.)
-            contrib = dr.select(active & is_inside_grid, weight * em * sa / st * (1 - st / self.majorant) ** n_interactions * st / self.majorant, 0.)
+            if dr.hint(extinction is not None, mode='scalar'):
+                sigma_t = mi.Spectrum(extinction.eval(p, active))
+                contrib = dr.select(active & is_inside_grid, throughput * em * (1 - extinction.albedo) * sigma_t * tr_est / majorant, 0.)
+            else:
+                sa = st - ss
+                weight = throughput * dr.exp(-st * t_prev)
+                weight *= dr.select(ss != 0, ss ** n_scat, 1.)
+                tr = tr_est * dr.exp(dlog_tr * (st - dr.detach(st)))
+                contrib = dr.select(active & is_inside_grid, weight * em * sa / st * tr * st / majorant, 0.)
 
             if dr.hint(is_primal, mode='scalar'):
-                self.m_film.write(contrib, idx, active & is_inside_grid)
+                self.splat(taps, contrib)
             else:
                 if dr.hint(is_forward, mode='scalar'):
                     # Forward-mode AD
-                    dr.scatter_reduce(dr.ReduceOp.Add, δL.array, dr.forward_to(contrib), idx, active & is_inside_grid)
+                    self.splat(taps, dr.forward_to(contrib), δL)
                 else:
                     # Reverse-mode AD
-                    grad = dr.gather(mi.Spectrum, δL.array, idx, active & is_inside_grid)
+                    grad = self.gather(taps, δL)
                     dr.backward_from(contrib * grad)
                     g_em += em.grad
                     g_ss += ss.grad
                     g_st += st.grad
 
-            n_interactions[active] += 1
+            tr_est[active] *= 1 - sigma_t / majorant
+            dlog_tr[active] -= dr.select(majorant > sigma_t, dr.rcp(majorant - sigma_t), 0.)
+            # With the majorant equal to the extinction, only the first interaction contributes
+            active &= dr.any(tr_est != 0)
 
         return g_em, g_ss, g_st
 
 class DDAVolumetricSensor(VolumetricSensor):
+    # Deposit the absorbed energy along the sampled free-flight segment only,
+    # rather than along the whole ray up to the next surface
+    track_length = False
+
     def __init__(self, props):
         super().__init__(props)
+        # Stop the traversal once the transmittance along the ray drops below
+        # this value, 0 to disable
+        self.min_transmittance = props.get('min_transmittance', 0.)
 
     def to_string(self):
         return ('DDAVolumetricSensor[\n'
                 f'    to_world = {self.to_world},\n'
+                f'    min_transmittance = {self.min_transmittance},\n'
                 ']')
 
     @dr.syntax
@@ -316,9 +824,10 @@ class DDAVolumetricSensor(VolumetricSensor):
                    sampler,
                    active=True,
                    δL=None,
-                   mode=dr.ADMode.Primal
+                   mode=dr.ADMode.Primal,
+                   occupancy=None,
+                   extinction=None
                    ):
-        # TODO: use dr.dda here
         active = mi.Bool(active)
 
         is_primal = (mode == dr.ADMode.Primal)
@@ -331,6 +840,10 @@ class DDAVolumetricSensor(VolumetricSensor):
         mint_box = dr.maximum(dr.max(dr.minimum(t_bmin, t_bmax)), 0.)
         maxt_box = dr.min(dr.maximum(t_bmin, t_bmax))
 
+        if dr.hint(self.track_length, mode='scalar'):
+            # Stop at the next collision, if any
+            maxt = dr.minimum(maxt, mei.t)
+
         t_start = dr.maximum(mint_box, 0.)
         t_end = dr.minimum(maxt_box, maxt)
 
@@ -359,14 +872,21 @@ class DDAVolumetricSensor(VolumetricSensor):
         dtmax[dtmax < 0] = dr.inf
         tstep = dr.select(is_valid_dir, self.voxel_size / ray.d * step_dir, dr.inf)
 
+        # With a sparse film, coarse bricks are crossed in a single step
+        sparse = isinstance(self.m_film, SparseFilm)
+
         current_voxel = mi.Vector3i(start_voxel)
         t = mi.Float(t_start)
-        x = mi.Point3f(grid_start)
         remaining_dist = mi.Float(t_end - t_start)
 
-        # Undo transmittance estimate from previous interactions, since we will recompute it
-        throughput = dr.detach(attenuation * dr.exp(mei.sigma_t * t_prev))
-        throughput *= dr.select(mei.sigma_s != 0, dr.rcp(dr.detach(mei.sigma_s) ** n_scat), 1.)
+        if dr.hint(extinction is not None, mode='scalar'):
+            # Heterogeneous medium: the transmittance estimates of previous
+            # segments are kept, and only the emission is differentiated
+            throughput = dr.detach(attenuation)
+        else:
+            # Undo transmittance estimate from previous interactions, since we will recompute it
+            throughput = dr.detach(attenuation * dr.exp(mei.sigma_t * t_prev))
+            throughput *= dr.select(mei.sigma_s != 0, dr.rcp(dr.detach(mei.sigma_s) ** n_scat), 1.)
 
         if dr.hint(is_forward, mode='scalar'):
             if dr.hint(dr.grad_enabled(mei.sigma_t), mode='scalar'):
@@ -378,12 +898,320 @@ class DDAVolumetricSensor(VolumetricSensor):
         g_ss = mi.Spectrum(0.)
         g_st = mi.Spectrum(0.)
 
-        em = dr.detach(emitted)
+        # In primal mode, the absorption in each voxel is the loop-invariant
+        # factor 'scale' times the drop in transmittance across the voxel. With
+        # the track-length estimator, the probability of reaching each point of
+        # the free-flight segment cancels out its transmittance, so it is
+        # 'scale' times the length of the segment in the voxel instead.
+        sigma_t = dr.detach(mei.sigma_t)
+        sigma_s = dr.detach(mei.sigma_s)
+        scale = throughput * dr.exp(-sigma_t * t_prev) * dr.select(sigma_s != 0, sigma_s ** n_scat, 1.) * (sigma_t - sigma_s) * dr.detach(emitted)
+        if dr.hint(not self.track_length, mode='scalar'):
+            scale /= sigma_t
+        tr = dr.exp(-sigma_t * t)
+
+        if dr.hint(extinction is not None, mode='scalar'):
+            # Heterogeneous medium: the transmittance up to the grid is
+            # estimated by ratio tracking, and the extinction is taken constant
+            # within each voxel, at the midpoint of the segment, so that the
+            # absorption is still integrated analytically
+            scale = throughput * (1 - extinction.albedo)
+            tr = extinction.transmittance(ray, 0., t, sampler, active)
 
         while dr.hint(active, label="DDA", exclude=[emitted, mei]):
 
-            dt = dr.minimum(dr.min(dtmax), remaining_dist)
+            if dr.hint(sparse, mode='scalar'):
+                # Distance to the exit of the current cell
+                lo, size = self.m_film.cell_bounds(current_voxel, active)
+                boundary = self.voxel_to_world(mi.Vector3f(dr.select(ray.d > 0, lo + size, lo)))
+                t_axis = dr.select(is_valid_dir, (boundary - ray.o) / ray.d, dr.inf)
+                dt = dr.minimum(dr.maximum(dr.min(t_axis) - t, 0.), remaining_dist)
+            else:
+                dt = dr.minimum(dr.min(dtmax), remaining_dist)
             remaining_dist[active] -= dt
+            midpoint = ray(t + 0.5 * dt)
+            if dr.hint(extinction is not None, mode='scalar'):
+                sigma_t = mi.Spectrum(extinction.eval(midpoint, active))
+                tr_next = tr * dr.exp(-sigma_t * dr.maximum(dt, 0.))
+            else:
+                tr_next = dr.exp(-sigma_t * (t + dr.maximum(dt, 0.)))
+
+            if dr.hint(extinction is not None, mode='scalar'):
+                em = dr.detach(emitted)
+                if dr.hint(not is_primal, mode='scalar'):
+                    dr.set_grad_enabled(em, dr.grad_enabled(emitted))
+                    if dr.hint(is_forward, mode='scalar'):
+                        dr.set_grad(em, emitted.grad)
+                if dr.hint(self.track_length, mode='scalar'):
+                    contrib = dr.select(active, scale * em * sigma_t * dr.maximum(dt, 0.), 0.)
+                else:
+                    contrib = dr.select(active, scale * em * (tr - tr_next), 0.)
+            elif dr.hint(is_primal and self.track_length, mode='scalar'):
+                contrib = dr.select(active, scale * dr.maximum(dt, 0.), 0.)
+            elif dr.hint(is_primal, mode='scalar'):
+                # Compute analytic absorption along the ray within the current voxel
+                contrib = dr.select(active, scale * (tr - tr_next), 0.)
+            else:
+                st = dr.detach(mei.sigma_t)
+                ss = dr.detach(mei.sigma_s)
+                em = dr.detach(emitted)
+                dr.set_grad_enabled(em, dr.grad_enabled(emitted))
+                dr.set_grad_enabled(ss, dr.grad_enabled(mei.sigma_s))
+                dr.set_grad_enabled(st, dr.grad_enabled(mei.sigma_t))
+                if dr.hint(is_forward, mode='scalar'):
+                    dr.set_grad(em, emitted.grad)
+                    dr.set_grad(ss, mei.sigma_s.grad)
+                    dr.set_grad(st, mei.sigma_t.grad)
+
+                sa = st - ss
+                weight = throughput * dr.exp(-st * t_prev)
+                weight *= dr.select(ss != 0, ss ** n_scat, 1.)
+                if dr.hint(self.track_length, mode='scalar'):
+                    # Differentiate the transmittance at the midpoint of the segment, the sampling pdf is detached
+                    tr_mid = dr.exp(-st * (t + 0.5 * dr.maximum(dt, 0.)))
+                    contrib = dr.select(active, weight * sa * em * dr.maximum(dt, 0.) * tr_mid / dr.detach(tr_mid), 0.)
+                else:
+                    # Compute analytic absorption along the ray within the current voxel
+                    contrib = dr.select(active, weight * sa / st * em * dr.exp(-st*t) * (1 - dr.exp(-st * dr.maximum(dt, 0.))), 0.)
+            if dr.hint(self.m_film.surface_aware and occupancy is not None, mode='scalar'):
+                # Classify the segment within the voxel by its midpoint
+                inside_target = occupancy.eval(midpoint, active)
+            taps = self.film_taps(midpoint, current_voxel, active, inside_target)
+
+            if dr.hint(is_primal, mode='scalar'):
+                self.splat(taps, contrib)
+            else:
+                if dr.hint(is_forward, mode='scalar'):
+                    # Forward-mode AD
+                    self.splat(taps, dr.forward_to(contrib), δL)
+                else:
+                    # Reverse-mode AD
+                    grad = self.gather(taps, δL)
+                    dr.backward_from(contrib * grad)
+                    g_em += em.grad
+                    if dr.hint(extinction is None, mode='scalar'):
+                        g_ss += ss.grad
+                        g_st += st.grad
+
+            active &= dr.any(end_voxel != current_voxel) & (remaining_dist > 1e-6)
+            if dr.hint(self.min_transmittance > 0 and not self.track_length, mode='scalar'):
+                # The remaining voxels would only receive a negligible dose
+                active &= dr.any(tr_next >= self.min_transmittance)
+
+            if dr.hint(sparse, mode='scalar'):
+                # Step into the neighboring cell through the exit face(s), the
+                # other coordinates are those of the exit point
+                exit_axis = t_axis == dr.min(t_axis)
+                inner = dr.clip(mi.Vector3i(dr.floor((ray(t + dt) - self.bbox.min) / self.voxel_size)), lo, lo + size - 1)
+                current_voxel[active] = dr.select(exit_axis, dr.select(ray.d > 0, lo + size, lo - 1), inner)
+            else:
+                mask = dtmax == dt
+                dtmax = dr.select(mask, tstep, dtmax - dt)
+                voxel_update = dr.select(mask, step_dir, 0)
+
+                current_voxel[active] += voxel_update
+
+            active &= dr.all(current_voxel >= 0) & dr.all(current_voxel < grid_res)
+
+            t[active] += dt
+            tr[active] = tr_next
+
+        return g_em, g_ss, g_st
+
+class HybridVolumetricSensor(DDAVolumetricSensor):
+    """
+    Track-length estimator for scattering media: scattering is handled by
+    delta tracking in the integrator, and the absorbed energy is deposited
+    analytically along each free-flight segment, through the voxels it
+    crosses. Unlike the DDA sensor, rays are only traversed up to their next
+    collision.
+    """
+    track_length = True
+
+    def to_string(self):
+        return ('HybridVolumetricSensor[\n'
+                f'    to_world = {self.to_world},\n'
+                ']')
+
+def cylindrical_grid(base):
+    """
+    Subclass of the sensor class 'base' using a cylindrical grid. Sensors
+    derive from Mitsuba's nanobind Sensor class, which only supports single
+    inheritance, so the cylindrical grid is added on top of each sensor type
+    rather than as a mixin.
+    """
+    class CylindricalGrid(base):
+        """
+        Base for sensors with a CylindricalFilm. The voxels of the film subdivide
+        the cylinder inscribed in the bounding box of the sensor, with uniform
+        steps in radius, angle and height. They are indexed by (r, theta, z)
+        instead of (x, y, z).
+        """
+        def __init__(self, props):
+            super().__init__(props)
+            if not isinstance(self.m_film, CylindricalFilm):
+                raise ValueError(f"[{self.__class__.__name__}] Cylindrical sensors require a film of type CylindricalFilm.")
+            if self.volume_estimator != 'sampling':
+                raise ValueError(f"[{self.__class__.__name__}] Only the 'sampling' volume estimator is supported with cylindrical sensors.")
+            if self.m_film.filter != 'box':
+                raise ValueError(f"[{self.__class__.__name__}] Only the 'box' filter is supported with cylindrical sensors.")
+
+            extents = self.bbox.extents()
+            self.center = 0.5 * (self.bbox.min + self.bbox.max)
+            self.radius = 0.5 * dr.minimum(extents.x, extents.y)
+            res = self.m_film.resolution()
+            # Radial, angular and vertical step sizes
+            self.cell_size = mi.Vector3f(self.radius / res.x, dr.two_pi / res.y, extents.z / res.z)
+
+        def voxel_index(self, p):
+            d = p - self.center
+            r = dr.sqrt(dr.square(d.x) + dr.square(d.y))
+            theta = dr.atan2(d.y, d.x) + dr.pi
+            res = self.m_film.resolution()
+            voxel = mi.Vector3i(dr.floor(mi.Vector3f(r, theta, p.z - self.bbox.min.z) / self.cell_size))
+            # theta = pi belongs to the first angular sector
+            voxel.y[voxel.y == res.y] = 0
+            return voxel, dr.all(voxel >= 0) & dr.all(voxel < res)
+
+        def voxel_to_world(self, coords):
+            # Warp the radius, so that uniform coordinates within a voxel are
+            # uniformly distributed in its volume
+            i = dr.floor(coords.x)
+            r = self.cell_size.x * dr.sqrt(dr.square(i) + (coords.x - i) * (2 * i + 1))
+            theta = coords.y * self.cell_size.y - dr.pi
+            return mi.Point3f(self.center.x + r * dr.cos(theta),
+                              self.center.y + r * dr.sin(theta),
+                              self.bbox.min.z + coords.z * self.cell_size.z)
+
+        def cell_volume(self):
+            res = self.m_film.resolution()
+            i = self.voxel_coords(dr.arange(mi.UInt32, dr.prod(res))).x
+            return (i + 0.5) * dr.square(self.cell_size.x) * self.cell_size.y * self.cell_size.z
+
+        def compute_volume(self, scene: mi.Scene, sample_count=2**14):
+            if dr.hint(not self.m_film.surface_aware, mode='scalar'):
+                # Voxel volumes grow with the radius
+                return mi.TensorXf(self.cell_volume(), shape=self.m_film.data.shape)
+            return super().compute_volume(scene, sample_count)
+
+        def voxel_exit(self, ray, voxel, t):
+            """
+            Distance along the rays at which they leave the given voxels, assuming
+            that they are inside of them at distance 't'
+            """
+            t_exit = mi.Float(dr.inf)
+            o = ray.o - self.center
+
+            # Planes of constant height
+            for k in range(2):
+                z = self.bbox.min.z + (voxel.z + k) * self.cell_size.z
+                t_z = (z - ray.o.z) / ray.d.z
+                t_exit[t_z > t] = dr.minimum(t_exit, t_z)
+
+            # Cylinders of constant radius
+            a = dr.square(ray.d.x) + dr.square(ray.d.y)
+            b = o.x * ray.d.x + o.y * ray.d.y
+            for k in range(2):
+                r = (voxel.x + k) * self.cell_size.x
+                disc = dr.square(b) - a * (dr.square(o.x) + dr.square(o.y) - dr.square(r))
+                sqrt_disc = dr.safe_sqrt(disc)
+                for t_r in ((-b - sqrt_disc) / a, (-b + sqrt_disc) / a):
+                    t_exit[(disc >= 0) & (a > 0) & (t_r > t)] = dr.minimum(t_exit, t_r)
+
+            # Half-planes of constant angle
+            for k in range(2):
+                theta = (voxel.y + k) * self.cell_size.y - dr.pi
+                s, c = dr.sincos(theta)
+                denom = c * ray.d.y - s * ray.d.x
+                t_theta = (s * o.x - c * o.y) / denom
+                # Discard intersections with the opposite half-plane
+                p = o + t_theta * ray.d
+                valid = (denom != 0) & (t_theta > t) & (c * p.x + s * p.y >= 0)
+                t_exit[valid] = dr.minimum(t_exit, t_theta)
+
+            return t_exit
+
+    return CylindricalGrid
+
+class CylindricalDeltaVolumetricSensor(cylindrical_grid(DeltaVolumetricSensor)):
+    def to_string(self):
+        return ('CylindricalDeltaVolumetricSensor[\n'
+                f'    to_world = {self.to_world},\n'
+                ']')
+
+class CylindricalRatioVolumetricSensor(cylindrical_grid(RatioVolumetricSensor)):
+    def to_string(self):
+        return ('CylindricalRatioVolumetricSensor[\n'
+                f'    to_world = {self.to_world},\n'
+                f'    majorant = {self.majorant if self.majorant > 0 else "auto"},\n'
+                ']')
+
+class CylindricalDDAVolumetricSensor(cylindrical_grid(VolumetricSensor)):
+    """
+    Analytic absorption along the rays, accumulated voxel by voxel in the
+    cylindrical grid. Each step jumps to the nearest boundary of the current
+    voxel (a plane of constant height or angle, or a cylinder of constant
+    radius), and the next voxel is found from a point slightly past it.
+    """
+    def to_string(self):
+        return ('CylindricalDDAVolumetricSensor[\n'
+                f'    to_world = {self.to_world},\n'
+                ']')
+
+    @dr.syntax
+    def accumulate(self,
+                   ray,
+                   emitted,
+                   inside_target,
+                   attenuation,
+                   t_prev,
+                   n_scat,
+                   maxt,
+                   mei,
+                   sampler,
+                   active=True,
+                   δL=None,
+                   mode=dr.ADMode.Primal,
+                   occupancy=None,
+                   extinction=None
+                   ):
+        if dr.hint(extinction is not None, mode='scalar'):
+            raise ValueError(f"[{self.__class__.__name__}] Heterogeneous media are not supported by the cylindrical DDA sensor.")
+        active = mi.Bool(active)
+
+        is_primal = (mode == dr.ADMode.Primal)
+        is_forward = (mode == dr.ADMode.Forward)
+
+        # Find intersection with the bounding box of the volume grid
+        t_bmin = (self.bbox.min - ray.o) / ray.d
+        t_bmax = (self.bbox.max - ray.o) / ray.d
+
+        t = dr.maximum(dr.max(dr.minimum(t_bmin, t_bmax)), 0.)
+        t_end = dr.minimum(dr.min(dr.maximum(t_bmin, t_bmax)), maxt)
+
+        active &= dr.isfinite(t) & dr.isfinite(t_end) & (t < t_end)
+
+        # Offset used to find the voxel past a boundary
+        eps = 1e-4 * dr.minimum(self.cell_size.x, self.cell_size.z)
+        current_voxel, is_inside_grid = self.voxel_index(ray(t + eps))
+
+        # Undo transmittance estimate from previous interactions, since we will recompute it
+        throughput = dr.detach(attenuation * dr.exp(mei.sigma_t * t_prev))
+        throughput *= dr.select(mei.sigma_s != 0, dr.rcp(dr.detach(mei.sigma_s) ** n_scat), 1.)
+
+        if dr.hint(is_forward, mode='scalar'):
+            if dr.hint(dr.grad_enabled(mei.sigma_t), mode='scalar'):
+                dr.forward_to(mei.sigma_t, mei.sigma_s)
+            elif dr.hint(dr.grad_enabled(mei.sigma_s), mode='scalar'):
+                dr.forward_to(mei.sigma_s)
+
+        g_em = dr.zeros(mi.Float, dr.width(emitted))
+        g_ss = mi.Spectrum(0.)
+        g_st = mi.Spectrum(0.)
+
+        while dr.hint(active, label="Cylindrical DDA", exclude=[emitted, mei]):
+            t_next = dr.minimum(dr.maximum(self.voxel_exit(ray, current_voxel, t), t + eps), t_end)
+            dt = t_next - t
 
             st = dr.detach(mei.sigma_t)
             ss = dr.detach(mei.sigma_s)
@@ -401,45 +1229,39 @@ class DDAVolumetricSensor(VolumetricSensor):
             weight = throughput * dr.exp(-st * t_prev)
             weight *= dr.select(ss != 0, ss ** n_scat, 1.)
             # Compute analytic absorption along the ray within the current voxel
-            contrib = dr.select(active, weight * sa / st * em * dr.exp(-st*t) * (1 - dr.exp(-st * dr.maximum(dt, 0.))), 0.)
-            current_voxel_flat = current_voxel.x + current_voxel.y * grid_res.x + current_voxel.z * grid_res.x * grid_res.y
-            if self.m_film.surface_aware:
-                idx = dr.select(inside_target, 2*current_voxel_flat, 2*current_voxel_flat+1)
-            else:
-                idx = current_voxel_flat
+            write = active & is_inside_grid
+            contrib = dr.select(write, weight * sa / st * em * dr.exp(-st*t) * (1 - dr.exp(-st * dt)), 0.)
+            midpoint = ray(t + 0.5 * dt)
+            if dr.hint(self.m_film.surface_aware and occupancy is not None, mode='scalar'):
+                # Classify the segment within the voxel by its midpoint
+                inside_target = occupancy.eval(midpoint, active)
+            taps = self.film_taps(midpoint, current_voxel, write, inside_target)
 
             if dr.hint(is_primal, mode='scalar'):
-                self.m_film.write(contrib, idx, active)
+                self.splat(taps, contrib)
             else:
                 if dr.hint(is_forward, mode='scalar'):
                     # Forward-mode AD
-                    dr.scatter_reduce(dr.ReduceOp.Add, δL.array, dr.forward_to(contrib), idx, active)
+                    self.splat(taps, dr.forward_to(contrib), δL)
                 else:
                     # Reverse-mode AD
-                    grad = dr.gather(mi.Spectrum, δL.array, idx, active)
+                    grad = self.gather(taps, δL)
                     dr.backward_from(contrib * grad)
                     g_em += em.grad
                     g_ss += ss.grad
                     g_st += st.grad
 
-                em = dr.detach(em)
-
-            active &= dr.any(end_voxel != current_voxel) & (remaining_dist > 1e-6)
-
-            voxel_update = mi.Vector3i()
-            mask = dtmax == dt
-            dtmax = dr.select(mask, tstep, dtmax - dt)
-            voxel_update = dr.select(mask, step_dir, 0)
-
-            current_voxel[active] += voxel_update
-
-            active &= dr.all(current_voxel >= 0) & dr.all(current_voxel < grid_res)
-
-            t[active] += dt
+            t[active] = t_next
+            active &= t < t_end
+            current_voxel, is_inside_grid = self.voxel_index(ray(t + eps))
 
         return g_em, g_ss, g_st
 
 mi.register_sensor('delta', DeltaVolumetricSensor)
 mi.register_sensor('ratio', RatioVolumetricSensor)
 mi.register_sensor('dda', DDAVolumetricSensor)
+mi.register_sensor('hybrid', HybridVolumetricSensor)
+mi.register_sensor('cylindrical_delta', CylindricalDeltaVolumetricSensor)
+mi.register_sensor('cylindrical_ratio', CylindricalRatioVolumetricSensor)
+mi.register_sensor('cylindrical_dda', CylindricalDDAVolumetricSensor)
 
@@ -1,9 +1,11 @@
 import mitsuba as mi
 import drjit as dr
 import os
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
+from .film import CylindricalFilm, SparseFilm, MaskedFilm
 
 def iou_loss(pred, target, threshold=0.9):
     obj_mask = target.array > 0.
@@ -45,6 +47,20 @@ def save_vol(vol, path):
     bmp = mi.Bitmap(mi.TensorXf(reshape_grid(vol)))
     bmp.write(path)
 
+def save_cells(film, tensor, path):
+    """
+    Save a tensor with the layout of the data of a sparse or masked film, along
+    with the integer coordinates of the first voxel of each cell and their
+    number of voxels per side, without expanding it to a dense grid.
+    """
+    lo, size = film.cells()
+    res = film.resolution()
+    np.savez_compressed(path,
+                        values=tensor.numpy(),
+                        lo=np.stack((lo.x.numpy(), lo.y.numpy(), lo.z.numpy()), axis=-1).astype(np.int32),
+                        size=size.numpy().astype(np.int32),
+                        resolution=np.array([res.x, res.y, res.z]))
+
 def save_histogram(vol, target, filename, efficiency, max_pattern_intensity):
     fig = plt.figure(figsize=(10, 5))
     obj_mask = target.numpy().flatten() > 0.
@@ -80,14 +96,12 @@ def save_histogram(vol, target, filename, efficiency, max_pattern_intensity):
     plt.legend()
     plt.savefig(filename)
 
-def discretize(scene, sensor=0):
+def get_target(scene):
     """
-    Given a scene containing a target shape, this function converts
-    it to a binary occupancy grid, to be used as the reference for optimization.
+    Find the target shape of a scene, and return it along with a scene
+    containing only the target, to be used for inside/outside queries. The
+    input scene is reused if it does not contain any other shape.
     """
-    if isinstance(sensor, int):
-        sensor = scene.sensors()[sensor]
-
     target_shape = None
     for shape in scene.shapes():
         if dr.hint(shape.id() == 'target', mode='scalar'):
@@ -95,22 +109,70 @@ def discretize(scene, sensor=0):
     if target_shape is None:
         raise ValueError("No target shape found in the scene")
 
-    bbox = target_shape.bbox()
+    if len(scene.shapes()) == 1:
+        return scene, target_shape
 
     target_scene = mi.load_dict({
         'type': 'scene',
         'target': target_shape,
     })
+    return target_scene, target_shape
+
+def build_scene(scene, shapes={}, exclude=()):
+    """
+    Build a new scene from the shapes, emitters and sensors of an existing
+    one, plus the additional 'shapes', except for the objects whose ID is in
+    'exclude'. Objects are shared between both scenes, so only the acceleration
+    structure is rebuilt.
+    """
+    scene_dict = {'type': 'scene'}
+    for obj in scene.shapes() + scene.emitters() + scene.sensors():
+        if obj.id() not in exclude:
+            scene_dict[obj.id()] = obj
+    return mi.load_dict(scene_dict | shapes)
+
+def discretize(scene, sensor=0, method='ray', n_votes=3):
+    """
+    Given a scene containing a target shape, this function converts
+    it to a binary occupancy grid, to be used as the reference for optimization.
+
+    With method='ray', each voxel is classified with one random ray from its
+    center. With method='scanline', one ray is traced along z per column of
+    voxels, and voxels are filled according to the crossings below their
+    center. Each column is traced 'n_votes' times with a jittered ray, and
+    voxels are classified by majority vote.
 
+    With a sparse or masked film, the grid has the layout of the film data.
+    With method='ray', each cell is then classified at its center, so no dense
+    grid is built.
+    """
+    if isinstance(sensor, int):
+        sensor = scene.sensors()[sensor]
+
+    target_scene, target_shape = get_target(scene)
+
+    film = sensor.film()
+    compact = isinstance(film, (SparseFilm, MaskedFilm))
+    if method == 'scanline':
+        voxels = discretize_scanline(target_scene, target_shape, sensor, n_votes)
+        return film.compact(voxels) if compact else voxels
+    elif method != 'ray':
+        raise ValueError(f"Unknown discretization method: '{method}'")
+
+    bbox = target_shape.bbox()
     res = sensor.resolution()
-    voxel_size = sensor.bbox.extents() / mi.Vector3f(res.x, res.y, res.z)
 
-    xx = dr.arange(mi.Float, res.x)
-    yy = dr.arange(mi.Float, res.y)
-    zz = dr.arange(mi.Float, res.z)
-    z_idx, y_idx, x_idx = dr.meshgrid(zz, yy, xx, indexing='ij')
+    if compact:
+        # Coarse cells of a sparse film are not crossed by the target surface
+        lo, size = film.cells()
+        pos = sensor.voxel_to_world(lo + 0.5 * size)
+    else:
+        xx = dr.arange(mi.Float, res.x)
+        yy = dr.arange(mi.Float, res.y)
+        zz = dr.arange(mi.Float, res.z)
+        z_idx, y_idx, x_idx = dr.meshgrid(zz, yy, xx, indexing='ij')
 
-    pos = sensor.bbox.min + (0.5 + mi.Point3f(x_idx, y_idx, z_idx)) * voxel_size
+        pos = sensor.voxel_to_world(0.5 + mi.Point3f(x_idx, y_idx, z_idx))
 
     sampler = mi.load_dict({'type': 'independent'})
     sampler.seed(0, dr.width(pos))
@@ -122,11 +184,299 @@ def discretize(scene, sensor=0):
 
     inside = si.is_valid() & (si.shape == mi.ShapePtr(target_shape)) & (dr.dot(si.n, ray.d) > 0)
 
-    voxels = dr.zeros(mi.TensorXf, shape=(res.z, res.y, res.x, 1))
+    voxels = dr.zeros(mi.TensorXf, shape=(dr.width(pos), 1) if compact else (res.z, res.y, res.x, 1))
     voxels.array[inside] = 1.0
 
     return voxels
 
+@dr.syntax
+def discretize_scanline(target_scene, target_shape, sensor, n_votes=3, jitter=0.5):
+    """
+    Scanline voxelization of the target: rays are traced along +z through each
+    column of voxels, and the winding number given by the orientation of the
+    surface at each crossing determines whether the voxel centers between two
+    crossings are inside. The ray position is jittered by up to 'jitter' voxels
+    around the center of the column, and each voxel is classified by majority
+    vote among the 'n_votes' rays of its column.
+    """
+    bbox = target_shape.bbox()
+    res = sensor.resolution()
+    voxel_size = sensor.bbox.extents() / mi.Vector3f(res.x, res.y, res.z)
+
+    idx = dr.arange(mi.UInt32, res.x * res.y * n_votes)
+    column = idx // n_votes
+    x_idx = column % res.x
+    y_idx = column // res.x
+
+    sampler = mi.load_dict({'type': 'independent'})
+    sampler.seed(0, dr.width(idx))
+    offset = 0.5 + jitter * (sampler.next_2d() - 0.5)
+    pos = sensor.voxel_to_world(mi.Point3f(mi.Float(x_idx) + offset.x, mi.Float(y_idx) + offset.y, 0.))
+
+    d = mi.Vector3f(0., 0., 1.)
+    def next_crossing(o, active):
+        si = target_scene.ray_intersect(mi.Ray3f(o, d), active=active)
+        return dr.select(si.is_valid(), si.p.z, dr.inf), si.n.z, si.spawn_ray(d).o
+
+    # Start below both the target and the grid
+    o = mi.Point3f(pos.x, pos.y, dr.minimum(bbox.min.z, sensor.bbox.min.z) - 1.)
+    active = (pos.x > bbox.min.x) & (pos.x < bbox.max.x) & (pos.y > bbox.min.y) & (pos.y < bbox.max.y)
+    next_z, next_nz, o = next_crossing(o, active)
+
+    votes = dr.zeros(mi.UInt32, res.x * res.y * res.z)
+    winding = mi.Int32(0)
+    k = mi.UInt32(0)
+    while active:
+        z_center = sensor.bbox.min.z + (mi.Float(k) + 0.5) * voxel_size.z
+        crossing = active & (next_z <= z_center)
+
+        # Entering the surface increases the winding number, leaving decreases it
+        winding[crossing] += dr.select(next_nz < 0, mi.Int32(1), mi.Int32(-1))
+        z_new, nz_new, o_new = next_crossing(o, crossing)
+        next_z[crossing] = z_new
+        next_nz[crossing] = nz_new
+        o[crossing] = o_new
+
+        # All crossings below the center of the current voxel were processed
+        record = active & ~crossing
+        dr.scatter_reduce(dr.ReduceOp.Add, votes, 1, x_idx + y_idx * res.x + k * res.x * res.y, record & (winding > 0))
+        k[record] += 1
+        active &= k < res.z
+
+    voxels = dr.zeros(mi.TensorXf, shape=(res.z, res.y, res.x, 1))
+    voxels.array[2 * votes > n_votes] = 1.0
+
+    return voxels
+
+# File formats that are loaded as voxel grids rather than meshes
+volume_formats = ('npy', 'raw', 'tif', 'tiff')
+
+def is_volume_file(filename):
+    return os.path.splitext(filename)[1][1:].lower() in volume_formats
+
+def load_volume(config):
+    """
+    Memory-map the voxel grid of a volume target, as a (z, y, x, c) array.
+    With a single channel, the values are the fraction of each voxel that is
+    inside the target (i.e. 0 or 1 for a binary mask). With two channels, they
+    are the inside and outside fractions of each voxel.
+    """
+    filename = config['filename']
+    ext = os.path.splitext(filename)[1][1:].lower()
+    if ext == 'npy':
+        data = np.load(filename, mmap_mode='r')
+    elif ext == 'raw':
+        if 'shape' not in config:
+            raise ValueError("Loading a raw volume requires its 'shape' to be specified, as [z, y, x] or [z, y, x, c].")
+        data = np.memmap(filename, dtype=config.get('dtype', 'uint8'), mode='r', shape=tuple(config['shape']))
+    elif ext in ('tif', 'tiff'):
+        try:
+            import tifffile
+        except ImportError:
+            raise ImportError("Loading TIFF stacks requires the 'tifffile' package.")
+        try:
+            data = tifffile.memmap(filename, mode='r')
+        except ValueError:
+            # Compressed files cannot be memory-mapped
+            data = tifffile.imread(filename)
+    else:
+        raise ValueError(f"Unsupported volume format: '{ext}'")
+
+    if data.ndim == 3:
+        data = data[..., None]
+    if data.ndim != 4 or data.shape[-1] > 2:
+        raise ValueError(f"Invalid volume shape: {data.shape}. Expected (z, y, x), or (z, y, x, c) with 1 or 2 channels.")
+
+    return data
+
+def resample_volume(data, bbox_min, bbox_max, res, grid_min, grid_max, filter='nearest'):
+    """
+    Resample the inside fraction of the voxel grid 'data', spanning
+    [bbox_min, bbox_max], at the voxel centers of a grid of resolution 'res'
+    spanning [grid_min, grid_max]. Points and resolutions are given in (x, y, z)
+    order. The grid is axis-aligned, so the filter is separable, and slices of
+    'data' are only read when they are needed.
+    """
+    if filter not in ('nearest', 'linear'):
+        raise ValueError(f"Invalid volume filter: '{filter}'")
+
+    shape = data.shape[2::-1]
+    taps = []
+    for i in range(3):
+        centers = grid_min[i] + (np.arange(res[i]) + 0.5) * (grid_max[i] - grid_min[i]) / res[i]
+        # Continuous coordinates in the input grid, in voxel units
+        u = (centers - bbox_min[i]) / (bbox_max[i] - bbox_min[i]) * shape[i]
+        if filter == 'nearest':
+            axis_taps = [(np.floor(u).astype(np.int64), np.ones_like(u))]
+        else:
+            i0 = np.floor(u - 0.5).astype(np.int64)
+            w = u - 0.5 - i0
+            axis_taps = [(i0, 1 - w), (i0 + 1, w)]
+        # Samples outside of the input grid are outside of the target
+        taps.append([(np.clip(j, 0, shape[i] - 1), np.where((j >= 0) & (j < shape[i]), w, 0.)) for j, w in axis_taps])
+
+    def fraction(plane):
+        plane = np.asarray(plane, dtype=np.float32)
+        if plane.shape[-1] == 2:
+            total = plane[..., 0] + plane[..., 1]
+            return np.divide(plane[..., 0], total, out=np.zeros_like(total), where=total > 0)
+        return plane[..., 0]
+
+    out = np.zeros((res[2], res[1], res[0]), dtype=np.float32)
+    for k in range(res[2]):
+        for iz, wz in taps[2]:
+            if wz[k] == 0:
+                continue
+            plane = fraction(data[iz[k]])
+            for iy, wy in taps[1]:
+                for ix, wx in taps[0]:
+                    out[k] += wz[k] * (wy[:, None] * wx[None, :]) * plane[np.ix_(iy, ix)]
+
+    return out
+
+def volume_bbox(config, shape=None):
+    """
+    Bounding box of a voxel grid target in the scene, as (min, max) arrays in
+    (x, y, z) order. The grid is placed like a target mesh, i.e. scaled to
+    'size' along its largest axis (or to the given 'voxel_size') and centered at
+    the 'box_center_*' coordinates.
+    """
+    if shape is None:
+        shape = load_volume(config).shape
+    shape = np.array(shape[2::-1])
+    voxel_size = config.get('voxel_size', config.get('size', 1.) / np.max(shape))
+    center = np.array([config.get('box_center_x', 0.), config.get('box_center_y', 0.), config.get('box_center_z', 0.)])
+    return center - 0.5 * shape * voxel_size, center + 0.5 * shape * voxel_size
+
+def volume_target(config, sensor, filter=None):
+    """
+    Compute the target of the optimization from a voxel grid rather than a
+    mesh, resampled onto the film of the sensor.
+    """
+    if isinstance(sensor.film(), CylindricalFilm):
+        raise ValueError("Voxel grid targets cannot be resampled onto a cylindrical film.")
+
+    data = load_volume(config)
+    bbox_min, bbox_max = volume_bbox(config, data.shape)
+
+    res = sensor.resolution()
+    res = (res.x, res.y, res.z)
+    grid_min = sensor.bbox.min.numpy().ravel()
+    grid_max = sensor.bbox.max.numpy().ravel()
+
+    surface_aware = sensor.film().surface_aware
+    if filter is None:
+        # Fractional volumes are interpolated, binary occupancy is not
+        filter = config.get('filter', 'linear' if surface_aware else 'nearest')
+
+    frac_in = resample_volume(data, bbox_min, bbox_max, res, grid_min, grid_max, filter)
+
+    if surface_aware:
+        voxel_vol = np.prod((grid_max - grid_min) / np.array(res))
+        return mi.TensorXf(np.stack((frac_in * voxel_vol, (1 - frac_in) * voxel_vol), axis=-1))
+
+    return mi.TensorXf((frac_in >= 0.5).astype(np.float32)[..., None])
+
+def mesh_arrays(mesh):
+    """
+    Vertex positions and faces of a Mitsuba mesh, as (n, 3) numpy arrays
+    """
+    params = mi.traverse(mesh)
+    return params['vertex_positions'].numpy().reshape(-1, 3), params['faces'].numpy().reshape(-1, 3)
+
+def mesh_from_arrays(vertices, faces, name='mesh'):
+    mesh = mi.Mesh(name, vertex_count=len(vertices), face_count=len(faces))
+    params = mi.traverse(mesh)
+    params['vertex_positions'] = mi.Float(vertices.astype(np.float32).ravel())
+    params['faces'] = mi.UInt32(faces.astype(np.uint32).ravel())
+    params.update()
+    return mesh
+
+def simplify_mesh(vertices, faces, tolerance):
+    """
+    Decimate a triangle mesh by vertex clustering. Vertices are merged with
+    the other vertices of their cell in a grid of diagonal 'tolerance', so no
+    vertex moves by more than 'tolerance'. Collapsed faces, and pairs of faces
+    folded onto each other, are removed.
+    """
+    h = tolerance / np.sqrt(3)
+    cells = np.floor((vertices - vertices.min(axis=0)) / h).astype(np.int64)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+
+    clustered = np.zeros((len(counts), 3))
+    np.add.at(clustered, cluster, vertices)
+    clustered /= counts[:, None]
+
+    faces = cluster[faces]
+    faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+    # Start each face at its smallest index, preserving its orientation, to merge duplicates
+    first = np.argmin(faces, axis=1)
+    faces = np.unique(faces[np.arange(len(faces))[:, None], (first[:, None] + np.arange(3)) % 3], axis=0)
+    # Remaining faces sharing the same vertices have opposite orientations, i.e. they are folded onto each other
+    _, face_idx, face_counts = np.unique(np.sort(faces, axis=1), axis=0, return_inverse=True, return_counts=True)
+    faces = faces[face_counts[face_idx.ravel()] == 1]
+
+    # Remove unreferenced vertices
+    used = np.unique(faces)
+    remap = np.zeros(len(clustered), dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    return clustered[used], remap[faces]
+
+def file_hash(filename, *args):
+    """
+    Hash of the contents of a file and of additional parameters, used to
+    identify cached results derived from it
+    """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    h.update(repr(args).encode())
+    return h.hexdigest()[:16]
+
+def load_mesh(filename, **kwargs):
+    return mi.load_dict({
+        'type': os.path.splitext(filename)[1][1:],
+        'filename': filename
+    } | kwargs)
+
+def cached_mesh_file(filename, cache_dir, load_fn=None, key=(), suffix=''):
+    """
+    Cache a mesh derived from a mesh file as a binary PLY file, which is much
+    faster to load than text PLY or OBJ files, and return its path. The cache
+    entry is keyed by the contents of the file and 'key', which should contain
+    all the parameters of 'load_fn' that affect the result, e.g. a transform.
+    'load_fn' defaults to loading the file as is.
+    """
+    path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(filename))[0]}{suffix}_{file_hash(filename, *key)}.ply")
+    if os.path.exists(path):
+        return path
+
+    mesh = load_fn() if load_fn is not None else load_mesh(filename)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so that concurrent runs never read a partial file
+    tmp_path = f"{path}.{os.getpid()}.tmp.ply"
+    mesh.write_ply(tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+def simplified_mesh_file(filename, tolerance, cache_dir, load_fn=None, key=()):
+    """
+    Simplify a mesh file to the given tolerance, and return the path of the
+    simplified mesh, which is cached in 'cache_dir'. 'load_fn' loads the mesh
+    to simplify, e.g. to apply a transform first (which should then be part of
+    the key).
+    """
+    def simplify():
+        mesh = load_fn() if load_fn is not None else load_mesh(filename)
+        vertices, faces = simplify_mesh(*mesh_arrays(mesh), tolerance)
+        mi.Log(mi.LogLevel.Info, f"[drtvam] Simplified '{filename}' from {mesh.face_count()} to {len(faces)} faces.")
+        return mesh_from_arrays(vertices, faces)
+
+    return cached_mesh_file(filename, cache_dir, simplify, (tolerance, *key), suffix='_simplified')
+
 def get_mesh_transform(filename, print_size, size=None):
     """
     Params
@@ -4,7 +4,7 @@ import mitsuba as mi
 import drjit as dr
 
 #TODO: test with analytic GT
-def build_scene(method):
+def build_scene(method, albedo=0.5):
     d_ext = 16.77
     d_int = 15.33
     scene_dict = {
@@ -56,7 +56,7 @@ def build_scene(method):
             'interior': {
                 'type': 'homogeneous',
                 'sigma_t': 0.1,
-                'albedo': 0.5,
+                'albedo': albedo,
                 'phase': {'type': 'rayleigh'}
             }
         },
@@ -66,6 +66,43 @@ def build_scene(method):
 
     return mi.load_dict(scene_dict)
 
+def cylinder_scene(sensor='dda', film=None, albedo=0., sigma_t=0.5, patterns=None, projector={}, **shapes):
+    """
+    Small scene for quick tests: cylinder of printing medium of radius 0.9 in a
+    sensor spanning [-1, 1]^3, lit by a collimated projector rotating around
+    it. 'sensor' is either the sensor type, or a dictionary of sensor
+    parameters, and 'projector' holds additional projector parameters. The
+    film defaults to a 16^3 volumetric film and the patterns to 8 patterns of
+    16x16 ones.
+    """
+    return mi.load_dict({
+        'type': 'scene',
+        'projector': {
+            'type': 'collimated',
+            'patterns': dr.ones(mi.TensorXf, shape=(8, 16, 16)) if patterns is None else patterns,
+            'pixel_size': 2. / 16,
+            'motion': 'circular',
+            'distance': 3.,
+        } | projector,
+        'sensor': ({'type': sensor} if isinstance(sensor, str) else sensor) | {
+            'to_world': mi.ScalarTransform4f().scale(2.),
+            'film': {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16} if film is None else film,
+        },
+        'vial': {
+            'type': 'cylinder',
+            'p0': [0., 0., -1.],
+            'p1': [0., 0., 1.],
+            'radius': 0.9,
+            'bsdf': {'type': 'null'},
+            'interior': {
+                'type': 'homogeneous',
+                'sigma_t': sigma_t,
+                'albedo': albedo,
+                'phase': {'type': 'isotropic'},
+            },
+        },
+    } | shapes)
+
 @pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
 def test_reverse_ad(variant):
     mi.set_variant(variant)
@@ -109,3 +146,70 @@ def test_reverse_ad(variant):
 
         assert dr.abs((a.grad - fd_grad) / fd_grad) < 2e-4
 
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_cache_rays(variant):
+    mi.set_variant(variant)
+    scene = build_scene('dda', albedo=0.)
+
+    def integrator(cache_rays):
+        # Without Russian roulette, paths through an absorptive medium are deterministic with regular sampling
+        return mi.load_dict({
+            'type': 'volume',
+            'max_depth': 8,
+            'rr_depth': 8,
+            'regular_sampling': True,
+            'cache_rays': cache_rays,
+        })
+
+    # Configurations where the rays traced to the medium are random
+    with pytest.raises(ValueError):
+        mi.load_dict({'type': 'volume', 'cache_rays': True})
+    with pytest.raises(ValueError):
+        mi.load_dict({'type': 'volume', 'cache_rays': True, 'regular_sampling': True, 'sample_time': True})
+    with pytest.raises(ValueError):
+        mi.load_dict({'type': 'volume', 'cache_rays': True, 'regular_sampling': True, 'transmission_only': False})
+
+    vol_ref = mi.render(scene, integrator=integrator(False), seed=0)
+
+    cached = integrator(True)
+    vol = mi.render(scene, integrator=cached, seed=0)
+    assert cached.ray_cache is not None
+    assert dr.allclose(vol, vol_ref, rtol=1e-3, atol=1e-4)
+
+    # The cached rays are reused in subsequent renderings
+    ray_cache = cached.ray_cache
+    vol = mi.render(scene, integrator=cached, seed=1)
+    assert cached.ray_cache is ray_cache
+    assert dr.allclose(vol, vol_ref, rtol=1e-3, atol=1e-4)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+@pytest.mark.parametrize("integrator", [{'type': 'radon'}, {'type': 'corner', 'dist': 0.5, 'radius': 0.2}])
+def test_pixel_block_sum(variant, integrator):
+    mi.set_variant(variant)
+    scene = cylinder_scene(target={
+        'type': 'cube',
+        'to_world': mi.ScalarTransform4f().scale(0.5),
+        'bsdf': {'type': 'null'},
+    })
+    # Keep every other pixel, so that the active pixels are not contiguous
+    params = mi.traverse(scene)
+    params['projector.active_pixels'] = dr.arange(mi.UInt32, 0, 8 * 16 * 16, 2)
+    params['projector.active_data'] = dr.ones(mi.Float, 4 * 16 * 16)
+    params.update()
+
+    integrator = mi.load_dict(integrator)
+    imgs = integrator.render(scene, seed=0, spp=4)
+
+    # Previous implementation, scattering each sample to its pixel
+    projector = scene.emitters()[0]
+    with dr.suspend_grad():
+        sampler, spp = integrator.prepare(projector, 0, 4)
+        ray, _, weight = integrator.sample_rays(scene, projector, sampler)
+        L = integrator.sample(mode=dr.ADMode.Primal, scene=scene, sampler=sampler, ray=ray,
+                              depth=mi.UInt32(0), active=mi.Bool(True)) * weight
+        ref = dr.zeros(mi.TensorXf, projector.size())
+        dr.scatter_reduce(dr.ReduceOp.Add, ref.array, L, dr.repeat(projector.active_pixels, spp))
+
+    assert dr.sum(ref.array)[0] > 0
+    assert dr.allclose(imgs, ref)
@@ -0,0 +1,64 @@
+import pytest
+import mitsuba as mi
+import drjit as dr
+import drtvam
+from drtvam.lbfgs import LinearLBFGSB
+
+def quadratic(n):
+    """
+    Linear forward model y = w * x and loss |y - b|^2, whose bound-constrained
+    minimum is max(b / w, 0)
+    """
+    key = 'projector.active_data'
+    i = dr.arange(mi.Float, n)
+    w = 1. + i / n
+    b = dr.sin(i)
+
+    def render_fn(vars):
+        return w * vars[key]
+
+    def loss_fn(y, patterns):
+        return dr.sum(dr.square(y - b))
+
+    return key, w, b, render_fn, loss_fn
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_lbfgsb_quadratic(variant):
+    mi.set_variant(variant)
+    key, w, b, render_fn, loss_fn = quadratic(64)
+
+    opt = LinearLBFGSB(render_fn=render_fn, loss_fn=loss_fn)
+    opt[key] = dr.full(mi.Float, 1., 64)
+    for _ in range(30):
+        vol = render_fn(opt)
+        loss = loss_fn(vol, opt[key])
+        dr.backward(loss)
+        opt.step(dr.detach(vol), loss)
+        assert dr.all(dr.detach(opt[key]) >= 0)
+
+    assert dr.allclose(opt[key], dr.maximum(b / w, 0.), atol=1e-4)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+@pytest.mark.parametrize("scale", [0.1, 1., 10., 1000.])
+def test_line_search(variant, scale):
+    mi.set_variant(variant)
+    key, w, b, render_fn, loss_fn = quadratic(64)
+    opt = LinearLBFGSB(render_fn=render_fn, loss_fn=loss_fn)
+
+    # Steepest descent direction, scaled so that different step sizes are accepted
+    x = dr.full(mi.Float, 1., 64)
+    vol = w * x
+    loss = loss_fn(vol, x)
+    d = -scale * 2. * w * (vol - b)
+    dvol = w * d
+    g_dot_z = dr.dot(2. * w * (vol - b), d)
+    alpha = opt.line_search(vol, dvol, loss, g_dot_z, x, d)
+
+    # Sequential backtracking search
+    alpha_ref = 1.
+    for _ in range(opt.search_it):
+        if dr.all(loss_fn(vol + alpha_ref * dvol, x + alpha_ref * d) <= loss + 1e-4 * alpha_ref * g_dot_z):
+            break
+        alpha_ref *= 0.5
+
+    assert dr.all(alpha == alpha_ref)
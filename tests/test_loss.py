@@ -107,3 +107,28 @@ def test_thresholded(variant):
     dr.backward(loss)
     assert dr.allclose(pred.grad.array, mi.Float([-2*0.2*0.75, 0., 0., 2*0.5*0.02]))
 
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+@pytest.mark.parametrize("loss_cls", [L2Loss, ThresholdedLoss])
+@pytest.mark.parametrize("reduction", ['sum', 'mean'])
+def test_fused_grad(variant, loss_cls, reduction):
+    mi.set_variant(variant)
+    loss_fn = loss_cls({'K': 2, 'tl': 0.9, 'tu': 0.95, 'weight_sparsity': 0.1,
+                        'reduction': reduction})
+    patterns = mi.Float([0., 0.5, 1.5, 2.])
+
+    # Binary target and surface-aware target
+    for target, pred in [(mi.TensorXf([1,1,0,0], shape=(2,2)),
+                          mi.TensorXf([0.5, 1.1, 0.92, 0.5], shape=(2,2,1))),
+                         (mi.TensorXf([0.2, 0.8, 2, 2], shape=(2,1,2)),
+                          mi.TensorXf([0.2, 0.1, 0.96, 0.92], shape=(2,1,2)))]:
+        p = mi.Float(patterns)
+        dr.enable_grad(pred, p)
+        loss = loss_fn(pred, target, p)
+        dr.backward(loss)
+
+        loss_fused, grad_pred, grad_patterns = loss_fn.eval_grad(pred, target, p)
+        assert dr.allclose(loss_fused, loss)
+        assert grad_pred.shape == pred.shape
+        assert dr.allclose(grad_pred.array, pred.grad.array)
+        assert dr.allclose(grad_patterns, p.grad)
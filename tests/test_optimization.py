@@ -10,6 +10,7 @@ import drtvam
 from drtvam.loss import *
 from drtvam.optimize import *
 from drtvam.utils import discretize
+from test_integrators import cylinder_scene
 import matplotlib.pyplot as plt
 
 
@@ -105,6 +106,7 @@ def test_square_hole_occlusion_optimization(fname, variant):
                                    'tests/files/box_hole_cylindrical.json',\
                                    'tests/files/box_hole_square.json',\
                                    'tests/files/box_hole_square_different_thresholds.json',\
+                                   'tests/files/box_hole_square_lbfgsb.json',\
                                    #'tests/files/box_hole_square_weighted_loss.json',\
                                    'tests/files/box_hole_index_matched.json',\
                                    'tests/files/box_hole_custom_cuvette.json'\
@@ -164,3 +166,118 @@ def test_square_hole_optimization(fname, variant):
     # plt.imshow(vol_final.numpy()[:, 50, :, 0])
     # plt.show()
 
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_incremental_dose(variant):
+    mi.set_variant(variant)
+
+    scene = cylinder_scene(patterns=dr.full(mi.TensorXf, 0.5, shape=(8, 16, 16)))
+    integrator = mi.load_dict({'type': 'volume', 'max_depth': 8, 'rr_depth': 8, 'regular_sampling': True})
+    params = mi.traverse(scene)
+    patterns_key = 'projector.active_data'
+    loss_fn = L2Loss({})
+
+    def render(seed):
+        return mi.render(scene, params, integrator=integrator, spp=4, seed=seed)
+
+    def render_fn(vars):
+        params[patterns_key] = vars[patterns_key]
+        params.update()
+        return render(i)
+
+    # Half of the dose of the initial patterns, so that some pixels end up at zero
+    target = 0.5 * dr.detach(render(0))
+    opt = LinearLBFGSB(render_fn=render_fn, loss_fn=lambda y, patterns: loss_fn(y, target, patterns))
+    opt[patterns_key] = params[patterns_key]
+
+    for i in range(4):
+        params.update(opt)
+        vol = render(i)
+        loss = loss_fn(vol, target, params[patterns_key])
+        dr.backward(loss)
+        opt.step(dr.detach(vol), loss)
+
+        # By linearity, the predicted dose matches a full render of the updated
+        # patterns with the same seed
+        params.update(opt)
+        with dr.suspend_grad():
+            vol_ref = render(i)
+        assert dr.all(dr.detach(opt[patterns_key]) >= 0)
+        assert dr.allclose(opt.vol, vol_ref, rtol=1e-3, atol=1e-5)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_set_active_pixels(variant):
+    mi.set_variant(variant)
+
+    scene = cylinder_scene(patterns=dr.full(mi.TensorXf, 0.5, shape=(8, 16, 16)))
+    integrator = mi.load_dict({'type': 'volume', 'max_depth': 8, 'rr_depth': 8, 'regular_sampling': True})
+    params = mi.traverse(scene)
+    patterns_key = 'projector.active_data'
+    loss_fn = L2Loss({})
+
+    def render():
+        return mi.render(scene, params, integrator=integrator, spp=4, seed=0)
+
+    def render_fn(vars):
+        params[patterns_key] = vars[patterns_key]
+        params.update()
+        return render()
+
+    all_pixels = mi.UInt32(params['projector.active_pixels'])
+    n_all = dr.width(all_pixels)
+    all_map = dr.arange(mi.UInt32, n_all)
+    dropped = all_map % 2 == 1
+    # Twice the dose of the initial patterns, so that all gradients are non-positive
+    with dr.suspend_grad():
+        target = 2. * render()
+    opt = LinearLBFGSB(render_fn=render_fn, loss_fn=lambda y, patterns: loss_fn(y, target, patterns))
+    opt[patterns_key] = params[patterns_key]
+
+    # Drop every other pixel: the kept pixels carry over their values, and the
+    # dose matches that of all pixels with the dropped ones at zero
+    kept = dr.compress(~dropped) + dr.opaque(mi.UInt32, 0)
+    active_map = set_active_pixels(params, opt, patterns_key, all_pixels, all_map, kept)
+    assert dr.width(opt[patterns_key]) == n_all // 2
+    assert dr.all(params['projector.active_pixels'] == dr.gather(mi.UInt32, all_pixels, kept))
+    with dr.suspend_grad():
+        vol_compact = render()
+        params['projector.active_pixels'] = all_pixels
+        params[patterns_key] = dr.select(dropped, 0., 0.5)
+        params.update()
+        vol_full = render()
+    assert dr.allclose(vol_compact, vol_full, rtol=1e-3, atol=1e-5)
+
+    # Trace all pixels again: the dropped pixels come back at zero, and are
+    # raised by the optimizer since their gradient is negative
+    active_map = set_active_pixels(params, opt, patterns_key, all_pixels, active_map, all_map)
+    assert dr.all(dr.detach(opt[patterns_key]) == dr.select(dropped, 0., 0.5))
+
+    params.update(opt)
+    vol = render()
+    loss = loss_fn(vol, target, params[patterns_key])
+    dr.backward(loss)
+    grad = mi.Float(opt[patterns_key].grad)
+    opt.step(dr.detach(vol), loss)
+    raised = dr.detach(opt[patterns_key]) > 0
+    assert dr.all(dr.select(dropped & (grad < 0), raised, True))
+    assert dr.any(dropped & raised)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_compaction(variant, tmp_path):
+    mi.set_variant(variant)
+
+    with open('tests/files/box_hole_square_lbfgsb.json', 'r') as f:
+        config = json.load(f)
+    config['n_steps'] = 12
+    config['output'] = str(tmp_path)
+    os.makedirs(tmp_path / "patterns", exist_ok=True)
+
+    losses = []
+    for compact_every in (0, 2):
+        config['compact_every'] = compact_every
+        config['compact_patience'] = 1
+        optimize(json.loads(json.dumps(config)))
+        losses.append(np.load(os.path.join(config['output'], "loss.npy")))
+
+    # Dropped pixels do not contribute to the dose, so the optimization follows the same path
+    assert np.allclose(losses[0][-1], losses[1][-1], rtol=5e-2)
@@ -2,6 +2,7 @@ import pytest
 import mitsuba as mi
 import drjit as dr
 import drtvam
+from test_integrators import cylinder_scene
 
 @pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
 def test_crop(variant):
@@ -37,3 +38,54 @@ def test_crop(variant):
 
     assert dr.all((ray.o.y > -2) & (ray.o.y < 2) & (ray.o.z > -2) & (ray.o.z < 2) , axis=None)
 
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_intensity_sampling(variant):
+    mi.set_variant(variant)
+    projector = mi.load_dict({
+        "type": "collimated",
+        "n_patterns": 1,
+        "resx": 4,
+        "resy": 1,
+        "pixel_size": 1.,
+        "motion": "circular",
+        "distance": 20
+    })
+    params = mi.traverse(projector)
+    params['active_data'] = mi.Float([0., 1., 2., 5.])
+    params.update()
+
+    integrator = mi.load_dict({
+        "type": "volume",
+        "pixel_sampling": "intensity",
+        "uniform_fraction": 0.2
+    })
+    sampler = mi.load_dict({'type': 'independent'})
+
+    spp = 4096
+    sampler.set_sample_count(spp)
+    sampler.set_samples_per_wavefront(spp)
+    sampler.seed(0, projector.active_size() * spp)
+
+    _, L, _ = integrator.sample_rays(None, projector, sampler)
+
+    # The total emitted power should match the one of uniform sampling
+    assert dr.allclose(dr.sum(L) / spp, 8., rtol=5e-2)
+    # Dark pixels are still sampled
+    assert dr.count(L == 0) > 0
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_samplers(variant):
+    mi.set_variant(variant)
+
+    def render(sampler):
+        scene = cylinder_scene(projector={'sampler': {'type': sampler}})
+        integrator = mi.load_dict({'type': 'volume', 'max_depth': 8, 'rr_depth': 8})
+        return mi.render(scene, integrator=integrator, spp=64, seed=0)
+
+    # Stratified and low-discrepancy samplers give the same expected dose as the independent sampler
+    reference = render('independent')
+    for sampler in ('stratified', 'multijitter', 'ldsampler'):
+        vol = render(sampler)
+        assert dr.allclose(dr.sum(vol.array), dr.sum(reference.array), rtol=1e-2)
+        assert dr.allclose(vol, reference, rtol=0.1, atol=0.1 * dr.max(reference.array)[0])
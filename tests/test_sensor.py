@@ -1 +1,414 @@
 #TODO: test crop, different resolutions
+import pytest
+import numpy as np
+import mitsuba as mi
+import drjit as dr
+import drtvam
+from test_integrators import cylinder_scene
+
+def render(scene, seed=0, spp=4, **props):
+    integrator = mi.load_dict({
+        'type': 'volume',
+        'max_depth': 8,
+        'rr_depth': 8,
+    } | props)
+    return mi.render(scene, integrator=integrator, spp=spp, seed=seed)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_sparse_film(variant):
+    mi.set_variant(variant)
+    film = mi.load_dict({
+        'type': 'sfilm',
+        'resx': 8,
+        'resy': 8,
+        'resz': 8,
+        'brick_size': 4,
+    })
+    # Refine the first and last bricks
+    film.refine(dr.arange(mi.UInt32, 8) % 7 == 0)
+    assert film.data.shape == (2 * 64 + 6, 1)
+
+    lo, size = film.cells()
+    idx = dr.arange(mi.UInt32, 134)
+    assert dr.all(size == dr.select((idx >= 64) & (idx < 70), 4., 1.))
+    assert dr.all(dr.gather(mi.Point3f, lo, 64) == mi.Point3f(4, 0, 0))
+    assert dr.all(dr.gather(mi.Point3f, lo, 133) == mi.Point3f(7, 7, 7))
+
+    # Constant values within coarse cells survive the round trip
+    dense = mi.TensorXf(dr.arange(mi.Float, 512), shape=(8, 8, 8, 1))
+    values = film.compact(dense)
+    expanded = film.expand(values)
+    x = dr.arange(mi.UInt32, 512) % 8
+    y = (dr.arange(mi.UInt32, 512) // 8) % 8
+    z = dr.arange(mi.UInt32, 512) // 64
+    brick = x // 4 + (y // 4) * 2 + (z // 4) * 4
+    refined = (brick == 0) | (brick == 7)
+    assert dr.all(dr.select(refined, expanded.array == dense.array, True))
+    assert dr.allclose(dr.sum(values.array * size**3), dr.sum(dense.array))
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_masked_film(variant):
+    mi.set_variant(variant)
+    film = mi.load_dict({
+        'type': 'mfilm',
+        'resx': 4,
+        'resy': 4,
+        'resz': 4,
+        'surface_aware': True,
+    })
+    mask = dr.arange(mi.UInt32, 64) % 3 == 0
+    film.set_mask(mask)
+    assert film.data.shape == (22, 2)
+
+    # Writes outside of the mask are discarded
+    idx, active = film.index(dr.arange(mi.UInt32, 128))
+    film.write(dr.ones(mi.Float, 128), idx, active)
+    assert dr.allclose(dr.sum(film.data.array), 44)
+
+    expanded = film.expand(film.data)
+    assert dr.all(expanded.array == dr.select(dr.repeat(mask, 2), 1., 0.))
+    assert dr.all(film.compact(expanded).array == film.data.array)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_medium_mask(variant):
+    mi.set_variant(variant)
+    scene = cylinder_scene('dda')
+    sensor = scene.sensors()[0]
+    mask = sensor.medium_mask(scene)
+    assert dr.all(mask == sensor.medium_mask(scene))
+
+    # Distance from the axis of the cylinder to the closest point of each voxel
+    lo = np.linspace(-1., 1., 17)[:-1]
+    hi = lo + 2. / 16
+    d = np.maximum(np.maximum(lo, -hi), 0.)
+    dist = np.sqrt(d[None, :]**2 + d[:, None]**2)
+    dist = np.broadcast_to(dist, (16, 16, 16)).ravel()
+
+    # All voxels overlapping the medium are kept, voxels far from it are not
+    mask = mask.numpy()
+    assert np.all(mask[dist < 0.9])
+    assert not np.any(mask[dist > 1.2])
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_extinction_grid(variant):
+    mi.set_variant(variant)
+    from drtvam.sensor import ExtinctionGrid
+
+    sigma_t = 0.5
+    bbox = mi.BoundingBox3f(mi.Point3f(0.), mi.Point3f(1.))
+    extinction = ExtinctionGrid(dr.full(mi.TensorXf, sigma_t, shape=(16, 16, 16, 1)), bbox, 0., brick_size=4)
+    assert extinction.majorants.data.shape == (64,)
+
+    n = 2**16
+    sampler = mi.load_dict({'type': 'independent'})
+    sampler.seed(0, n)
+    ray = mi.Ray3f(mi.Point3f(-1., 0.5, 0.5), mi.Vector3f(1., 0., 0.))
+
+    # The extinction is zero outside of the grid, so only one unit of length is traversed
+    tr = extinction.transmittance(ray, 0., 3., sampler)
+    assert dr.allclose(dr.mean(tr[0]), dr.exp(-sigma_t), rtol=1e-2)
+
+    mei = extinction.sample_interaction(ray, 3., sampler)
+    hit = mei.is_valid()
+    assert dr.allclose(dr.mean(dr.select(hit, 1., 0.)), 1 - dr.exp(-sigma_t), rtol=1e-2)
+    assert dr.all(dr.select(hit, (mei.t >= 1.) & (mei.t <= 2.), True))
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_sparse_dda(variant):
+    mi.set_variant(variant)
+    res = {'resx': 16, 'resy': 16, 'resz': 16}
+    dense = cylinder_scene('dda', {'type': 'vfilm'} | res)
+    sparse = cylinder_scene('dda', {'type': 'sfilm', 'brick_size': 4} | res)
+    film = sparse.sensors()[0].film()
+    film.refine(dr.arange(mi.UInt32, 64) % 5 == 0)
+
+    # Coarse bricks are crossed in a single step, and receive the mean dose of their voxels
+    vol_dense = render(dense, regular_sampling=True)
+    vol_sparse = render(sparse, regular_sampling=True)
+    assert vol_sparse.shape == film.data.shape
+    assert dr.allclose(vol_sparse, film.compact(vol_dense), rtol=1e-3, atol=1e-4)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_ratio_auto_majorant(variant):
+    mi.set_variant(variant)
+    sigma_t = 2.
+    # Single pattern, the beam enters the cube [-1, 1]^3 at x = 1 and travels along -x
+    scene = mi.load_dict({
+        'type': 'scene',
+        'projector': {
+            'type': 'collimated',
+            'patterns': dr.ones(mi.TensorXf, shape=(1, 16, 16)),
+            'pixel_size': 2. / 16,
+            'motion': 'circular',
+            'distance': 3.,
+        },
+        'sensor': {
+            'type': 'ratio',
+            'to_world': mi.ScalarTransform4f().scale(2.),
+            'film': {'type': 'vfilm', 'resx': 8, 'resy': 8, 'resz': 8},
+        },
+        'vial': {
+            'type': 'cube',
+            'bsdf': {'type': 'null'},
+            'interior': {'type': 'homogeneous', 'sigma_t': sigma_t, 'albedo': 0.},
+        },
+    })
+    vol = render(scene, spp=256)
+
+    # Fraction of the energy absorbed in each slab of constant x, at depth t = 1 - x
+    profile = vol.numpy().sum(axis=(0, 1, 3))
+    t = 1. - np.linspace(-1., 1., 9)
+    expected = np.exp(-sigma_t * t[1:]) - np.exp(-sigma_t * t[:-1])
+    assert np.allclose(profile / profile.sum(), expected / expected.sum(), rtol=3e-2)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_hybrid_sensor(variant):
+    mi.set_variant(variant)
+    film = {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16}
+    vols = {sensor: render(cylinder_scene(sensor, film, albedo=0.5), spp=64).numpy()
+            for sensor in ('dda', 'hybrid', 'delta')}
+
+    # Same expected dose as the analytic and delta tracking sensors on a scattering medium
+    total = vols['dda'].sum()
+    assert np.isclose(vols['hybrid'].sum(), total, rtol=2e-2)
+    assert np.isclose(vols['delta'].sum(), total, rtol=5e-2)
+    profile = vols['dda'].sum(axis=0)
+    assert np.allclose(vols['hybrid'].sum(axis=0), profile, rtol=5e-2, atol=1e-2 * profile.max())
+
+    # Free-flight distances are never sampled in a purely absorptive medium
+    with pytest.raises(ValueError, match="hybrid sensor"):
+        render(cylinder_scene('hybrid', film, albedo=0.))
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+@pytest.mark.parametrize("sensor", ["dda", "ratio"])
+def test_constant_extinction_grid(variant, sensor):
+    mi.set_variant(variant)
+    from drtvam.sensor import ExtinctionGrid
+
+    sigma_t = 0.5
+    film = {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16}
+    homogeneous = cylinder_scene(sensor, film, sigma_t=sigma_t)
+
+    # Constant grid over the bounding box of the cylinder
+    bbox = mi.BoundingBox3f(mi.Point3f(-0.9, -0.9, -1.), mi.Point3f(0.9, 0.9, 1.))
+    grid = dr.full(mi.TensorXf, sigma_t, shape=(8, 8, 8, 1))
+    heterogeneous = cylinder_scene(sensor, film, vial={
+        'type': 'cylinder',
+        'p0': [0., 0., -1.],
+        'p1': [0., 0., 1.],
+        'radius': 0.9,
+        'bsdf': {'type': 'null'},
+        'interior': {
+            'type': 'heterogeneous',
+            'sigma_t': {
+                'type': 'gridvolume',
+                'grid': mi.VolumeGrid(grid.numpy()),
+                'to_world': mi.ScalarTransform4f().translate([-0.9, -0.9, -1.]).scale([1.8, 1.8, 2.]),
+            },
+            'albedo': 0.,
+        },
+    })
+
+    integrator = mi.load_dict({'type': 'volume', 'max_depth': 8, 'rr_depth': 8})
+    integrator.extinction = ExtinctionGrid(grid, bbox, 0., brick_size=4)
+    vol = mi.render(heterogeneous, integrator=integrator, spp=64, seed=0)
+    vol_ref = render(homogeneous, spp=64)
+    assert np.isclose(dr.sum(vol.array)[0], dr.sum(vol_ref.array)[0], rtol=1e-2)
+    assert dr.allclose(vol, vol_ref, rtol=5e-2, atol=5e-2 * dr.max(vol_ref.array)[0])
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_boundary_volume_estimator(variant):
+    mi.set_variant(variant)
+    # Cube of side 1.1, whose faces are not aligned with the voxel boundaries
+    scene = mi.load_dict({
+        'type': 'scene',
+        'target': {
+            'type': 'cube',
+            'to_world': mi.ScalarTransform4f().scale(0.55),
+            'bsdf': {'type': 'null'},
+        },
+    })
+
+    volumes = {}
+    for estimator in ('sampling', 'boundary'):
+        sensor = mi.load_dict({
+            'type': 'dda',
+            'to_world': mi.ScalarTransform4f().scale(2.),
+            'volume_estimator': estimator,
+            'film': {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16, 'surface_aware': True},
+        })
+        volumes[estimator] = sensor.compute_volume(scene).numpy()
+    boundary = sensor.boundary_voxels(scene.shapes()[0]).numpy().reshape(16, 16, 16)
+
+    # Voxels entirely inside or outside of the cube, from their distance to its center
+    c = np.abs(np.linspace(-1., 1., 17)[:-1] + 1. / 16)
+    dist = np.maximum(np.maximum(c[:, None, None], c[None, :, None]), c[None, None, :])
+    interior = dist + 1. / 16 < 0.55
+    exterior = dist - 1. / 16 > 0.55
+    assert np.all(boundary[~interior & ~exterior])
+
+    # Voxels that are not crossed by the surface get exact volumes
+    cell_vol = (2. / 16) ** 3
+    inside = volumes['boundary'][..., 0]
+    assert np.all(inside[interior] == cell_vol)
+    assert np.all(inside[exterior] == 0.)
+    assert np.allclose(inside + volumes['boundary'][..., 1], cell_vol)
+
+    assert np.isclose(inside.sum(), 1.1**3, rtol=1e-2)
+    assert np.isclose(inside.sum(), volumes['sampling'][..., 0].sum(), rtol=1e-2)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_cylindrical_dda(variant):
+    mi.set_variant(variant)
+    # Both grids cover the cylinder of medium, and the rays are the same
+    cyl = render(cylinder_scene('cylindrical_dda', {'type': 'cfilm', 'resr': 8, 'restheta': 16, 'resz': 4}), spp=64).numpy()[..., 0]
+    cart = render(cylinder_scene('dda', {'type': 'vfilm', 'resx': 32, 'resy': 32, 'resz': 4}), spp=64).numpy()[..., 0]
+
+    # Same absorbed energy
+    r = np.arange(8)
+    cyl_vol = (r + 0.5) * (1. / 8)**2 * (2 * np.pi / 16) * 0.5
+    assert np.isclose((cyl * cyl_vol).sum(), cart.sum() * (2. / 32)**2 * 0.5, rtol=1e-3)
+
+    # Same dose averaged over rings, away from the surface of the medium
+    x = np.linspace(-1., 1., 33)[:-1] + 1. / 32
+    ring = np.floor(8 * np.sqrt(x[None, :]**2 + x[:, None]**2)).astype(int)
+    for i in range(6):
+        assert np.isclose(cyl[:, :, i].mean(), cart[:, ring == i].mean(), rtol=5e-2)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_voxel_exit(variant):
+    mi.set_variant(variant)
+    sensor = mi.load_dict({
+        'type': 'cylindrical_dda',
+        'to_world': mi.ScalarTransform4f().scale(2.),
+        'film': {'type': 'cfilm', 'resr': 4, 'restheta': 8, 'resz': 4},
+    })
+
+    n = 4096
+    sampler = mi.load_dict({'type': 'independent'})
+    sampler.seed(0, n)
+    o = mi.Point3f(2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1)
+    ray = mi.Ray3f(o, mi.warp.square_to_uniform_sphere(sampler.next_2d()))
+    voxel, valid = sensor.voxel_index(o)
+
+    t_exit = sensor.voxel_exit(ray, voxel, 0.)
+    valid &= dr.isfinite(t_exit)
+    assert dr.all(dr.select(valid, t_exit > 0, True))
+
+    # The rays stay in their voxel until they exit it
+    eps = 1e-4
+    valid &= t_exit > 2 * eps
+    for t in (0.5 * t_exit, t_exit - eps):
+        v, _ = sensor.voxel_index(ray(t))
+        assert dr.all(dr.select(valid, dr.all(v == voxel), True))
+    v, _ = sensor.voxel_index(ray(t_exit + eps))
+    assert dr.all(dr.select(valid, dr.any(v != voxel), True))
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_tent_filter(variant):
+    mi.set_variant(variant)
+    sensors = {f: mi.load_dict({
+        'type': 'dda',
+        'to_world': mi.ScalarTransform4f().scale(2.),
+        'film': {'type': 'vfilm', 'resx': 8, 'resy': 8, 'resz': 8, 'filter': f},
+    }) for f in ('box', 'tent')}
+    tent = sensors['tent']
+
+    # The weights of each sample sum to one, including next to the boundary of the grid
+    n = 4096
+    sampler = mi.load_dict({'type': 'independent'})
+    sampler.seed(0, n)
+    p = mi.Point3f(2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1)
+    voxel, valid = tent.voxel_index(p)
+    taps = tent.film_taps(p, voxel, valid, True)
+    assert len(taps) == 8
+    assert dr.allclose(sum(w for _, w, _ in taps), 1.)
+
+    tent.m_film.clear()
+    tent.splat(taps, dr.ones(mi.Float, n))
+    assert dr.allclose(dr.sum(tent.m_film.data.array), dr.sum(dr.select(valid, 1., 0.)))
+
+    # Samples at voxel centers are not spread to the neighboring voxels
+    coords = dr.arange(mi.UInt32, 512)
+    voxel = mi.Vector3i(coords % 8, (coords // 8) % 8, coords // 64)
+    p = tent.voxel_to_world(mi.Point3f(voxel) + 0.5)
+    values = mi.Float(coords)
+    for sensor in sensors.values():
+        sensor.m_film.clear()
+        sensor.splat(sensor.film_taps(p, voxel, True, True), values)
+    assert dr.allclose(tent.m_film.data, sensors['box'].m_film.data, atol=1e-3)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_min_transmittance(variant):
+    mi.set_variant(variant)
+    film = {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16}
+    vols = [render(cylinder_scene({'type': 'dda', 'min_transmittance': threshold}, film, sigma_t=4.)).numpy()
+            for threshold in (0., 1e-3)]
+
+    # Only the energy left after the transmittance drops below the threshold is lost
+    assert np.isclose(vols[1].sum(), vols[0].sum(), rtol=2e-3)
+    assert np.allclose(vols[1], vols[0], atol=1e-2 * vols[0].max())
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_occupancy_grid(variant):
+    mi.set_variant(variant)
+    from drtvam.sensor import OccupancyGrid
+    target = {
+        'type': 'cube',
+        'to_world': mi.ScalarTransform4f().scale(0.55),
+        'bsdf': {'type': 'null'},
+    }
+    film = {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16, 'surface_aware': True}
+    scene = cylinder_scene('dda', film, target=target)
+    sensor = scene.sensors()[0]
+    target_scene = mi.load_dict({'type': 'scene', 'target': target})
+    occupancy = OccupancyGrid(sensor.occupancy(target_scene, 2), sensor.bbox)
+
+    # Points are classified as by the ray parity test, except close to the surface
+    n = 2**16
+    sampler = mi.load_dict({'type': 'independent'})
+    sampler.seed(0, n)
+    p = mi.Point3f(2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1, 2 * sampler.next_1d() - 1)
+    inside_grid = occupancy.eval(p)
+    inside_mesh = sensor.is_inside(target_scene, target_scene.shapes()[0], p)
+    near_surface = dr.abs(dr.max(dr.abs(p)) - 0.55) < dr.max(sensor.voxel_size) / 2
+    assert dr.all(dr.select(near_surface, True, inside_grid == inside_mesh))
+    assert dr.all(dr.select(near_surface, True, inside_grid == (dr.max(dr.abs(p)) < 0.55)))
+
+    # Same inside and outside doses along the rays
+    vols = {}
+    for inside_test in ('mesh', 'grid'):
+        integrator = mi.load_dict({'type': 'volume', 'max_depth': 8, 'rr_depth': 8, 'inside_test': inside_test})
+        integrator.occupancy = occupancy
+        vols[inside_test] = mi.render(scene, integrator=integrator, spp=16, seed=0).numpy()
+    for channel in range(2):
+        assert np.isclose(vols['grid'][..., channel].sum(), vols['mesh'][..., channel].sum(), rtol=2e-2)
+
+@pytest.mark.parametrize("variant", ["cuda_ad_mono", "llvm_ad_mono"])
+def test_reduce_modes(variant):
+    mi.set_variant(variant)
+    modes = ['auto', 'direct', 'local']
+    if variant.startswith('llvm'):
+        modes.append('expand')
+    else:
+        with pytest.raises(ValueError, match="only supported on the LLVM backend"):
+            mi.load_dict({'type': 'vfilm', 'resx': 8, 'resy': 8, 'resz': 8, 'reduce_mode': 'expand'})
+
+    # Runs of contributions to the same voxels, with integer values so that
+    # the sums do not depend on the order of the additions
+    n = 2**16
+    idx = (dr.arange(mi.UInt32, n) // 16) % 512
+    values = mi.Float(dr.arange(mi.UInt32, n) % 7)
+    data = {}
+    for mode in modes:
+        film = mi.load_dict({'type': 'vfilm', 'resx': 8, 'resy': 8, 'resz': 8, 'reduce_mode': mode})
+        film.write(values, idx, True)
+        data[mode] = film.data.numpy()
+    for mode in modes:
+        assert np.all(data[mode] == data['direct'])
+
+    # Same dose when rendering, up to the order of the additions
+    vols = [render(cylinder_scene('dda', {'type': 'vfilm', 'resx': 16, 'resy': 16, 'resz': 16, 'reduce_mode': mode})).numpy()
+            for mode in modes]
+    for vol in vols:
+        assert np.allclose(vol, vols[0], rtol=1e-4, atol=1e-6 * vols[0].max())
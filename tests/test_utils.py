@@ -2,6 +2,7 @@ import mitsuba as mi
 mi.set_variant('cuda_ad_mono', 'cuda_ad_rgb')
 import drjit as dr
 import pytest
+import numpy as np
 from drtvam.utils import iou_loss
 
 def test_iou():
@@ -25,3 +26,97 @@ def test_iou():
     pred = mi.TensorXf([0.6, 0.6, 0.6,0], shape=(2,2))
     assert dr.all(iou_loss(pred, target, threshold=0.5) == 2/3)
 
+
+def test_resample_volume():
+    from drtvam.utils import resample_volume
+    data = np.zeros((4, 4, 4, 1), dtype=np.uint8)
+    data[:2, :2, :2] = 1
+
+    out = resample_volume(data, np.zeros(3), np.ones(3), (2, 2, 2), np.zeros(3), np.ones(3))
+    ref = np.zeros((2, 2, 2))
+    ref[0, 0, 0] = 1
+    assert np.allclose(out, ref)
+
+    # Grid extending outside of the volume
+    out = resample_volume(data, np.zeros(3), np.ones(3), (4, 4, 4), -np.ones(3), np.ones(3))
+    assert np.allclose(out[2, 2, 2], 1.)
+    assert np.allclose(out[:2], 0.)
+
+    # Inside and outside fractions
+    data = np.ones((2, 2, 2, 2), dtype=np.float32)
+    out = resample_volume(data, np.zeros(3), np.ones(3), (2, 2, 2), np.zeros(3), np.ones(3), filter='linear')
+    assert np.allclose(out, 0.5)
+
+def test_simplify_mesh():
+    from drtvam.utils import simplify_mesh
+    # Regular grid of 11x11 vertices on the unit square
+    n = 11
+    x, y = np.meshgrid(np.linspace(0, 1, n), np.linspace(0, 1, n))
+    vertices = np.stack((x.ravel(), y.ravel(), np.zeros(n*n)), axis=-1)
+    idx = np.arange(n*n).reshape(n, n)
+    a, b, c, d = idx[:-1, :-1].ravel(), idx[:-1, 1:].ravel(), idx[1:, :-1].ravel(), idx[1:, 1:].ravel()
+    faces = np.concatenate((np.stack((a, b, d), axis=-1), np.stack((a, d, c), axis=-1)))
+
+    tolerance = 0.35
+    new_vertices, new_faces = simplify_mesh(vertices, faces, tolerance)
+    assert len(new_faces) < len(faces)
+    assert new_faces.max() < len(new_vertices)
+    # All vertices are within the tolerance of the simplified vertices
+    dist = np.linalg.norm(vertices[:, None] - new_vertices[None], axis=-1).min(axis=1)
+    assert np.all(dist <= tolerance)
+
+@pytest.mark.parametrize("fname", ['tests/files/box_hole.ply', 'tests/files/hollow_gear.ply', 'tests/files/occlusion.ply'])
+def test_discretize_scanline(fname):
+    from drtvam.utils import discretize
+    target = mi.load_dict({'type': 'ply', 'filename': fname, 'bsdf': {'type': 'null'}})
+    bbox = target.bbox()
+    # Sensor slightly larger than the mesh
+    scene = mi.load_dict({
+        'type': 'scene',
+        'target': target,
+        'sensor': {
+            'type': 'dda',
+            'to_world': mi.ScalarTransform4f().translate(bbox.center()).scale(1.1 * bbox.extents()),
+            'film': {'type': 'vfilm', 'resx': 64, 'resy': 64, 'resz': 64},
+        },
+    })
+
+    ray = discretize(scene, method='ray').numpy()
+    scanline = discretize(scene, method='scanline').numpy()
+    assert ray.shape == scanline.shape
+    assert ray.sum() > 0
+    # Both voxelizers may only disagree on voxels whose center is close to the surface
+    assert np.mean(ray == scanline) > 0.99
+    assert np.isclose(scanline.sum(), ray.sum(), rtol=2e-2)
+
+def test_cached_mesh_file(tmp_path):
+    import shutil
+    from drtvam.utils import cached_mesh_file, load_mesh, mesh_arrays
+    fname = str(tmp_path / 'box_hole.ply')
+    shutil.copy('tests/files/box_hole.ply', fname)
+    cache_dir = str(tmp_path / 'cache')
+
+    loads = []
+    def load_fn():
+        loads.append(fname)
+        return load_mesh(fname)
+
+    # Miss, then hit
+    path = cached_mesh_file(fname, cache_dir, load_fn)
+    assert cached_mesh_file(fname, cache_dir, load_fn) == path
+    assert len(loads) == 1
+
+    # The cached file is a binary PLY with the same geometry
+    with open(path, 'rb') as f:
+        assert b'format binary_little_endian' in f.read(256)
+    vertices, faces = mesh_arrays(load_mesh(fname))
+    cached_vertices, cached_faces = mesh_arrays(load_mesh(path))
+    assert np.allclose(cached_vertices, vertices)
+    assert np.all(cached_faces == faces)
+
+    # Different parameters, or a modified file, invalidate the entry
+    assert cached_mesh_file(fname, cache_dir, load_fn, key=(2.,)) != path
+    assert len(loads) == 2
+    load_mesh(fname, to_world=mi.ScalarTransform4f().scale(2.)).write_ply(fname)
+    assert cached_mesh_file(fname, cache_dir, load_fn) != path
+    assert len(loads) == 3